@@ -6,12 +6,16 @@ import json
 import os 
 import hashlib
 import pathlib
-from typing import Dict, List, Any, Tuple
+from typing import Callable, Dict, Hashable, List, Any, Set, Tuple
 from dataclasses import dataclass
 import shutil
-import select
-from threading import Thread
-from time import sleep
+import selectors
+import struct
+import io
+from threading import Thread, Lock
+from time import sleep, monotonic
+from collections import deque
+from concurrent.futures import Future, CancelledError, TimeoutError as FutureTimeoutError
 
 # Third party imports 
 
@@ -19,11 +23,59 @@ from time import sleep
 # Local application imports
 from utils import networking_utils 
 from utils.setup import setup_peer
+from utils import wire_protocol
+from utils.bitfield import Bitfield
+from utils.storage import ChunkStorage, FileStorage, FileRange, file_stamp, public_torrent
+from utils.file_cache import FileCache
+from utils.piece_cache import PieceCache, PIECE_CACHE_BYTES
+from utils.catalog import TorrentCatalog
+from utils.connection_pool import ConnectionPool
+from utils.peer_stats import PeerStats
+from utils.choker import Choker, UPLOAD_SLOTS, RECHOKE_INTERVAL
+from utils import rate_limit
+from utils.rate_limit import BandwidthLimits, TokenBucket, UPLOAD_LIMIT, DOWNLOAD_LIMIT
+from utils.download_manager import DownloadManager, DownloadJob, MAX_ACTIVE_DOWNLOADS
+from utils.stream_server import StreamServer
+from utils.hashing import hash_file, verify_pieces
+from utils.piece_hash import PieceHasher, DEFAULT_ALGORITHM, MERKLE_BLOCK_LENGTH, MERKLE_VERSION
+from utils.download_engine import DownloadEngine, PeerChoked, MAX_IN_FLIGHT, MAX_IN_FLIGHT_PER_PEER, REQUEST_TIMEOUT
 
 BUFSIZE = 3145728
 TORRENT_FILES_DIR = '.torrent'
+# verified pieces of incomplete downloads, one file per info hash
+RESUME_DIR = '.resume'
+# queue of the downloads, see Peer.enqueue_download
+DOWNLOAD_QUEUE_FILE = os.path.join(RESUME_DIR, 'downloads.json')
 HOST_IP = ''
 TRACKER_IP = ''
+# seconds an idle peer session is kept open by the server
+SESSION_IDLE_TIMEOUT = 60
+# seconds to connect to a peer and finish the session handshake
+CONNECT_TIMEOUT = 5
+# seconds a connected peer has to send a torrent or the pieces it holds
+PROBE_TIMEOUT = 10
+# seconds between the server's checks for idle connections
+IDLE_CHECK_INTERVAL = 1
+# bytes the server reads from a connection at once
+READ_SIZE = 65536
+# unanswered requests a session may queue before it is dropped
+MAX_QUEUED_REQUESTS = 256
+# whole pieces of an old peer a session keeps while blocks are cut from them
+LEGACY_PIECES = 8
+# how downloads are stored, see Peer
+STORAGE_MODE = 'file'
+# whether shared files are seeded from where they are, see Peer.create_torrent_file
+SEED_IN_PLACE = True
+# bounds of the automatic piece length, see choose_piece_length
+MIN_PIECE_LENGTH = 1 << 14
+MAX_PIECE_LENGTH = 1 << 24
+# pieces a torrent is split into at most, unless that needs pieces over MAX_PIECE_LENGTH
+MAX_PIECES = 2048
+# hash algorithm of new torrents, see utils.piece_hash.ALGORITHMS
+HASH_ALGORITHM = DEFAULT_ALGORITHM
+# address the HTTP server streaming downloads to local players listens on, port 0 picks a free one
+STREAM_HOST = '127.0.0.1'
+STREAM_PORT = 0
 
 @dataclass
 class Address:
@@ -44,7 +96,12 @@ class FilePart:
     
     
 class Peer: 
-    def __init__(self) -> None:
+    def __init__(self, max_in_flight : int = MAX_IN_FLIGHT,
+                 max_in_flight_per_peer : int = MAX_IN_FLIGHT_PER_PEER,
+                 storage_mode : str = STORAGE_MODE, recheck : bool = False,
+                 piece_cache_bytes : int = PIECE_CACHE_BYTES, upload_slots : int | None = UPLOAD_SLOTS,
+                 upload_limit : float | None = UPLOAD_LIMIT, download_limit : float | None = DOWNLOAD_LIMIT,
+                 max_active_downloads : int = MAX_ACTIVE_DOWNLOADS) -> None:
         setup_peer()
         # tracker holding information about peers 
         self.tracker = f'http://{TRACKER_IP}:5000/'
@@ -53,31 +110,63 @@ class Peer:
         self.peer_id = get_id()
         self.stopped = []
         self.peers = []
+        # limits of concurrent piece requests while downloading
+        self.max_in_flight = max_in_flight
+        self.max_in_flight_per_peer = max_in_flight_per_peer
+        # 'file' writes downloads in place into their final file, 'chunks' keeps
+        # every piece in its own file and joins them once all are downloaded
+        self.storage_mode = storage_mode
+        # info hash -> storage of the torrent, shared with the server
+        self.storages : Dict[str, ChunkStorage | FileStorage] = {}
         
         os.makedirs(TORRENT_FILES_DIR, exist_ok=True)
         os.makedirs('downloads', exist_ok=True)
+        os.makedirs(RESUME_DIR, exist_ok=True)
+        # torrent files by info hash, shared with the server
+        self.catalog = TorrentCatalog(TORRENT_FILES_DIR)
 
-        # socket for connecting to peers 
-        self.socket = socket.socket(
-            socket.AF_INET, 
-            socket.SOCK_STREAM
+        # bytes per second uploaded and downloaded, see set_rate_limits
+        self.limits = BandwidthLimits(upload_limit, download_limit)
+
+        # one session per peer address, shared by every download and lookup
+        self.pool = ConnectionPool(
+            factory=lambda key: PeerSession(Address(*key), self.peer_id, self.limits),
+            healthy=PeerSession.healthy
         )
         
         # server socket listening to peer requests 
         self.server = PeerServer(
             port=self.port,
-            peer_id=self.peer_id
+            peer_id=self.peer_id,
+            storages=self.storages,
+            catalog=self.catalog,
+            piece_cache_bytes=piece_cache_bytes,
+            upload_slots=upload_slots,
+            download_rates=self.download_rates,
+            limits=self.limits
         )
+        # after a crash the stored pieces are verified before any is served
+        if recheck:
+            self.recheck()
         handle_connections_thread = Thread(
             target=self.server.handle_connections)
         handle_connections_thread.daemon = True
         handle_connections_thread.start()
         
-        for torrent_name in os.listdir(TORRENT_FILES_DIR):
-            with open(os.path.join(TORRENT_FILES_DIR, torrent_name), 'r') as file:
-                data = json.load(file)
+        for data in self.catalog.values():
             self.announce(data['info_hash'], data['info']['name'], 'stopped')        
 
+        # info hash -> engine of a running download, stopped when it is paused
+        self.engines : Dict[str, DownloadEngine] = {}
+        self.engines_lock = Lock()
+        # downloads queued before a restart continue
+        self.downloads = DownloadManager(DOWNLOAD_QUEUE_FILE, self.run_download, self.stop_download,
+                                         max_active_downloads)
+        self.downloads.start()
+        # started by the first call to stream
+        self.stream_server : StreamServer | None = None
+        self.stream_lock = Lock()
+
 
     def announce(self, info_hash : str, name : str, event : str) -> None | List[dict[str, str]]:
         
@@ -110,35 +199,54 @@ class Peer:
             return self.peers 
                
         
-    def create_torrent_file(self,file_path : str) -> str: 
+    def create_torrent_file(self, file_path : str, seed_in_place : bool = SEED_IN_PLACE,
+                            piece_length : int | None = None, merkle : bool = False,
+                            algorithm : str = HASH_ALGORITHM) -> str: 
         """
+        Hashes a file into a torrent file.
+
+        Args:
+            file_path (str): path of the shared file.
+            seed_in_place (bool): serve the pieces straight from the file instead
+                of copying every piece into a directory named after the info hash.
+            piece_length (int | None): size of a piece in bytes, chosen from the
+                size of the file by choose_piece_length if None.
+            merkle (bool): hash the pieces into Merkle trees of blocks, peers then
+                verify every block as it arrives, see PieceHasher.
+            algorithm (str): hash algorithm of the pieces and the file, the info hash
+                is always SHA-256 so every peer and the tracker can compute it.
 
         Returns:
             str: file path of the torrent file 
+
+        Raises:
+            ValueError: the piece length is out of bounds or the hash algorithm is not available.
         """
-        chunk_size = BUFSIZE // 2
+        if piece_length is not None and not 0 < piece_length <= MAX_PIECE_LENGTH:
+            raise ValueError(f'piece length must be between 1 and {MAX_PIECE_LENGTH}, got {piece_length}')
+        chunk_size = piece_length or choose_piece_length(os.path.getsize(file_path))
+        if merkle and chunk_size > MERKLE_BLOCK_LENGTH and chunk_size % MERKLE_BLOCK_LENGTH:
+            raise ValueError(f'piece length of a Merkle torrent must be a multiple of {MERKLE_BLOCK_LENGTH}')
+        if merkle:
+            hasher = PieceHasher(min(chunk_size, MERKLE_BLOCK_LENGTH), chunk_size, algorithm)
+        else:
+            hasher = PieceHasher(algorithm=algorithm)
+        # raises the ValueError of an algorithm that is not available before the file is read
+        hasher.new()
         path = pathlib.Path(file_path)
-        os.makedirs(path.stem, exist_ok=True)
+        if not seed_in_place:
+            os.makedirs(path.stem, exist_ok=True)
 
-        
+        stamp = file_stamp(file_path)
 
-        parts = {}
-        part_order = 0
-        with open(file_path, 'rb') as file:
-            file_hash = hashlib.sha256()
-            while True:
-                chunk = file.read(chunk_size)
-                if not chunk:
-                    break
-                file_hash.update(chunk)
+        def write_chunk(index : int, chunk : bytes, chunk_hash : str) -> None:
+            chunk_file_path = os.path.join(path.stem, f"{chunk_hash}.bin")
+            with open(chunk_file_path, 'wb') as chunk_file:
+                chunk_file.write(chunk)
 
-                chunk_hash = hashlib.sha256(chunk).hexdigest()
-                chunk_file_path = os.path.join(path.stem, f"{chunk_hash}.bin")
-                with open(chunk_file_path, 'wb') as chunk_file:
-                    chunk_file.write(chunk)
-
-                parts[part_order] = chunk_hash
-                part_order += 1
+        # pieces are hashed on all cores while the file is read
+        parts, file_hash = hash_file(file_path, chunk_size, on_piece=None if seed_in_place else write_chunk,
+                                     hasher=hasher)
             
         info = {
                 'length' : os.path.getsize(file_path),
@@ -146,9 +254,14 @@ class Peer:
                 'name' : path.name,
                 'piece length' : chunk_size,   
                 'pieces' : parts,
-                'file_hash' : file_hash.hexdigest(), 
+                'file_hash' : file_hash, 
                 
             }
+        if algorithm != DEFAULT_ALGORITHM:
+            info['hash algorithm'] = algorithm
+        if merkle:
+            info.update({'meta version' : MERKLE_VERSION, 'block length' : hasher.block_length,
+                         'pieces root' : hasher.root(parts)})
         info_hash = hashlib.sha256(bytes(json.dumps(info), 'utf-8')).hexdigest()
         torrent_dict = {
             'announce' : self.tracker,
@@ -157,16 +270,16 @@ class Peer:
             
         }
         
-        if os.path.exists(info_hash): 
-            shutil.rmtree(info_hash)
-        os.rename(path.stem, info_hash)
-        
+        if seed_in_place:
+            # the file is rehashed if its size or modification time differ from the stamp
+            torrent_dict['storage'] = {
+                'mode' : 'file', 'path' : str(path.resolve()), 'complete' : True, 'stamp' : stamp}
+        else:
+            if os.path.exists(info_hash): 
+                shutil.rmtree(info_hash)
+            os.rename(path.stem, info_hash)
         
-        torrent_path = os.path.join(TORRENT_FILES_DIR, path.stem + '.torrent')
-        with open(torrent_path, 'w') as file:
-            json.dump(torrent_dict, file)
-        
-        return torrent_path
+        return self.catalog.save(torrent_dict)
     
     
     def scrape(self) -> List[Dict[str,Any]]: 
@@ -178,39 +291,144 @@ class Peer:
             return [] 
             
     
+    def enqueue_download(self, info_hash : str, name : str, priority : int = 0, pipe : int | None = None,
+                         sequential : bool = False) -> None:
+        """
+        Queues a torrent for download, it starts once fewer than the maximum
+        number of torrents are downloading and no torrent of a higher
+        priority waits.
+
+        Args:
+            info_hash (str): info hash of the torrent.
+            name (str): name of the torrent.
+            priority (int): higher priorities start first.
+            pipe (int | None): progress of the download is written to it, see download_file.
+            sequential (bool): download the pieces in order, see stream.
+        """
+        self.downloads.add(info_hash, name, priority, pipe, sequential)
+
+
+    def pause_download(self, info_hash : str) -> None:
+        self.downloads.pause(info_hash)
+
+
+    def resume_download(self, info_hash : str) -> None:
+        self.downloads.resume(info_hash)
+
+
+    def run_download(self, job : DownloadJob) -> bool:
+        return self.download_file(job.info_hash, job.name, job.pipe, job.sequential) is not None
+
+
+    def stop_download(self, info_hash : str) -> None:
+        with self.engines_lock:
+            engine = self.engines.get(info_hash)
+        if engine is not None:
+            engine.stop()
+
+
+    def stream(self, info_hash : str, name : str, priority : int = 0) -> str:
+        """
+        Streams a torrent to a local player over HTTP. A torrent that is not
+        complete is queued for a sequential download, the server then serves
+        the pieces as they arrive and moves the download to the part the
+        player reads.
+
+        Args:
+            info_hash (str): info hash of the torrent.
+            name (str): name of the torrent.
+            priority (int): priority of the download, see enqueue_download.
+
+        Returns:
+            str: URL the player opens, it accepts byte ranges.
+        """
+        with self.stream_lock:
+            if self.stream_server is None:
+                self.stream_server = StreamServer((STREAM_HOST, STREAM_PORT), self.stream_source, self.seek)
+                stream_thread = Thread(target=self.stream_server.serve_forever)
+                stream_thread.daemon = True
+                stream_thread.start()
+        torrent = self.catalog.get(info_hash)
+        if torrent is None or not self.server.storage(info_hash).have.complete():
+            self.enqueue_download(info_hash, name, priority, sequential=True)
+        return self.stream_server.url(info_hash)
+
+
+    def stream_source(self, info_hash : str) -> Tuple[Dict[str, Any], ChunkStorage | FileStorage] | None:
+        # the storage is shared with the download, so pieces are served as soon as they are stored
+        torrent = self.catalog.get(info_hash)
+        if torrent is None:
+            return None
+        return torrent['info'], self.server.storage(info_hash)
+
+
+    def seek(self, info_hash : str, index : int) -> None:
+        """
+        Moves the download of a torrent to the pieces from `index` on, a
+        torrent that is not downloading is left alone.
+        """
+        with self.engines_lock:
+            engine = self.engines.get(info_hash)
+        if engine is not None:
+            engine.set_cursor(index)
+
+
+    def set_rate_limits(self, upload : float | None = None, download : float | None = None,
+                        info_hash : str | None = None) -> None:
+        """
+        Limits the bandwidth of the peer, or of one torrent, while it runs.
+
+        Args:
+            upload (float | None): bytes per second uploaded at most, None for no limit.
+            download (float | None): bytes per second downloaded at most, None for no limit.
+            info_hash (str | None): the torrent limited, every transfer if None.
+        """
+        self.limits.set_limits(upload, download, info_hash)
+
+
+    def download_rates(self) -> Dict[str, float]:
+        """
+        Returns:
+            Dict[str, float]: peer id of every peer with an open session -> bytes per
+            second we download from it, the server reciprocates with them.
+        """
+        return {session.remote_id : session.stats.rate() or 0.0
+                for session in self.pool.connections().values() if session.remote_id is not None}
+
+
+    def peer_stats(self) -> Dict[str, Dict[str, float | int | None]]:
+        """
+        Returns:
+            Dict[str, Dict[str, float | int | None]]: 'ip:port' of every peer with an
+            open session -> its statistics, see PeerStats.snapshot.
+        """
+        return {f'{ip}:{port}' : session.stats.snapshot() for (ip, port), session in self.pool.connections().items()}
+
+
     def get_torrent_file(self, info_hash : str, peers : List[Address]) -> Dict[str, Any] | None:
-        # connect to peers 
-        self.not_active = []
+        # peers that fail back off in the pool and are skipped by the download
         for address in peers: 
+            key = (address.ip, address.port)
+            try:
+                session = self.pool.acquire(key)
+            except ConnectionError as e:
+                print(f"Skipping {address.ip}:{address.port}: {e}")
+                continue
             try: 
-                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.socket.connect((address.ip, address.port))
-                self.socket.setblocking(True)
-                
-                msg = Message('$.torrent', info_hash)
-                self.socket.send(pickle.dumps(msg))
-
-                data = b""
-                while True:
-                    packet = self.socket.recv(BUFSIZE)
-                    if not packet: break
-                    data += packet
-                recv_msg : Message = pickle.loads(data)
-                
-                if recv_msg.msg == '$.torrent': 
-                    if recv_msg.data is not None:
-                        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                        return recv_msg.data
-                
-
+                torrent = session.request_torrent(info_hash, PROBE_TIMEOUT)
+                self.pool.succeeded(key)
+                if torrent is not None:
+                    return torrent
 
             except (socket.error, TimeoutError, Exception) as e: 
                 print(f"Error connecting to {address.ip}:{address.port}: {e}")
-                self.not_active.append(address)
+                self.pool.failed(key)
+            finally:
+                self.pool.release(key)
         print('file wasn not found')
    
 
-    def download_file(self, info_hash : str, name : str, pipe : int | None = None) -> None:
+    def download_file(self, info_hash : str, name : str, pipe : int | None = None, sequential : bool = False) -> None:
         peers = self.announce(info_hash, name, 'started')
         if peers is None:
             print('File does not exist')
@@ -228,190 +446,1196 @@ class Peer:
             if pipe:
                 os.write(pipe, json.dumps({'msg' : 'failed'}).encode())
             return    
+        if not valid_pieces(torrent_file['info']):
+            print('torrent pieces do not match its length')
+            if pipe:
+                os.write(pipe, json.dumps({'msg' : 'failed'}).encode())
+            return
         
-        for address in addresss_list:
-            if address in self.not_active: 
-                addresss_list.remove(address)
-        
-        with open(os.path.join(TORRENT_FILES_DIR, torrent_file['info']['name'].split('.')[0] + '.torrent'), 'w') as file:
-            json.dump(torrent_file, file)
-            
-        
-        os.makedirs(torrent_file['info_hash'],exist_ok=True)
-        parts_missing = list(torrent_file['info']['pieces'].values())
-        for part in os.listdir(torrent_file['info_hash']): 
-            if part in parts_missing:
-                parts_missing.remove(part)
+        download_path = os.path.join('downloads', torrent_file['info']['name'])
+        local_torrent = self.catalog.get(info_hash)
+        if local_torrent is not None and 'storage' in local_torrent:
+            torrent_file['storage'] = local_torrent['storage']
+        elif self.storage_mode == 'file':
+            # written next to its final name until the last piece arrives
+            torrent_file['storage'] = {'mode' : 'file', 'path' : download_path + '.part', 'complete' : False}
+        self.catalog.save(torrent_file)
+        storage = self.storage(torrent_file)
+        if isinstance(storage, FileStorage):
+            storage.preallocate()
         
-        parts_per_peer = self.get_file_parts_availablity(info_hash, addresss_list)
-        total = len(parts_missing)
+        # resumed from the pieces verified before, see open_storage
+        parts_missing = [int(index) for index in torrent_file['info']['pieces'] if int(index) not in storage.have]
         
-        while parts_missing: 
+        # the pooled session of every peer carries every request of this download
+        sessions : Dict[Tuple[str, int], PeerSession] = {}
+        for address in addresss_list:
+            try:
+                sessions[(address.ip, address.port)] = self.pool.acquire((address.ip, address.port))
+            except ConnectionError as e:
+                print(f"Skipping {address.ip}:{address.port}: {e}")
+        try:
+            engine = self.download_parts(torrent_file, parts_missing, storage, sessions, pipe, sequential)
+        finally:
+            for key in sessions:
+                self.pool.release(key)
+            storage.flush()
+        if engine.error is not None:
+            print(f'download of {name} failed: {engine.error}')
             if pipe:
-                os.write(pipe, json.dumps({'msg' : 'update', 'number' : 100 - int((len(parts_missing) / total) * 100)}).encode())
-            if all(element == [] for element in list(parts_per_peer.values())):
-                print('peers miss a part, file is not downloadable')
-                if pipe:
-                    os.write(pipe, json.dumps({'msg' : 'failed'}).encode())
-                return 
-          
-            for address in addresss_list:
-                parts_hash = parts_per_peer.get((address.ip, address.port), None)
-                if parts_hash is not None:
-                    try: 
-                        for part_hash in parts_hash: 
-                            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock: 
-                                sock.connect((address.ip, address.port))
-                                if part_hash in parts_missing:
-                                    msg = Message('$part', FilePart(info_hash=info_hash, part_hash=part_hash))
-                                    sock.send(pickle.dumps(msg))
-                                    data = b""
-                                    while True:
-                                        packet = sock.recv(BUFSIZE)
-                                        if not packet: break
-                                        data += packet
-                                        
-                                    msg = pickle.loads(data).data 
-                                    if part.data:
-                                        if hashlib.sha256(part.data).hexdigest() == part_hash:
-                                            with open(os.path.join(torrent_file['info_hash'], part_hash + '.bin'), 'wb') as file:
-                                                file.write(part.data)
-                                    
-                                            parts_missing.remove(part_hash)    
-                                    parts_hash.remove(part_hash)
-
-                    except socket.error as e: 
-                        print(f"Error connecting to {address.ip}:{address.port}: {e}")    
-        
-        with open(os.path.join('downloads', torrent_file['info']['name']),'wb') as file:
-            for part_hash in torrent_file['info']['pieces'].values():
-                with open(os.path.join(torrent_file['info_hash'], part_hash + '.bin'), 'rb') as part_file:
-                    file.write(part_file.read())
+                os.write(pipe, json.dumps({'msg' : 'failed', 'error' : str(engine.error)}).encode())
+            return
+        if engine.stopped:
+            print(f'download of {name} paused')
+            if pipe:
+                os.write(pipe, json.dumps({'msg' : 'paused'}).encode())
+            return
+        if engine.missing:
+            print('peers miss a part, file is not downloadable')
+            if pipe:
+                os.write(pipe, json.dumps({'msg' : 'failed'}).encode())
+            return
+
+        if isinstance(storage, FileStorage):
+            # only the .part file of this download is moved, a file seeded in place
+            # stays where it was shared from and is the result of the download
+            if storage.path == download_path + '.part':
+                storage.move(download_path)
+                torrent_file['storage'] = {
+                    'mode' : 'file', 'path' : download_path, 'complete' : True, 'stamp' : storage.seal()}
+                self.catalog.save(torrent_file)
+            download_path = storage.path
+        else:
+            with open(download_path,'wb') as file:
+                for part_hash in torrent_file['info']['pieces'].values():
+                    with open(os.path.join(torrent_file['info_hash'], part_hash + '.bin'), 'rb') as part_file:
+                        file.write(part_file.read())
         if pipe:
             os.write(pipe, json.dumps({'msg' : 'success'}).encode())
         
         self.announce(info_hash, name, 'completed')
-        return {'status': 'success'}
-        
+        return {'status': 'success', 'redundant_bytes': engine.redundant_bytes, 'path': download_path}
+
+
+    def storage(self, torrent_file : Dict[str, Any]) -> ChunkStorage | FileStorage:
+        """
+        Returns the storage of a torrent, shared with the server.
+        """
+        with self.server.storages_lock:
+            storage = self.storages.get(torrent_file['info_hash'])
+            if storage is None:
+                storage = open_storage(torrent_file)
+                self.storages[torrent_file['info_hash']] = storage
+            return storage
+
+
+    def recheck(self, force : bool = False, workers : int | None = None) -> Dict[str, Any]:
+        """
+        Verifies the stored pieces of every torrent against their hashes on
+        all cores and rebuilds which pieces the peer has. Torrents whose data
+        did not change since their have state was written are skipped.
+
+        Args:
+            force (bool): verify unchanged torrents as well.
+            workers (int | None): worker processes, the number of cores if None.
+
+        Returns:
+            Dict[str, Any]: torrents checked and skipped, pieces that failed,
+            bytes checked and the throughput in MB/s.
+        """
+        checked : List[Tuple[Dict[str, Any], ChunkStorage | FileStorage]] = []
+        skipped = 0
+        for torrent in self.catalog.values():
+            try:
+                PieceHasher.from_info(torrent['info'])
+            except ValueError as e:
+                print(f"skipping {torrent['info']['name']}: {e}")
+                skipped += 1
+                continue
+            storage = self.storage(torrent)
+            if not force and storage.unchanged():
+                skipped += 1
+            else:
+                checked.append((torrent, storage))
+
+        def pieces():
+            for torrent, storage in checked:
+                info = torrent['info']
+                hasher = PieceHasher.from_info(info)
+                for index, part_hash in info['pieces'].items():
+                    index = int(index)
+                    file_range = storage.piece_range(index, piece_size(info, index))
+                    yield (torrent['info_hash'], index), file_range, part_hash, hasher
+
+        last_report = 0.0
+        def on_progress(done : int, total : int, elapsed : float) -> None:
+            nonlocal last_report
+            if done == total or elapsed - last_report >= 1:
+                last_report = elapsed
+                print(f'recheck: {done / total:.0%} of {total / 1e6:.0f} MB, {done / max(elapsed, 1e-9) / 1e6:.0f} MB/s')
+
+        total = sum(torrent['info']['length'] for torrent, _ in checked)
+        start = monotonic()
+        results = verify_pieces(pieces(), total, workers, on_progress) if checked else {}
+        elapsed = monotonic() - start
+
+        failed = 0
+        for torrent, storage in checked:
+            info_hash = torrent['info_hash']
+            count = len(torrent['info']['pieces'])
+            have = Bitfield.from_indices(count, (index for index in range(count) if results.get((info_hash, index))))
+            failed += count - have.count()
+            storage.reset(have)
+            self.server.pieces.discard(info_hash)
+            if isinstance(storage, FileStorage) and storage.stamped and have.complete():
+                # a complete file is trusted until it changes again
+                torrent['storage']['stamp'] = storage.stamp
+                self.catalog.save(torrent)
+
+        summary = {
+            'checked' : len(checked), 'skipped' : skipped, 'failed_pieces' : failed,
+            'bytes' : total, 'mb_per_second' : round(total / max(elapsed, 1e-9) / 1e6, 1)
+        }
+        print(f'recheck: {summary}')
+        return summary
+
+
+    def download_parts(self, torrent_file : Dict[str, Any], parts_missing : List[int],
+                       storage : ChunkStorage | FileStorage,
+                       sessions : Dict[Tuple[str, int], 'PeerSession'], pipe : int | None = None,
+                       sequential : bool = False) -> DownloadEngine:
+        """
+        Downloads the missing parts of a torrent over the given peer sessions,
+        in order if `sequential`.
+
+        Returns:
+            DownloadEngine: the finished engine, its `missing` pieces are empty
+            if every part was downloaded.
+        """
+        info_hash = torrent_file['info_hash']
+        info = torrent_file['info']
+        pieces = {int(index) : part_hash for index, part_hash in info['pieces'].items()}
+
+        last_update = -1
+        def on_progress(downloaded : int, total : int) -> None:
+            nonlocal last_update
+            number = 100 - int(((total - downloaded) / total) * 100)
+            if pipe and number != last_update:
+                os.write(pipe, json.dumps({'msg' : 'update', 'number' : number}).encode())
+            last_update = number
+
+        engine = DownloadEngine(
+            pieces=pieces,
+            missing=parts_missing,
+            availability={},
+            fetch=lambda peer, index, begin, length: sessions[peer].request_part(
+                info_hash, index, pieces[index], begin, length, REQUEST_TIMEOUT),
+            store=lambda index, data: self.server.store(info_hash, storage, index, data),
+            piece_size=lambda index: piece_size(info, index),
+            max_in_flight=self.max_in_flight,
+            max_in_flight_per_peer=self.max_in_flight_per_peer,
+            on_progress=on_progress,
+            cancel=lambda peer, index, begin, on_discard: sessions[peer].cancel_part(
+                info_hash, index, begin, on_discard),
+            hasher=PieceHasher.from_info(info),
+            fetch_hashes=lambda peer, index: sessions[peer].request_hashes(info_hash, index, REQUEST_TIMEOUT),
+            pending_peers=len(sessions),
+            stats=lambda peer: sessions[peer].stats,
+            sequential=sequential
+        )
+        with self.engines_lock:
+            self.engines[info_hash] = engine
+        # a download paused while it was looking for its peers stops right away
+        if self.downloads.paused(info_hash):
+            engine.stop()
+        # the download starts with the first peer that answers
+        self.probe_availability(info_hash, pieces, sessions, engine.add_peer)
+        try:
+            engine.run()
+        finally:
+            with self.engines_lock:
+                self.engines.pop(info_hash, None)
+        if engine.redundant_requests:
+            print(f'endgame: {engine.redundant_requests} redundant requests, '
+                  f'{engine.redundant_bytes} bytes of redundant traffic')
+        return engine
         
-    def get_file_parts_availablity(self, info_hash : str, peers : List[Address]) -> Dict[Tuple[str, int], List[str]]:
         
-        parts_per_peer = {}
-        for address in peers:
+    def probe_availability(self, info_hash : str, pieces : Dict[int, str],
+                           sessions : Dict[Tuple[str, int], 'PeerSession'],
+                           on_answer : Callable[[Tuple[str, int], List[int] | None], None]) -> None:
+        """
+        Asks every peer for the pieces it holds at once, a peer that does not
+        connect within CONNECT_TIMEOUT or answer within PROBE_TIMEOUT is given up.
+
+        Args:
+            info_hash (str): info hash of the torrent.
+            pieces (Dict[int, str]): piece index -> hex digest.
+            sessions (Dict[Tuple[str, int], PeerSession]): session of every peer.
+            on_answer (Callable[[Tuple[str, int], List[int] | None], None]): called from
+                the probing threads with every peer and the indices of its pieces as the
+                answers arrive, None for the peers that failed.
+        """
+        def probe(key : Tuple[str, int], session : PeerSession) -> None:
             try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                    sock.connect((address.ip, address.port))
-                    msg = Message('$parts_available', info_hash)
-                    sock.send(pickle.dumps(msg))
-                
-                    data = b""
-                    while True:
-                        packet = sock.recv(BUFSIZE)
-                        if not packet: break
-                        data += packet
-                    data = pickle.loads(data)
-                parts_per_peer[(address.ip, address.port)] = data
-
-            except socket.error as e: 
-                print(f"Error connecting to {address.ip}:{address.port}: {e}")
-        return parts_per_peer
+                indices = session.request_parts_available(info_hash, pieces, PROBE_TIMEOUT)
+                self.pool.succeeded(key)
+            except Exception as e:
+                # every peer has to be answered for, or the download waits for it forever
+                print(f"Error connecting to {session.address.ip}:{session.address.port}: {e}")
+                self.pool.failed(key)
+                indices = None
+            on_answer(key, indices)
+
+        for key, session in sessions.items():
+            prober = Thread(target=probe, args=(key, session))
+            prober.daemon = True
+            prober.start()
         
             
-    @staticmethod
-    def torrent_file_exists(info_hash : str) -> Dict[str, Any] | None:
-        for filename in os.listdir(TORRENT_FILES_DIR):
-            # open file and read its contents 
-            file_path = os.path.join(TORRENT_FILES_DIR, filename)
-            with open(file_path, 'r') as file:
-                data = json.load(file)
-            
-            if data['info_hash'] == info_hash:
-                return data
-        return None             
-
-
-    @staticmethod
-    def file_part_exists(file_part : FilePart) -> FilePart | None:
-        part_path = os.path.join(file_part.info_hash, file_part.part_hash + '.bin')
-        if os.path.exists(part_path):
-            with open(part_path, 'rb') as file:
-                file_part.data = file.read()
-            return file_part
-        return None
+class MessageUnpickler(pickle.Unpickler):
+    """
+    Unpickler for the pickled messages of old peers and the session handshake,
+    only `Message` and `FilePart` objects can be loaded.
+    """
+    def find_class(self, module : str, name : str) -> Any:
+        if module in ('peer', '__main__') and name in ('Message', 'FilePart'):
+            return globals()[name]
+        raise pickle.UnpicklingError(f'{module}.{name} is not allowed')
+
+
+def load_message(data : bytes) -> Any:
+    return MessageUnpickler(io.BytesIO(data)).load()
+
+
+class PeerSession:
+    """
+    Long lived connection to a peer that carries many requests.
+
+    The session opens with a pickled `$session` handshake carrying the protocol
+    version, old peers unpickle it without errors and simply close the
+    connection. Once both sides agreed on a version they exchange binary frames
+    (see utils.wire_protocol), every request has an id so several of them can be
+    outstanding at once. Peers that do not support sessions are served with one
+    pickled request per connection like before.
+    """
+    def __init__(self, address : Address, peer_id : str, limits : BandwidthLimits | None = None) -> None:
+        self.address = address
+        self.peer_id = peer_id
+        # download limits the pieces received are read within
+        self.limits = limits or BandwidthLimits()
+        # None until the first connection tells whether the peer supports sessions
+        self.persistent : bool | None = None
+        self.version = 0
+        # peer id the peer sent in the session handshake
+        self.remote_id : str | None = None
+        self.socket : socket.socket | None = None
+        # request id -> (future, buffer the reply data is read into, block requested)
+        self.pending : Dict[int, Tuple[Future, memoryview | None, Tuple[str, int, int] | None]] = {}
+        # request id of a cancelled request -> called with the size of its late reply
+        self.cancelled : Dict[int, Callable[[int], None]] = {}
+        self.next_id = 0
+        # piece hash -> whole piece an old peer sends, fetched once for all its blocks
+        self.legacy_pieces : Dict[str, Future] = {}
+        # piece hash -> bytes of it handed out, the piece is dropped once all were
+        self.legacy_served : Dict[str, int] = {}
+        # bandwidth, round trip time and failures of the block requests to the peer
+        self.stats = PeerStats()
+        self.lock = Lock()
+
+
+    def connect(self) -> None:
+        sock = socket.create_connection((self.address.ip, self.address.port), timeout=CONNECT_TIMEOUT)
+        hello = {'peer_id' : self.peer_id, 'version' : wire_protocol.PROTOCOL_VERSION}
+        rfile = sock.makefile('rb', buffering=0)
+        try:
+            sock.sendall(pickle.dumps(Message('$session', hello)))
+            reply : Message = MessageUnpickler(rfile).load()
+            version = reply.data['version']
+            self.remote_id = reply.data.get('peer_id')
+        except (EOFError, pickle.UnpicklingError, AttributeError, TypeError, KeyError):
+            # the peer answered the way old peers answer unknown messages
+            version = 0
+        except OSError:
+            # a peer that does not finish the handshake in time
+            rfile.close()
+            sock.close()
+            raise
+        rfile.close()
+        if version < 1:
+            sock.close()
+            self.persistent = False
+            return
+
+        # replies are waited for by the requests, each with its own deadline
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.persistent = True
+        self.version = version
+        self.socket = sock
+        reader = Thread(target=self.read_replies, args=(sock,))
+        reader.daemon = True
+        reader.start()
+
+
+    def healthy(self) -> bool:
+        """
+        Returns:
+            bool: False once the connection of a session broke, a pool replaces
+            the session then.
+        """
+        # read without the lock, which a session that is connecting holds for up to CONNECT_TIMEOUT
+        return self.persistent is not True or self.socket is not None
+
+
+    def ensure_connected(self) -> bool:
+        """
+        Returns:
+            bool: True if the peer supports sessions and the session is open.
+        """
+        with self.lock:
+            if self.socket is None and self.persistent is not False:
+                self.connect()
+            return bool(self.persistent)
+
+
+    def request(self, msg_type : int, payload : bytes, buffer : memoryview | None = None,
+                part : Tuple[str, int, int] | None = None, timeout : float | None = None) -> Tuple[int, Any]:
+        """
+        Sends a request frame and waits for its reply.
+
+        Args:
+            msg_type (int): message type of the request.
+            payload (bytes): payload of the request.
+            buffer (memoryview | None): buffer the data of a PART reply is read into.
+            part (Tuple[str, int, int] | None): info hash, piece index and offset of
+                the block a PART request asks for, used to cancel it.
+            timeout (float | None): seconds to wait for the reply, forever if None.
+
+        Returns:
+            Tuple[int, Any]: message type and payload of the reply.
+
+        Raises:
+            TimeoutError: the reply did not arrive in time, a PART request is
+                cancelled and its reply thrown away if it arrives later.
+        """
+        future : Future = Future()
+        with self.lock:
+            if self.socket is None:
+                self.connect()
+            if self.socket is None:
+                raise ConnectionError('peer does not support sessions')
+            self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+            request_id = self.next_id
+            self.pending[request_id] = (future, buffer, part)
+            try:
+                self.socket.sendall(wire_protocol.pack_frame(msg_type, request_id, payload))
+            except socket.error:
+                self.disconnect(self.socket)
+                raise
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            with self.lock:
+                if self.pending.pop(request_id, None) is not None and part is not None and self.socket is not None:
+                    # the peer stops sending the block if it did not start yet
+                    self.cancelled[request_id] = lambda size: None
+                    try:
+                        self.socket.sendall(wire_protocol.pack_frame(wire_protocol.CANCEL, request_id))
+                    except socket.error:
+                        pass
+            raise TimeoutError(f'no reply within {timeout}s') from None
+
+
+    def request_torrent(self, info_hash : str, timeout : float | None = None) -> Dict[str, Any] | None:
+        if not self.ensure_connected():
+            return self.request_once(Message('$.torrent', info_hash), timeout).data
+        msg_type, payload = self.request(wire_protocol.TORRENT, bytes.fromhex(info_hash), timeout=timeout)
+        if msg_type != wire_protocol.TORRENT:
+            return None
+        return json.loads(payload)
+
+
+    def request_parts_available(self, info_hash : str, pieces : Dict[int, str],
+                                timeout : float | None = None) -> List[int]:
+        if not self.ensure_connected():
+            parts_hash = set(self.request_once(Message('$parts_available', info_hash), timeout).data or [])
+            return [index for index, part_hash in pieces.items() if part_hash in parts_hash]
+        msg_type, payload = self.request(wire_protocol.PARTS_AVAILABLE, bytes.fromhex(info_hash), timeout=timeout)
+        if msg_type != wire_protocol.PARTS_AVAILABLE:
+            return []
+        return list(Bitfield(len(pieces), payload))
+
+
+    def request_part(self, info_hash : str, index : int, part_hash : str,
+                     begin : int, length : int, timeout : float | None = None) -> bytearray | bytes | None:
+        """
+        Requests the block of a piece at an offset with a size.
+
+        Old peers only send whole pieces, a piece is fetched once by the
+        first request for one of its blocks and the blocks are cut from it,
+        see request_legacy_block.
 
+        Raises:
+            PeerChoked: the peer does not upload to us right now.
+            TimeoutError: the block did not arrive within `timeout` seconds.
+        """
+        if not self.ensure_connected():
+            return self.request_legacy_block(info_hash, part_hash, begin, length, timeout)
+
+        data = bytearray(length)
+        payload = wire_protocol.pack_part_request(info_hash, index, begin, length)
+        msg_type, _ = self.request(wire_protocol.PART, payload, memoryview(data), (info_hash, index, begin), timeout)
+        if msg_type == wire_protocol.CHOKED:
+            raise PeerChoked(f'{self.address.ip}:{self.address.port} choked us')
+        if msg_type != wire_protocol.PART:
+            return None
+        return data
+
+
+    def request_legacy_block(self, info_hash : str, part_hash : str, begin : int, length : int,
+                             timeout : float | None = None) -> bytes | None:
+        """
+        Cuts a block from a whole piece of an old peer. Concurrent requests
+        for blocks of one piece share a single `$part` request, the piece is
+        kept until all its bytes were handed out, at most LEGACY_PIECES pieces
+        are kept.
+
+        Raises:
+            TimeoutError: the piece did not arrive within `timeout` seconds.
+        """
+        with self.lock:
+            fetch = self.legacy_pieces.get(part_hash)
+            first = fetch is None
+            if first:
+                fetch = self.legacy_pieces[part_hash] = Future()
+                self.legacy_served[part_hash] = 0
+                # pieces whose blocks went to other peers are never handed out in full
+                others = [other for other in self.legacy_pieces if other != part_hash]
+                for stale in others[:max(0, len(others) - LEGACY_PIECES + 1)]:
+                    self.forget_legacy_piece(stale, self.legacy_pieces[stale])
+
+        if first:
+            try:
+                part : FilePart | None = self.request_once(
+                    Message('$part', FilePart(info_hash=info_hash, part_hash=part_hash)), timeout).data
+            except Exception as e:
+                with self.lock:
+                    self.forget_legacy_piece(part_hash, fetch)
+                fetch.set_exception(e)
+                raise
+            fetch.set_result(None if part is None else part.data)
+        try:
+            piece = fetch.result(timeout)
+        except FutureTimeoutError:
+            raise TimeoutError(f'no piece from {self.address.ip}:{self.address.port} within {timeout} s') from None
 
-    @staticmethod
-    def file_parts_available(info_hash : str) -> List[str]:
-        hashes = []
-        if os.path.exists(info_hash): 
-            for filepart in os.listdir(info_hash):
-                hash = filepart.split('.')[0]
-                hashes.append(hash)
-        return hashes
+        with self.lock:
+            if piece is None:
+                self.forget_legacy_piece(part_hash, fetch)
+                return None
+            if self.legacy_pieces.get(part_hash) is fetch:
+                self.legacy_served[part_hash] += length
+                if self.legacy_served[part_hash] >= len(piece):
+                    self.forget_legacy_piece(part_hash, fetch)
+        return piece[begin:begin + length]
+
+
+    def forget_legacy_piece(self, part_hash : str, fetch : Future) -> None:
+        # called with the lock held, a newer fetch of the same piece stays
+        if self.legacy_pieces.get(part_hash) is fetch:
+            del self.legacy_pieces[part_hash]
+            del self.legacy_served[part_hash]
+
+
+    def request_hashes(self, info_hash : str, index : int, timeout : float | None = None) -> List[bytes] | None:
+        """
+        Requests the block hashes of a piece of a Merkle torrent.
+
+        Returns:
+            List[bytes] | None: digest of every block of the piece, None if
+            the peer does not have the piece or cannot send its block hashes.
+        """
+        if not self.ensure_connected():
+            return None
+        payload = wire_protocol.pack_part_request(info_hash, index, 0, 0)
+        msg_type, hashes = self.request(wire_protocol.HASHES, payload, timeout=timeout)
+        if msg_type != wire_protocol.HASHES or len(hashes) % 32:
+            return None
+        return [bytes(hashes[i:i + 32]) for i in range(0, len(hashes), 32)]
+
+
+    def cancel_part(self, info_hash : str, index : int, begin : int,
+                    on_discard : Callable[[int], None] | None = None) -> None:
+        """
+        Cancels the outstanding requests of a block, their callers get a CancelledError.
+
+        Args:
+            info_hash (str): info hash of the torrent.
+            index (int): index of the piece.
+            begin (int): offset of the block in the piece.
+            on_discard (Callable[[int], None] | None): called with the size of a reply
+                that was already on its way and is thrown away.
+        """
+        with self.lock:
+            for request_id, (future, _, part) in list(self.pending.items()):
+                if part != (info_hash, index, begin):
+                    continue
+                del self.pending[request_id]
+                future.set_exception(CancelledError())
+                if self.socket is None:
+                    continue
+                self.cancelled[request_id] = on_discard or (lambda size: None)
+                try:
+                    self.socket.sendall(wire_protocol.pack_frame(wire_protocol.CANCEL, request_id))
+                except socket.error:
+                    pass
+
+
+    def request_once(self, msg : Message, timeout : float | None = None) -> Message:
+        with socket.create_connection((self.address.ip, self.address.port), timeout=CONNECT_TIMEOUT) as sock:
+            sock.settimeout(timeout)
+            sock.sendall(pickle.dumps(msg))
+
+            chunks = []
+            while True:
+                packet = sock.recv(BUFSIZE)
+                if not packet: break
+                chunks.append(packet)
+        if not chunks:
+            raise ConnectionError('connection closed without a reply')
+        reply = load_message(b"".join(chunks))
+        # old peers answer $parts_available with the bare list
+        if not isinstance(reply, Message):
+            reply = Message(msg.msg, reply)
+        return reply
+
+
+    def read_replies(self, sock : socket.socket) -> None:
+        future = None
+        try:
+            while True:
+                msg_type, request_id, length = wire_protocol.read_header(sock)
+                with self.lock:
+                    future, buffer, part = self.pending.pop(request_id, (None, None, None))
+                    on_discard = self.cancelled.pop(request_id, None)
+                if length > wire_protocol.MAX_REPLY_SIZE:
+                    raise ConnectionError(f'reply of {length} bytes is too large')
+
+                if msg_type == wire_protocol.PART and buffer is not None:
+                    # the block is read straight into the buffer of the request
+                    _, begin = wire_protocol.PART_REPLY.unpack(
+                        wire_protocol.recv_exact(sock, wire_protocol.PART_REPLY.size))
+                    size = length - wire_protocol.PART_REPLY.size
+                    offset = begin - part[2]
+                    if offset < 0 or offset + size > len(buffer):
+                        raise ConnectionError('part reply does not fit the request')
+                    # a throttled reader leaves the data in the socket, TCP slows the peer down
+                    rate_limit.throttle(self.limits.buckets('download', part[0]), size)
+                    wire_protocol.recv_into_exact(sock, buffer[offset:offset + size])
+                    if offset or size != len(buffer):
+                        # a block is sent whole, a shorter one would leave zeros in the buffer
+                        if future is not None:
+                            future.set_exception(ConnectionError(f'short part reply of {size} of {len(buffer)} bytes'))
+                            future = None
+                        continue
+                    payload = buffer
+                else:
+                    payload = wire_protocol.recv_exact(sock, length)
+
+                if future is not None:
+                    future.set_result((msg_type, payload))
+                    future = None
+                elif on_discard is not None and msg_type == wire_protocol.PART:
+                    on_discard(length)
+        except (OSError, struct.error) as e:
+            # the reply that was being read when the connection broke
+            if future is not None:
+                future.set_exception(ConnectionError(f'peer session closed: {e}'))
+        with self.lock:
+            self.disconnect(sock)
+
+
+    def disconnect(self, sock : socket.socket) -> None:
+        # fails the requests still waiting so they can be retried
+        if self.socket is sock:
+            self.socket = None
+            for future, _, _ in self.pending.values():
+                future.set_exception(ConnectionError('peer session closed'))
+            self.pending.clear()
+            self.cancelled.clear()
+        sock.close()
+
+
+    def close(self) -> None:
+        with self.lock:
+            if self.socket is not None:
+                try:
+                    self.socket.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+                self.disconnect(self.socket)
+
+
+class PeerConnection:
+    """
+    State of a connection served by PeerServer.
+
+    A connection starts in the HANDSHAKE state and reads one pickled message,
+    either a request of an old peer, answered before the connection is
+    closed, or the `$session` handshake. Sessions read request frames until
+    the peer disconnects or stays idle.
+
+    A request is only answered once the reply to the previous one was sent,
+    so replies never pile up for a slow peer and a CANCEL can still drop the
+    requests queued behind the reply being sent.
+
+    Piece requests of sessions of version 2 and newer are refused with a
+    CHOKED reply while the peer is choked, see Choker.
+    """
+    HANDSHAKE = 0
+    SESSION = 1
+    # the last reply is being sent, the connection is closed after it
+    CLOSING = 2
+
+    def __init__(self, sock : socket.socket) -> None:
+        self.sock = sock
+        self.state = PeerConnection.HANDSHAKE
+        self.inbox = bytearray()
+        # request frames that were not answered yet
+        self.requests : deque[Tuple[int, int, bytes]] = deque()
+        # reply buffers that were not sent yet, file ranges are sent with sendfile
+        self.outbox : deque[memoryview | FileRange] = deque()
+        self.events = selectors.EVENT_READ
+        self.last_active = monotonic()
+        # protocol version and peer id agreed on in the session handshake
+        self.version = 0
+        self.peer_id : str | None = None
+        # upload limits of the reply being sent
+        self.upload : List[TokenBucket] = []
 
 
 class PeerServer(socket.socket):
-    def __init__(self, port : int, peer_id : str) -> None:
+    def __init__(self, port : int, peer_id : str,
+                 storages : Dict[str, ChunkStorage | FileStorage] | None = None,
+                 catalog : TorrentCatalog | None = None,
+                 piece_cache_bytes : int = PIECE_CACHE_BYTES,
+                 upload_slots : int | None = UPLOAD_SLOTS,
+                 download_rates : Callable[[], Dict[str, float]] | None = None,
+                 limits : BandwidthLimits | None = None) -> None:
         super().__init__(socket.AF_INET, socket.SOCK_STREAM)
         self.bind((HOST_IP, port))
-        self.listen(5)
-        self.setblocking
+        self.listen(socket.SOMAXCONN)
+        self.setblocking(False)
         self.peer_id = peer_id
-        self.CONNECTION_LIST = [self,]
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self, selectors.EVENT_READ)
+        self.connections : Dict[socket.socket, PeerConnection] = {}
+        self.catalog = catalog if catalog is not None else TorrentCatalog(TORRENT_FILES_DIR)
+        # info hash -> storage, shared with the downloads of the peer
+        self.storages = storages if storages is not None else {}
+        self.storages_lock = Lock()
+        # info hashes of seeded files that changed and are being rehashed, their
+        # pieces are not served until it finished
+        self.rehashing : Set[str] = set()
+        # open files piece replies are sent from
+        self.files = FileCache()
+        # pieces and block hashes in demand, served without reading the disk
+        self.pieces = PieceCache(piece_cache_bytes)
+        # peers pieces are uploaded to, rechoked by the download rate we get from them
+        self.choker = Choker(upload_slots, busy=lambda connection: bool(connection.requests or connection.outbox))
+        self.download_rates = download_rates or (lambda: {})
+        self.limits = limits or BandwidthLimits()
+        # connection held back by its upload limit -> when it may send again
+        self.throttled : Dict[PeerConnection, float] = {}
         
     def handle_connections(self) -> None:
         """
+        Serves every peer connection from one thread. The selector only waits
+        for sockets to become writable while they have replies to send, so an
+        idle server does not use any CPU. Connections over their upload limit
+        stop waiting for the socket until their limit lets them send again.
+        """
+        last_sweep = last_rechoke = monotonic()
+        while True: 
+            timeout = IDLE_CHECK_INTERVAL
+            if self.throttled:
+                timeout = max(0.0, min(timeout, min(self.throttled.values()) - monotonic()))
+            for key, events in self.selector.select(timeout=timeout):
+                if key.fileobj is self:
+                    self.accept_connections()
+                    continue
+                connection : PeerConnection = key.data
+                try:
+                    if events & selectors.EVENT_READ:
+                        self.read_connection(connection)
+                    if events & selectors.EVENT_WRITE and connection.sock in self.connections:
+                        self.write_connection(connection)
+                except (OSError, ValueError, struct.error) as e:
+                    self.disconnect(connection.sock)
+                except Exception as e:
+                    # a malformed request, a bad pickle can raise almost anything, only
+                    # costs its own connection
+                    print(f'invalid request: {e!r}')
+                    self.disconnect(connection.sock)
+
+            now = monotonic()
+            for connection, resume_at in list(self.throttled.items()):
+                if resume_at <= now:
+                    del self.throttled[connection]
+                    try:
+                        self.write_connection(connection)
+                    except Exception as e:
+                        if not isinstance(e, OSError):
+                            print(f'cannot answer request: {e!r}')
+                        self.disconnect(connection.sock)
+            if now - last_sweep >= IDLE_CHECK_INTERVAL:
+                last_sweep = now
+                for connection in list(self.connections.values()):
+                    if now - connection.last_active > SESSION_IDLE_TIMEOUT:
+                        self.disconnect(connection.sock)
+            if now - last_rechoke >= RECHOKE_INTERVAL:
+                last_rechoke = now
+                self.rechoke()
+
+
+    def rechoke(self) -> None:
+        rates = self.download_rates()
+        self.choker.rechoke({connection : rates.get(connection.peer_id, 0.0)
+                             for connection in self.connections.values()})
+
+
+    def accept_connections(self) -> None:
+        while True:
+            try:
+                new_socket, address = self.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # out of file descriptors, the connection waits in the backlog
+                print(f'cannot accept connections: {e}')
+                return
+            new_socket.setblocking(False)
+            connection = PeerConnection(new_socket)
+            self.connections[new_socket] = connection
+            self.selector.register(new_socket, selectors.EVENT_READ, connection)
+            print(address, 'has joined')
+
+
+    def read_connection(self, connection : PeerConnection) -> None:
+        try:
+            data = connection.sock.recv(READ_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        if not data:
+            self.disconnect(connection.sock)
+            return
+        connection.last_active = monotonic()
+        if connection.state == PeerConnection.CLOSING:
+            return
+        connection.inbox += data
+
+        if connection.state == PeerConnection.HANDSHAKE:
+            self.read_handshake(connection)
+        if connection.state == PeerConnection.SESSION:
+            self.read_frames(connection)
+        self.answer(connection)
+        self.update_events(connection)
+
+
+    def read_handshake(self, connection : PeerConnection) -> None:
+        stream = io.BytesIO(connection.inbox)
+        try:
+            msg : Message = MessageUnpickler(stream).load()
+        except EOFError:
+            msg = None
+        except pickle.UnpicklingError as e:
+            if 'truncated' not in str(e):
+                raise
+            msg = None
+        if msg is None:
+            # the rest of the message did not arrive yet
+            if len(connection.inbox) > wire_protocol.MAX_REQUEST_SIZE:
+                raise ConnectionError('request too large')
+            return
+        del connection.inbox[:stream.tell()]
+        print(msg)
+
+        if msg.msg == "$session":
+            version = min(msg.data['version'], wire_protocol.PROTOCOL_VERSION)
+            hello = {'peer_id' : self.peer_id, 'version' : version}
+            connection.outbox.append(memoryview(pickle.dumps(Message('$session', hello))))
+            connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection.state = PeerConnection.SESSION
+            connection.version = version
+            connection.peer_id = msg.data.get('peer_id')
+            return
+
+        reply = self.handle_message(msg)
+        if msg.msg == "$parts_available":
+            # old peers expect the bare list
+            reply = reply.data
+        connection.state = PeerConnection.CLOSING
+        if reply is not None:
+            connection.outbox.append(memoryview(pickle.dumps(reply)))
+
+
+    def read_frames(self, connection : PeerConnection) -> None:
+        inbox = connection.inbox
+        while len(inbox) >= wire_protocol.HEADER.size:
+            msg_type, request_id, length = wire_protocol.HEADER.unpack_from(inbox)
+            if length > wire_protocol.MAX_REQUEST_SIZE:
+                raise ConnectionError('request too large')
+            end = wire_protocol.HEADER.size + length
+            if len(inbox) < end:
+                return
+            payload = bytes(inbox[wire_protocol.HEADER.size:end])
+            del inbox[:end]
+
+            if msg_type != wire_protocol.CANCEL:
+                if len(connection.requests) >= MAX_QUEUED_REQUESTS:
+                    raise ConnectionError('too many queued requests')
+                connection.requests.append((msg_type, request_id, payload))
+                continue
+            for request in connection.requests:
+                if request[1] == request_id:
+                    connection.requests.remove(request)
+                    connection.outbox.append(memoryview(wire_protocol.pack_frame(wire_protocol.CANCEL, request_id)))
+                    break
+
+
+    def answer(self, connection : PeerConnection) -> None:
+        # the next request is answered once the previous reply is sent
+        if connection.outbox or not connection.requests:
+            return
+        msg_type, request_id, payload = connection.requests.popleft()
+        # pieces count against the limit of their torrent too
+        info_hash = payload[:32].hex() if msg_type == wire_protocol.PART else None
+        connection.upload = self.limits.buckets('upload', info_hash)
+        if msg_type == wire_protocol.PART and connection.version >= 2 and not self.choker.allow(connection):
+            connection.outbox.append(memoryview(wire_protocol.pack_frame(wire_protocol.CHOKED, request_id)))
+            return
+        for data in self.handle_frame(msg_type, request_id, payload, id(connection)):
+            connection.outbox.append(data if isinstance(data, FileRange) else memoryview(data))
+            if msg_type == wire_protocol.PART:
+                self.choker.sent(connection, data.length if isinstance(data, FileRange) else len(data))
+
+
+    def write_connection(self, connection : PeerConnection) -> None:
+        """
+        Sends replies until the socket buffer is full or the upload limit is
+        reached, partially sent buffers stay at the front of the outbox.
+        """
+        outbox = connection.outbox
+        while outbox:
+            data = outbox[0]
+            size = data.length if isinstance(data, FileRange) else len(data)
+            limit = None
+            if connection.upload:
+                limit = rate_limit.allowance(connection.upload, size)
+                if limit < min(size, rate_limit.MIN_SEND):
+                    wait = rate_limit.delay(connection.upload, min(size, rate_limit.MIN_SEND))
+                    self.throttled[connection] = monotonic() + wait
+                    break
+            if isinstance(data, FileRange):
+                sent = self.files.send(connection.sock, data, limit)
+                data.offset += sent
+                data.length -= sent
+                done = not data.length
+            else:
+                # a header waits for the data behind it instead of going out in its own packet
+                more = len(outbox) > 1
+                try:
+                    sent = connection.sock.send(data if limit is None else data[:limit], getattr(socket, 'MSG_MORE', 0) if more else 0)
+                except (BlockingIOError, InterruptedError):
+                    sent = 0
+                outbox[0] = data = data[sent:]
+                done = not data
+            if connection.upload:
+                rate_limit.consume(connection.upload, sent)
+            if not sent and not done:
+                break
+            connection.last_active = monotonic()
+            if done:
+                outbox.popleft()
+                if not outbox:
+                    self.answer(connection)
+
+        if not outbox and connection.state == PeerConnection.CLOSING:
+            self.disconnect(connection.sock)
+            return
+        self.update_events(connection)
+
+
+    def update_events(self, connection : PeerConnection) -> None:
+        if connection.sock not in self.connections:
+            return
+        events = selectors.EVENT_READ
+        if connection.outbox and connection not in self.throttled:
+            events |= selectors.EVENT_WRITE
+        if connection.state == PeerConnection.CLOSING and connection.outbox:
+            events = selectors.EVENT_WRITE
+        if events != connection.events:
+            connection.events = events
+            self.selector.modify(connection.sock, events, connection)
+
+
+    def handle_message(self, msg : Message) -> Message | None:
+        if msg.msg == "$.torrent": 
+            torrent = self.torrent(msg.data)
+            msg.data = public_torrent(torrent) if torrent is not None else None
+            return msg
         
+        if msg.msg == "$parts_available":
+            torrent = self.torrent(msg.data)
+            if torrent is None:
+                msg.data = []
+                return msg
+            pieces = torrent['info']['pieces']
+            storage = self.storage(msg.data, True)
+            # a changed file has no pieces until it was rehashed
+            msg.data = [] if msg.data in self.rehashing else [pieces[str(index)] for index in storage.available()]
+            return msg
         
+        if msg.msg == "$part": 
+            file_part : FilePart = msg.data
+            torrent = self.torrent(file_part.info_hash)
+            if torrent is None or file_part.info_hash in self.rehashing:
+                msg.data = None
+                return msg
+            indices = [int(index) for index, part_hash in torrent['info']['pieces'].items()
+                       if part_hash == file_part.part_hash]
+            file_part.data = None
+            if indices:
+                file_part.data = self.piece(file_part.info_hash, torrent, indices[0])
+            msg.data = file_part if file_part.data is not None else None
+            return msg
+        return None
+
+
+    def torrent(self, info_hash : str) -> Dict[str, Any] | None:
+        return self.catalog.get(info_hash)
+
+
+    def storage(self, info_hash : str, recheck : bool = False) -> ChunkStorage | FileStorage:
         """
-        while True: 
-            read_sockets, _, _ = select.select(
-                self.CONNECTION_LIST,
-                self.CONNECTION_LIST,
-                self.CONNECTION_LIST
-            )          
+        Returns the storage of a torrent the peer has, downloads in progress
+        share theirs so the pieces they wrote are served right away.
+
+        Args:
+            info_hash (str): info hash of the torrent.
+            recheck (bool): rehash a seeded file if it changed since it was hashed,
+                always done when the storage is opened. The file is rehashed by a
+                thread of its own, see `rehashing`.
+        """
+        with self.storages_lock:
+            storage = self.storages.get(info_hash)
+            if storage is None:
+                storage = open_storage(self.torrent(info_hash))
+                self.storages[info_hash] = storage
+                recheck = True
+            if recheck and isinstance(storage, FileStorage) and info_hash not in self.rehashing and storage.stale():
+                # hashing a big file takes long, the server keeps serving the other torrents
+                self.rehashing.add(info_hash)
+                rehasher = Thread(target=self.rehash, args=(info_hash, storage))
+                rehasher.daemon = True
+                rehasher.start()
+            return storage
+
+
+    def piece(self, info_hash : str, torrent : Dict[str, Any], index : int) -> bytes | None:
+        """
+        Returns:
+            bytes | None: the data of a piece the peer has, read through the piece
+            cache, None if the peer does not have it.
+        """
+        data = self.pieces.get(info_hash, index)
+        return data if data is not None else self.cache_piece(info_hash, torrent, index)
+
+
+    def cache_piece(self, info_hash : str, torrent : Dict[str, Any], index : int) -> bytes | None:
+        data = self.storage(info_hash).read(index, 0, piece_size(torrent['info'], index))
+        if data is not None:
+            self.pieces.put(info_hash, index, data)
+        return data
+
+
+    def store(self, info_hash : str, storage : ChunkStorage | FileStorage, index : int, data : bytes) -> None:
+        """
+        Writes a downloaded piece, a copy of it in the piece cache is dropped first.
+        """
+        self.pieces.discard(info_hash, index)
+        self.pieces.discard(info_hash, ('hashes', index))
+        storage.write(index, data)
+
+
+    def rehash(self, info_hash : str, storage : FileStorage) -> None:
+        torrent = self.catalog.get(info_hash)
+        print(f"{storage.path} changed, rehashing it")
+        pieces = {int(index) : part_hash for index, part_hash in torrent['info']['pieces'].items()}
+        self.files.discard(storage.path)
+        self.pieces.discard(info_hash)
+        try:
+            if storage.rehash(pieces, PieceHasher.from_info(torrent['info'])):
+                # unchanged content, for example a touched file, is trusted again after a restart
+                torrent['storage']['stamp'] = storage.stamp
+                self.catalog.save(torrent)
+            else:
+                print(f"{storage.path} no longer matches its torrent, serving {storage.have.count()} of {len(pieces)} pieces")
+        finally:
+            with self.storages_lock:
+                self.rehashing.discard(info_hash)
+
+
+    def handle_frame(self, msg_type : int, request_id : int, payload : bytes,
+                     requester : Hashable = None) -> List[bytes | FileRange]:
+        """
+        Answers a request frame.
+
+        Args:
+            msg_type (int): message type of the request.
+            request_id (int): id of the request.
+            payload (bytes): payload of the request.
+            requester (Hashable): the connection the request came from, pieces that
+                several connections ask for are cached.
+
+        Returns:
+            List[bytes | FileRange]: the reply frame, possibly split into several
+            buffers, piece data is a range of the file it is sent from.
+        """
+        not_found = [wire_protocol.pack_frame(wire_protocol.NOT_FOUND, request_id)]
         
-            for sock in read_sockets:
-                if sock == self:
-                    new_socket, _ = sock.accept()
-                    self.CONNECTION_LIST.append(new_socket)
-                    print(new_socket.getpeername(), 'has joined')
-                else: 
-                    try: 
-                        msg = sock.recv(BUFSIZE)
-
-                        if msg == b'':
-                            self.disconnect(sock)
-                        else: 
-                            msg : Message = pickle.loads(msg) # type: ignore
-                            print(msg)
-                            
-                            if msg.msg == "$.torrent": 
-                                msg.data = Peer.torrent_file_exists(msg.data)
-                                sock.send(pickle.dumps(msg))
-                            
-                            if msg.msg == "$parts_available":
-                                msg.data = Peer.file_parts_available(msg.data)
-                                sock.send(pickle.dumps(msg.data))
-                            
-                            if msg.msg == "$part": 
-                                msg.data = Peer.file_part_exists(msg.data)
-                                sock.send(pickle.dumps(msg))
-                            self.disconnect(sock)
-                    except socket.error as e:
-                        self.disconnect(sock)    
-                    except EOFError as e:
-                        print(msg)
-                            
+        if msg_type == wire_protocol.TORRENT:
+            torrent = self.torrent(payload.hex())
+            if torrent is None:
+                return not_found
+            return [wire_protocol.pack_frame(msg_type, request_id, json.dumps(public_torrent(torrent)).encode())]
+
+        if msg_type == wire_protocol.PARTS_AVAILABLE:
+            info_hash = payload.hex()
+            torrent = self.torrent(info_hash)
+            if torrent is None:
+                return not_found
+            storage = self.storage(info_hash, True)
+            # a changed file has no pieces until it was rehashed
+            bitfield = Bitfield(len(torrent['info']['pieces'])).to_bytes() if info_hash in self.rehashing else storage.snapshot()
+            return [wire_protocol.pack_frame(msg_type, request_id, bitfield)]
+
+        if msg_type == wire_protocol.PART:
+            info_hash, index, begin, length = wire_protocol.unpack_part_request(payload)
+            torrent = self.torrent(info_hash)
+            if torrent is None or str(index) not in torrent['info']['pieces'] or info_hash in self.rehashing:
+                return not_found
+            header = wire_protocol.HEADER.pack(msg_type, request_id, wire_protocol.PART_REPLY.size + length)
+            data = self.pieces.get(info_hash, index)
+            if data is None and self.pieces.wanted(info_hash, index, requester):
+                data = self.cache_piece(info_hash, torrent, index)
+            if data is not None:
+                if begin + length > len(data):
+                    return not_found
+                return [header + wire_protocol.PART_REPLY.pack(index, begin), memoryview(data)[begin:begin + length]]
+            file_range = self.storage(info_hash).locate(index, begin, length)
+            if file_range is None:
+                return not_found
+            return [header + wire_protocol.PART_REPLY.pack(index, begin), file_range]
+
+        if msg_type == wire_protocol.HASHES:
+            info_hash, index, _, _ = wire_protocol.unpack_part_request(payload)
+            torrent = self.torrent(info_hash)
+            if torrent is None or str(index) not in torrent['info']['pieces'] or info_hash in self.rehashing:
+                return not_found
+            try:
+                hasher = PieceHasher.from_info(torrent['info'])
+            except ValueError:
+                # a torrent of an algorithm this peer cannot hash has no block hashes to send
+                return not_found
+            hashes = self.pieces.get(info_hash, ('hashes', index))
+            if hashes is None:
+                data = self.piece(info_hash, torrent, index) if hasher.merkle else None
+                if data is None:
+                    return not_found
+                hashes = b''.join(hasher.leaves(data))
+                self.pieces.put(info_hash, ('hashes', index), hashes)
+            return [wire_protocol.pack_frame(msg_type, request_id, hashes)]
+        
+        return not_found
                         
                             
     def disconnect(self, sock : socket.socket) -> None:
-        if sock in self.CONNECTION_LIST:
-            self.CONNECTION_LIST.remove(sock)
-        print(sock.getpeername(), 'has disconnected')
+        connection = self.connections.pop(sock, None)
+        if connection is not None:
+            self.selector.unregister(sock)
+            self.choker.remove(connection)
+            self.throttled.pop(connection, None)
+        try:
+            print(sock.getpeername(), 'has disconnected')
+        except socket.error:
+            pass
         sock.close()
 
 
+def open_storage(torrent_file : Dict[str, Any]) -> ChunkStorage | FileStorage:
+    """
+    Opens the storage described by the `storage` entry of a torrent, torrents
+    without one keep their pieces in a directory named after the info hash.
+    """
+    info = torrent_file['info']
+    record = torrent_file.get('storage', {'mode' : 'chunks'})
+    resume = os.path.join(RESUME_DIR, torrent_file['info_hash'])
+    if record['mode'] == 'file':
+        return FileStorage(record['path'], info['length'], info['piece length'],
+                           record.get('complete', False), record.get('stamp'), resume)
+    pieces = {int(index) : part_hash for index, part_hash in info['pieces'].items()}
+    return ChunkStorage(torrent_file['info_hash'], pieces, resume)
+
+
+def choose_piece_length(length : int) -> int:
+    """
+    Returns:
+        int: the smallest power of two piece length that splits a file of
+        `length` bytes into at most MAX_PIECES pieces, within
+        MIN_PIECE_LENGTH and MAX_PIECE_LENGTH.
+    """
+    piece_length = MIN_PIECE_LENGTH
+    while piece_length < MAX_PIECE_LENGTH and piece_length * MAX_PIECES < length:
+        piece_length *= 2
+    return piece_length
+
+
+def valid_pieces(info : Dict[str, Any]) -> bool:
+    """
+    Returns:
+        bool: whether the piece length and the number of pieces of a torrent
+        received from a peer fit its length, its hash algorithm is available,
+        and the piece hashes of a Merkle torrent its pieces root.
+    """
+    try:
+        hasher = PieceHasher.from_info(info)
+        piece_length, length = int(info['piece length']), int(info['length'])
+        if not 0 < piece_length <= MAX_PIECE_LENGTH or length < 0:
+            return False
+        indices = sorted(int(index) for index in info['pieces'])
+        if indices != list(range((length + piece_length - 1) // piece_length)):
+            return False
+        if info.get('meta version') == MERKLE_VERSION:
+            # the piece hashes have to add up to the root of the file
+            block_length = int(info['block length'])
+            if not 0 < block_length <= piece_length or piece_length % block_length:
+                return False
+            return hasher.root(info['pieces']) == info['pieces root']
+    except (KeyError, TypeError, ValueError):
+        return False
+    return True
+
+
+def piece_size(info : Dict[str, Any], index : int) -> int:
+    """
+    Returns:
+        int: size in bytes of a piece, the last piece can be shorter than the piece length.
+    """
+    return min(info['piece length'], info['length'] - index * info['piece length'])
+
+
 def get_id() -> str:
     with open('settings.json', 'r') as file:
         data = json.load(file)
@@ -0,0 +1,204 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import statistics
+import tempfile
+import uuid
+from threading import Thread
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+from utils.catalog import TorrentCatalog
+from utils.choker import UPLOAD_SLOTS
+from utils.download_engine import DownloadEngine
+from utils.hashing import hash_file
+from utils.networking_utils import get_open_port
+from utils.piece_hash import ALGORITHMS, MERKLE_BLOCK_LENGTH, PieceHasher
+from utils.storage import FileStorage, file_stamp
+
+# piece lengths choose_piece_length picks for files of 32 MB, 512 MB, 2 GB and 32 GB
+PIECE_LENGTHS = [1 << 14, 1 << 18, 1 << 20, 1 << 24]
+
+
+def hash_file_serially(path : str, piece_length : int) -> Tuple[Dict[int, str], str]:
+    # the loop create_torrent_file used before hashing was pipelined
+    parts = {}
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while chunk := file.read(piece_length):
+            file_hash.update(chunk)
+            parts[len(parts)] = hashlib.sha256(chunk).hexdigest()
+    return parts, file_hash.hexdigest()
+
+
+def benchmark_torrent_hashing(size_mb : int = 1024, worker_counts : List[int] | None = None,
+                              repeat : int = 3) -> None:
+    """
+    Hashes a file of random data the way create_torrent_file does, in the
+    pieces choose_piece_length picks for its size, serially and with the
+    pipeline for every number of workers, and prints the throughput. The
+    file is read once up front so every run reads it from the page cache.
+    """
+    # peer.py needs the tracker client, like the swarm benchmark this one imports it late
+    from peer import choose_piece_length
+    piece_length = choose_piece_length(size_mb << 20)
+    cores = os.cpu_count() or 1
+    worker_counts = worker_counts or sorted({1, 2, 4, 8, cores} & set(range(1, cores + 1)))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'benchmark.bin')
+        with open(path, 'wb') as file:
+            for _ in range(size_mb):
+                file.write(os.urandom(1 << 20))
+        expected = hash_file_serially(path, piece_length)
+
+        def run(name : str, hasher) -> None:
+            best = float('inf')
+            for _ in range(repeat):
+                start = perf_counter()
+                result = hasher()
+                best = min(best, perf_counter() - start)
+                assert result == expected
+            print(f'{name:>12}: {size_mb / 1024 / best:6.2f} GB/s')
+
+        print(f'hashing {size_mb} MB in pieces of {piece_length} bytes, {cores} cores')
+        run('serial', lambda: hash_file_serially(path, piece_length))
+        for workers in worker_counts:
+            run(f'{workers} workers', lambda: hash_file(path, piece_length, workers))
+
+
+def benchmark_piece_hashes(size_mb : int = 256, piece_lengths : List[int] | None = None,
+                           algorithms : List[str] | None = None, repeat : int = 3) -> None:
+    """
+    Hashes random data in memory piece by piece with every available hash
+    algorithm, flat and as Merkle trees of blocks, on one core, and prints
+    the throughput for every piece length.
+    """
+    piece_lengths = piece_lengths or PIECE_LENGTHS
+    algorithms = algorithms or list(ALGORITHMS)
+    data = memoryview(os.urandom(size_mb << 20))
+    print(f'hashing {size_mb} MB on one core, GB/s')
+    print(f'{"piece length":>14}' + ''.join(f'{f"{name} {kind}":>17}' for name in algorithms for kind in ('flat', 'merkle')))
+    for piece_length in piece_lengths:
+        row = f'{piece_length:>14}'
+        for algorithm in algorithms:
+            for hasher in (PieceHasher(algorithm=algorithm),
+                           PieceHasher(min(piece_length, MERKLE_BLOCK_LENGTH), piece_length, algorithm)):
+                best = float('inf')
+                for _ in range(repeat):
+                    start = perf_counter()
+                    for offset in range(0, len(data), piece_length):
+                        hasher.digest(data[offset:offset + piece_length])
+                    best = min(best, perf_counter() - start)
+                row += f'{size_mb / 1024 / best:17.2f}'
+        print(row)
+
+
+
+def benchmark_swarm(leechers : int = 8, size_mb : int = 64, upload_slots : List[int | None] | None = None,
+                    piece_length : int = 1 << 18) -> None:
+    """
+    Runs a swarm of one seeder and several leechers on loopback for every
+    number of upload slots, None serving every peer at once, and prints the
+    median and the longest completion time of the leechers.
+
+    Every peer runs its own PeerServer, the leechers start at the same time
+    and ask every other peer for pieces. Leechers only learn which pieces
+    the others hold when they start, so the upload of the seeder is what
+    they share.
+    """
+    # peer.py needs the tracker client, only the swarm benchmark imports it
+    from peer import Address, PeerServer, PeerSession, piece_size
+
+    upload_slots = upload_slots or [None, UPLOAD_SLOTS]
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, 'swarm.bin')
+        with open(source, 'wb') as file:
+            for _ in range(size_mb):
+                file.write(os.urandom(1 << 20))
+        pieces, file_hash = hash_file(source, piece_length)
+        info = {'length' : size_mb << 20, 'path' : '', 'name' : 'swarm.bin', 'piece length' : piece_length,
+                'pieces' : pieces, 'file_hash' : file_hash}
+        info_hash = hashlib.sha256(json.dumps(info).encode()).hexdigest()
+
+        def start_peer(name : str, slots : int | None, complete : bool) -> Tuple[PeerServer, FileStorage, Dict]:
+            home = os.path.join(directory, name)
+            os.makedirs(home)
+            path = source if complete else os.path.join(home, 'swarm.bin')
+            storage = FileStorage(path, info['length'], piece_length, complete,
+                                  file_stamp(source) if complete else None, os.path.join(home, 'resume'))
+            if not complete:
+                storage.preallocate()
+            catalog = TorrentCatalog(home)
+            catalog.save({'info' : info, 'info_hash' : info_hash,
+                          'storage' : {'mode' : 'file', 'path' : path, 'complete' : complete}})
+            sessions : Dict[Tuple[str, int], PeerSession] = {}
+            server = PeerServer(get_open_port(), uuid.uuid4().hex, {info_hash : storage}, catalog,
+                                upload_slots=slots,
+                                download_rates=lambda: {session.remote_id : session.stats.rate() or 0.0
+                                                        for session in list(sessions.values())})
+            Thread(target=server.handle_connections, daemon=True).start()
+            return server, storage, sessions
+
+        def leech(server : PeerServer, storage : FileStorage, sessions : Dict, others : List[Tuple[str, int]],
+                  times : List[float], start : float) -> None:
+            sessions.update({key : PeerSession(Address(*key), server.peer_id) for key in others})
+            engine = DownloadEngine(
+                pieces={int(index) : part_hash for index, part_hash in pieces.items()},
+                missing=range(len(pieces)),
+                availability={},
+                fetch=lambda peer, index, begin, length: sessions[peer].request_part(
+                    info_hash, index, pieces[index], begin, length),
+                store=lambda index, data: server.store(info_hash, storage, index, data),
+                piece_size=lambda index: piece_size(info, index),
+                cancel=lambda peer, index, begin, on_discard: sessions[peer].cancel_part(
+                    info_hash, index, begin, on_discard),
+                pending_peers=len(sessions),
+                stats=lambda peer: sessions[peer].stats
+            )
+            for key, session in sessions.items():
+                def probe(key=key, session=session) -> None:
+                    try:
+                        engine.add_peer(key, session.request_parts_available(info_hash, pieces))
+                    except OSError:
+                        engine.add_peer(key, None)
+                Thread(target=probe, daemon=True).start()
+            assert engine.run()
+            times.append(perf_counter() - start)
+
+        print(f'{leechers} leechers downloading {size_mb} MB from one seeder on loopback')
+        for run, slots in enumerate(upload_slots):
+            with contextlib.redirect_stdout(io.StringIO()):
+                peers = [start_peer(f'{run}-seeder', slots, True)]
+                peers += [start_peer(f'{run}-leecher-{i}', slots, False) for i in range(leechers)]
+                addresses = [('127.0.0.1', server.getsockname()[1]) for server, _, _ in peers]
+                times : List[float] = []
+                start = perf_counter()
+                threads = [Thread(target=leech, args=(*peers[i], addresses[:i] + addresses[i + 1:], times, start))
+                           for i in range(1, len(peers))]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            label = 'every peer' if slots is None else f'{slots} slots'
+            print(f'{label:>12}: median {statistics.median(times):6.2f}s, last {max(times):6.2f}s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='peer benchmarks')
+    parser.add_argument('--size', type=int, default=1024, help='size of the hashed file in MB')
+    parser.add_argument('--workers', type=int, nargs='*', help='worker counts to measure')
+    parser.add_argument('--hashes', action='store_true',
+                        help='compare the hash algorithms on the piece lengths instead')
+    parser.add_argument('--algorithms', nargs='*', choices=list(ALGORITHMS), help='hash algorithms to compare')
+    parser.add_argument('--swarm', type=int, metavar='LEECHERS',
+                        help='run a loopback swarm with this many leechers and --size MB instead')
+    args = parser.parse_args()
+    if args.swarm:
+        benchmark_swarm(args.swarm, args.size)
+    elif args.hashes:
+        benchmark_piece_hashes(args.size, algorithms=args.algorithms)
+    else:
+        benchmark_torrent_hashing(args.size, args.workers)
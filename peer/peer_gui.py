@@ -171,9 +171,9 @@ class PeerGUI(tk.Tk):
         listbox.delete(0, tk.END)
         list_file_names = []
 
-        for torrent_file in os.listdir('.torrent'):
-            with open(os.path.join('.torrent',torrent_file), 'r') as file:
-                torrent_data = json.load(file)
+        # only torrent files added or changed on disk since the last reload are parsed
+        self.peer.catalog.refresh()
+        for torrent_data in self.peer.catalog.values():
             self.peer.announce(torrent_data['info_hash'], torrent_data['info']['name'], 'completed')
             list_file_names.append(torrent_data['info']['name'])
             if len(data) == 0: 
@@ -322,13 +322,13 @@ class PeerGUI(tk.Tk):
         def download_bar(info_hash : str, name : str):
  
             submit_button.configure(state='disabled')  # Disable the download button
-            status_label.config(text="Downloading...")
+            pause_button.configure(state='normal')
+            status_label.config(text="Queued...")
                   # Start the progress bar
             read_pipe, write_pipe = os.pipe()
             
-            download_thread = Thread(target=self.download, args=(info_hash, name, write_pipe))
-            download_thread.daemon = True
-            download_thread.start()
+            # the download manager of the peer starts it once a slot is free
+            self.download(info_hash, name, write_pipe)
             
             progress_bar_handler = Thread(target=handle_progress_bar, args=(write_pipe, read_pipe))
             progress_bar_handler.daemon = True
@@ -337,38 +337,67 @@ class PeerGUI(tk.Tk):
         def handle_progress_bar(write_pipe, read_pipe): 
             
            # Simulate the download progress
-            while True: 
-                data = os.read(read_pipe, 1024) # Simulate some delay
-                data =  json.loads(data.decode())
-                if data['msg'] == 'success':
-                    progress['value'] = 100  # Update the progress bar
-                    # Update the status label and stop the progress bar
-                    status_label.config(text="Download Complete")
-                    break
-                
-                elif data['msg'] == 'failed':
-                    status_label.config(text="Download Failed,\npress download to try again...")
-                    submit_button.configure(state='noraml') 
-                    break
-                
-                elif data['msg'] == 'update':
-                    progress['value'] = int(data['number']) 
+            # several messages can arrive in one read while pieces complete concurrently
+            decoder = json.JSONDecoder()
+            buffer = ''
+            done = False
+            while not done: 
+                buffer += os.read(read_pipe, 1024).decode()
+                while buffer:
+                    try:
+                        data, end = decoder.raw_decode(buffer)
+                    except json.JSONDecodeError:
+                        break
+                    buffer = buffer[end:]
+                    if data['msg'] == 'success':
+                        progress['value'] = 100  # Update the progress bar
+                        # Update the status label and stop the progress bar
+                        status_label.config(text="Download Complete")
+                        pause_button.configure(state='disabled')
+                        done = True
+                        break
+                    
+                    elif data['msg'] == 'failed':
+                        status_label.config(text="Download Failed,\npress download to try again...")
+                        submit_button.configure(state='noraml') 
+                        pause_button.configure(state='disabled')
+                        done = True
+                        break
+                    
+                    elif data['msg'] == 'paused':
+                        # the pipe stays open, the download writes to it again once resumed
+                        status_label.config(text="Paused")
+                    
+                    elif data['msg'] == 'update':
+                        status_label.config(text="Downloading...")
+                        progress['value'] = int(data['number']) 
                     
                          
             os.close(read_pipe)
             os.close(write_pipe)
             self.reload_sessions(self.listbox)
             
+        def toggle_pause() -> None:
+            if pause_button['text'] == 'Pause':
+                self.peer.pause_download(info_hash)
+                pause_button.configure(text='Resume')
+            else:
+                self.peer.resume_download(info_hash)
+                status_label.config(text="Queued...")
+                pause_button.configure(text='Pause')
+
         # Create a button to submit the download form
         submit_button = ttk.Button(form_frame, text="Download", command=lambda : download_bar(info_hash, name))
-        submit_button.pack()
+        submit_button.pack(side='left', expand=True)
+        pause_button = ttk.Button(form_frame, text="Pause", command=toggle_pause, state='disabled')
+        pause_button.pack(side='left', expand=True)
 
         # Hide the progress bar initially
         
         
         
     def download(self, info_hash : str, name : str, pipe : int) -> None:
-        self.peer.download_file(info_hash, name, pipe)
+        self.peer.enqueue_download(info_hash, name, pipe=pipe)
         
     
     def create_torrent_window(self) -> None:
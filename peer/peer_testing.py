@@ -0,0 +1,1273 @@
+import errno
+import hashlib
+import json
+import os
+import pickle
+import random
+import socket
+import threading
+import time
+from typing import Any, Dict, List, Set, Tuple
+
+import pytest
+
+from utils.piece_picker import PiecePicker
+from utils.download_engine import CorruptPieceError, DownloadEngine, StorageError
+from utils import wire_protocol
+from utils import atomic_file
+from utils.atomic_file import atomic_write
+from utils.catalog import TorrentCatalog
+from utils.file_cache import FileCache
+from utils.hashing import hash_file, verify_pieces
+from utils.piece_hash import PieceHasher
+from utils.piece_cache import PieceCache
+from utils.connection_pool import ConnectionPool
+from utils.peer_stats import PeerStats
+from utils.choker import Choker
+from utils.rate_limit import BandwidthLimits, TokenBucket, allowance, throttle
+from utils.download_manager import DownloadManager, DownloadJob, ACTIVE, DONE, PAUSED, QUEUED
+from utils.storage import FileRange, FileStorage, file_stamp
+
+try:
+    import peer
+except ImportError:
+    # peer.py needs the tracker client of a full install
+    peer = None
+
+needs_peer = pytest.mark.skipif(peer is None, reason='peer.py cannot be imported without its dependencies')
+
+
+def start_seeder(tmp_path, data : bytes, piece_length : int, **server_args : Any) -> Tuple[Any, Dict[str, Any]]:
+    """
+    Serves a file seeded in place from a PeerServer on a free port, `server_args`
+    are passed on to the server.
+
+    Returns:
+        Tuple[PeerServer, Dict[str, Any]]: the running server and the torrent of the file.
+    """
+    path = tmp_path / 'seeded.bin'
+    path.write_bytes(data)
+    parts, file_hash = hash_file(str(path), piece_length)
+    info = {'length' : len(data), 'path' : '', 'name' : path.name, 'piece length' : piece_length,
+            'pieces' : parts, 'file_hash' : file_hash}
+    torrent = {'info' : info, 'info_hash' : hashlib.sha256(json.dumps(info).encode()).hexdigest(),
+               'storage' : {'mode' : 'file', 'path' : str(path), 'complete' : True, 'stamp' : file_stamp(str(path))}}
+    (tmp_path / 'torrents').mkdir()
+    catalog = TorrentCatalog(str(tmp_path / 'torrents'))
+    catalog.save(torrent)
+    server = peer.PeerServer(0, 'seeder', catalog=catalog, **server_args)
+    threading.Thread(target=server.handle_connections, daemon=True).start()
+    return server, catalog.get(torrent['info_hash'])
+
+
+def start_legacy_peer(data : bytes, piece_length : int, pieces : Dict[str, str],
+                      delay : float = 0) -> Tuple[socket.socket, List[str]]:
+    """
+    Serves a file like a peer before sessions, one pickled request per connection
+    and whole pieces only, each sent after `delay` seconds.
+
+    Returns:
+        Tuple[socket.socket, List[str]]: the listening socket, closing it stops the
+        peer, and the messages it was sent.
+    """
+    listener = socket.create_server(('127.0.0.1', 0))
+    asked : List[str] = []
+
+    def legacy_peer() -> None:
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except OSError:
+                return
+            with sock:
+                msg = peer.load_message(sock.recv(65536))
+                asked.append(msg.msg)
+                if msg.msg == '$parts_available':
+                    sock.sendall(pickle.dumps(list(pieces.values())))
+                elif msg.msg == '$part':
+                    time.sleep(delay)
+                    index = next(int(i) for i, h in pieces.items() if h == msg.data.part_hash)
+                    msg.data.data = data[index * piece_length:(index + 1) * piece_length]
+                    sock.sendall(pickle.dumps(msg))
+
+    threading.Thread(target=legacy_peer, daemon=True).start()
+    return listener, asked
+
+
+def simulate_swarm(rarest_first : bool, piece_count : int = 200, leechers : int = 8,
+                   seeder_slots : int = 2, seeder_rounds : int = 110, rounds : int = 400,
+                   seed : int = 7) -> Dict[str, int | None]:
+    """
+    Simulates a swarm of one seeder and several leechers in rounds. Every round
+    each peer uploads at most one piece (the seeder `seeder_slots`), after
+    `seeder_rounds` rounds the seeder leaves the swarm, by then it uploaded
+    a little more than one copy of the file.
+
+    Returns:
+        Dict[str, int | None]: distinct pieces the leechers held when the seeder
+        left and the round the last leecher completed, None if it never did.
+    """
+    rng = random.Random(seed)
+    have : Dict[str, Set[int]] = {'seeder' : set(range(piece_count))}
+    have.update({f'leecher{i}' : set() for i in range(leechers)})
+    pickers : Dict[str, PiecePicker] = {}
+    for name in have:
+        if name == 'seeder':
+            continue
+        pickers[name] = PiecePicker(piece_count, range(piece_count), random.Random(rng.random()))
+        for other, pieces in have.items():
+            if other != name:
+                pickers[name].add_peer(other, pieces)
+
+    result : Dict[str, int | None] = {'replicated' : None, 'completed' : None}
+    for round_number in range(rounds):
+        if round_number == seeder_rounds:
+            del have['seeder']
+            for picker in pickers.values():
+                picker.remove_peer('seeder')
+            result['replicated'] = len(set().union(*have.values()))
+
+        # every peer serves its upload slots to random peers that want something from it
+        transfers : List[tuple[str, int]] = []
+        sources = list(have)
+        rng.shuffle(sources)
+        for source in sources:
+            slots = seeder_slots if source == 'seeder' else 1
+            requesters = [name for name in pickers if name != source]
+            rng.shuffle(requesters)
+            for name in requesters:
+                if not slots:
+                    break
+                if rarest_first:
+                    index = pickers[name].pick(source)
+                else:
+                    # today's order: the first missing piece in the list of the peer
+                    missing = sorted(have[source] - have[name] - {i for n, i in transfers if n == name})
+                    index = missing[0] if missing else None
+                if index is not None:
+                    slots -= 1
+                    transfers.append((name, index))
+
+        for name, index in transfers:
+            have[name].add(index)
+            pickers[name].complete(index)
+            for other, picker in pickers.items():
+                if other != name:
+                    picker.peer_has(name, index)
+
+        if all(len(have[name]) == piece_count for name in pickers):
+            result['completed'] = round_number + 1
+            break
+    return result
+
+
+def test_rarest_first_replicates_more_pieces():
+    in_order = simulate_swarm(rarest_first=False)
+    rarest = simulate_swarm(rarest_first=True)
+
+    assert rarest['replicated'] > in_order['replicated']
+    # every piece left the seeder before it did, so the leechers can still finish
+    assert rarest['replicated'] == 200
+    assert rarest['completed'] is not None
+    assert in_order['completed'] is None
+
+
+def test_picker_prefers_rare_pieces():
+    picker = PiecePicker(4, range(4), random.Random(1))
+    picker.add_peer('a', [0, 1, 2, 3])
+    picker.add_peer('b', [0, 1, 2])
+    picker.add_peer('c', [0, 1])
+
+    assert picker.pick('a') == 3
+    assert picker.pick('a') == 2
+    assert picker.pick('a') in (0, 1)
+
+
+def test_picker_survives_seeder_churn():
+    picker = PiecePicker(3, range(3))
+    picker.add_peer('seeder', [0, 1, 2])
+    picker.add_peer('leecher', [1])
+    index = picker.pick('seeder')
+    picker.release(index)
+    picker.remove_peer('seeder')
+
+    assert picker.availability == [0, 1, 0]
+    assert picker.pick('leecher') == 1
+    assert picker.pick('leecher') is None
+
+
+def test_file_storage_writes_pieces_in_place(tmp_path):
+    storage = FileStorage(str(tmp_path / 'file.part'), 10, 4)
+    storage.preallocate()
+    storage.write(2, b'ij')
+    storage.write(0, b'abcd')
+
+    assert os.path.getsize(tmp_path / 'file.part') == 10
+    assert storage.available() == [0, 2]
+    assert storage.read(1, 0, 4) is None
+    assert storage.read(0, 1, 2) == b'bc'
+    storage.write(1, b'efgh')
+    storage.move(str(tmp_path / 'file'))
+    storage.close()
+    assert (tmp_path / 'file').read_bytes() == b'abcdefghij'
+    # downloads are not executable
+    assert not os.stat(tmp_path / 'file').st_mode & 0o111
+
+
+def test_file_storage_rehashes_changed_file(tmp_path):
+    path = tmp_path / 'file'
+    path.write_bytes(b'abcdefghij')
+    pieces = {0 : hashlib.sha256(b'abcd').hexdigest(), 1 : hashlib.sha256(b'efgh').hexdigest(),
+              2 : hashlib.sha256(b'ij').hexdigest()}
+    storage = FileStorage(str(path), 10, 4, complete=True, stamp=file_stamp(str(path)))
+    assert not storage.stale()
+
+    path.write_bytes(b'abcdXXghij')
+    os.utime(path, ns=(0, 0))
+    assert storage.stale()
+    assert not storage.rehash(pieces)
+    assert storage.available() == [0, 2]
+    assert storage.read(1, 0, 4) is None
+    assert not storage.stale()
+
+
+def test_file_cache_sends_ranges_with_bounded_files(tmp_path):
+    paths = []
+    for i in range(3):
+        path = tmp_path / f'file{i}'
+        path.write_bytes(bytes([i]) * 100)
+        paths.append(str(path))
+    cache = FileCache(max_open=2)
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        for path in paths:
+            assert cache.send(sender, FileRange(path, 10, 5)) == 5
+        assert wire_protocol.recv_exact(receiver, 15) == b'\x00' * 5 + b'\x01' * 5 + b'\x02' * 5
+    assert list(cache.files) == paths[1:]
+    cache.close()
+
+
+def test_catalog_indexes_torrents_and_follows_the_directory(tmp_path):
+    catalog = TorrentCatalog(str(tmp_path), rescan_interval=0)
+    path = catalog.save({'info' : {'name' : 'a.bin', 'pieces' : {0 : 'x'}}, 'info_hash' : 'aa'})
+    assert catalog.get('aa')['info']['pieces'] == {'0' : 'x'}
+
+    (tmp_path / 'b.torrent').write_text(json.dumps({'info' : {'name' : 'b.bin'}, 'info_hash' : 'bb'}))
+    assert catalog.get('bb')['info']['name'] == 'b.bin'
+
+    os.remove(path)
+    catalog.refresh()
+    assert 'aa' not in catalog
+    assert len(catalog) == 1
+
+
+def test_catalog_follows_edited_and_removed_files_of_known_torrents(tmp_path):
+    catalog = TorrentCatalog(str(tmp_path), rescan_interval=0.05)
+    path = catalog.save({'info' : {'name' : 'a.bin'}, 'info_hash' : 'aa'})
+    assert catalog.get('aa')['info']['name'] == 'a.bin'
+
+    # a torrent that is found is still rescanned once the interval passed
+    with open(path, 'w') as file:
+        json.dump({'info' : {'name' : 'renamed.bin'}, 'info_hash' : 'aa'}, file)
+    os.utime(path, ns=(0, 0))
+    time.sleep(0.1)
+    assert catalog.get('aa')['info']['name'] == 'renamed.bin'
+
+    os.remove(path)
+    time.sleep(0.1)
+    assert catalog.values() == [] and catalog.get('aa') is None
+
+
+def test_atomic_write_replaces_files_whole(tmp_path):
+    path = str(tmp_path / 'queue.json')
+    atomic_write(path, '[]')
+    atomic_write(path, b'\x00\x01')
+    with open(path, 'rb') as file:
+        assert file.read() == b'\x00\x01'
+    assert os.listdir(tmp_path) == ['queue.json']
+    assert os.stat(path).st_mode & 0o777 == 0o666 & ~atomic_file.UMASK
+
+    # concurrent writers each swap in a whole file of their own
+    contents = [bytes([i]) * 100_000 for i in range(8)]
+    writers = [threading.Thread(target=lambda data=data: [atomic_write(path, data) for _ in range(10)])
+               for data in contents]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    with open(path, 'rb') as file:
+        assert file.read() in contents
+    assert os.listdir(tmp_path) == ['queue.json']
+
+    # a failed swap leaves no temporary file behind
+    (tmp_path / 'directory').mkdir()
+    with pytest.raises(OSError):
+        atomic_write(str(tmp_path / 'directory'), '[]')
+    assert sorted(os.listdir(tmp_path)) == ['directory', 'queue.json']
+
+
+def test_file_storage_resumes_verified_pieces(tmp_path):
+    path, resume = str(tmp_path / 'file.part'), str(tmp_path / 'resume')
+    storage = FileStorage(path, 10, 4, resume=resume)
+    storage.preallocate()
+    storage.write(0, b'abcd')
+    storage.write(2, b'ij')
+    storage.close()
+
+    resumed = FileStorage(path, 10, 4, resume=resume)
+    assert resumed.available() == [0, 2]
+    assert resumed.read(2, 0, 2) == b'ij'
+    resumed.seal()
+    assert not os.path.exists(resume)
+
+    os.remove(path)
+    assert FileStorage(path, 10, 4, resume=resume).available() == []
+
+
+def test_verify_pieces_flags_corrupt_and_missing_pieces(tmp_path):
+    path = tmp_path / 'file'
+    path.write_bytes(b'abcdefghij')
+    pieces = [
+        (0, FileRange(str(path), 0, 4), hashlib.sha256(b'abcd').hexdigest()),
+        (1, FileRange(str(path), 4, 4), hashlib.sha256(b'XXXX').hexdigest()),
+        (2, FileRange(str(path), 8, 4), hashlib.sha256(b'ij').hexdigest()),
+        (3, FileRange(str(tmp_path / 'missing'), 0, 4), hashlib.sha256(b'abcd').hexdigest()),
+    ]
+
+    assert verify_pieces(pieces, 16, workers=2) == {0 : True, 1 : False, 2 : False, 3 : False}
+
+
+def test_hash_file_matches_serial_hashing(tmp_path):
+    path = tmp_path / 'file'
+    data = os.urandom(10 * 1000 + 7)
+    path.write_bytes(data)
+    written = {}
+
+    parts, file_hash = hash_file(str(path), 1000, workers=3,
+                                 on_piece=lambda index, piece, piece_hash: written.update({index : piece}))
+
+    assert file_hash == hashlib.sha256(data).hexdigest()
+    assert list(parts) == list(range(11))
+    assert all(parts[i] == hashlib.sha256(data[i * 1000:(i + 1) * 1000]).hexdigest() for i in parts)
+    assert b''.join(written[i] for i in range(11)) == data
+
+
+def test_engine_assembles_pieces_from_blocks_of_several_peers():
+    data = os.urandom(25)
+    pieces = {i : hashlib.sha256(data[i * 10:(i + 1) * 10]).hexdigest() for i in range(3)}
+    requests : List[tuple[str, int, int]] = []
+    corrupted : List[int] = []
+    stored = {}
+
+    def fetch(peer : str, index : int, begin : int, length : int) -> bytes:
+        requests.append((peer, index, begin))
+        # peer b stalls on its first request, only that block is requested again
+        if peer == 'b' and [request[0] for request in requests].count('b') == 1:
+            raise ConnectionError('stalled')
+        # the first copy of the middle block of piece 1 is corrupt, the piece is downloaded again
+        if (index, begin) == (1, 4) and not corrupted:
+            corrupted.append(index)
+            return b'X' * length
+        return data[index * 10 + begin:index * 10 + begin + length]
+
+    engine = DownloadEngine(pieces, range(3), {'a' : range(3), 'b' : range(3)}, fetch,
+                            store=lambda index, piece: stored.update({index : bytes(piece)}),
+                            piece_size=lambda index: min(10, 25 - index * 10),
+                            max_in_flight=2, max_in_flight_per_peer=1, endgame_threshold=0, block_size=4)
+
+    assert engine.run()
+    assert b''.join(stored[i] for i in range(3)) == data
+    blocks = [request[1:] for request in requests]
+    # blocks of 4, 4 and 2 bytes, the stalled block once more and the corrupt piece again
+    assert set(blocks) == {(0, 0), (0, 4), (0, 8), (1, 0), (1, 4), (1, 8), (2, 0), (2, 4)}
+    assert len(blocks) == 8 + 1 + 3
+    assert {'a', 'b'} == {request[0] for request in requests}
+
+
+def test_engine_rerequests_only_corrupt_blocks_of_merkle_pieces(tmp_path):
+    path = tmp_path / 'file'
+    data = os.urandom(50)
+    path.write_bytes(data)
+    hasher = PieceHasher(block_length=4, piece_length=16)
+    pieces, _ = hash_file(str(path), 16, hasher=hasher)
+    assert pieces[3] == hasher.digest(data[48:])
+    assert hasher.leaves_root(hasher.leaves(data[:16])) == pieces[0]
+    requests : List[tuple[int, int]] = []
+    stored = {}
+
+    def fetch(peer : str, index : int, begin : int, length : int) -> bytes:
+        requests.append((index, begin))
+        if (index, begin) == (2, 8) and requests.count((2, 8)) == 1:
+            return b'X' * length
+        return data[index * 16 + begin:index * 16 + begin + length]
+
+    engine = DownloadEngine(pieces, range(4), {'a' : range(4)}, fetch,
+                            store=lambda index, piece: stored.update({index : bytes(piece)}),
+                            piece_size=lambda index: min(16, 50 - index * 16), endgame_threshold=0,
+                            hasher=hasher, fetch_hashes=lambda peer, index: hasher.leaves(data[index * 16:index * 16 + 16]))
+
+    assert engine.run()
+    assert b''.join(stored[i] for i in range(4)) == data
+    # 4 blocks per full piece, 1 for the last, only the corrupt block is fetched twice
+    assert len(requests) == 4 * 3 + 1 + 1
+
+
+def test_hashers_follow_the_algorithm_of_the_torrent(tmp_path):
+    path = tmp_path / 'file'
+    data = os.urandom(3000)
+    path.write_bytes(data)
+    hasher = PieceHasher.from_info({'piece length' : 1000, 'hash algorithm' : 'blake2b'})
+
+    parts, file_hash = hash_file(str(path), 1000, hasher=hasher)
+
+    assert file_hash == hashlib.blake2b(data, digest_size=32).hexdigest()
+    assert parts[1] == hashlib.blake2b(data[1000:2000], digest_size=32).hexdigest()
+    assert verify_pieces([(1, FileRange(str(path), 1000, 1000), parts[1], hasher)], 1000, workers=1) == {1 : True}
+    assert verify_pieces([(1, FileRange(str(path), 1000, 1000), parts[1])], 1000, workers=1) == {1 : False}
+    with pytest.raises(ValueError):
+        PieceHasher.from_info({'hash algorithm' : 'md5'})
+
+
+def test_piece_cache_keeps_hot_pieces_through_a_scan():
+    cache = PieceCache(max_bytes=40, protected_share=0.5)
+    assert not cache.wanted('aa', 0, 'first')
+    assert cache.wanted('aa', 0, 'second')
+    cache.put('aa', 0, b'0' * 10)
+    assert cache.get('aa', 0) == b'0' * 10
+
+    # a peer reading every piece once only cycles the probation segment
+    for index in range(1, 10):
+        cache.put('aa', index, bytes([index]) * 10)
+    assert cache.get('aa', 0) == b'0' * 10
+    assert cache.get('aa', 1) is None
+    assert cache.stats() == {'hits' : 2, 'misses' : 1, 'evictions' : 6, 'bytes' : 40, 'entries' : 4}
+
+    cache.put('bb', 0, b'x' * 10)
+    cache.discard('aa', 0)
+    assert cache.get('aa', 0) is None
+    cache.discard('aa')
+    assert cache.stats()['entries'] == 1
+    assert cache.get('bb', 0) == b'x' * 10
+
+
+def test_connection_pool_shares_evicts_and_backs_off():
+    opened : List[str] = []
+    closed : List[str] = []
+    pool = ConnectionPool(lambda key: opened.append(key) or key, max_size=2, backoff=60,
+                          close=closed.append)
+
+    assert pool.acquire('a') == 'a'
+    pool.acquire('a')
+    assert opened == ['a']
+    pool.acquire('b')
+    pool.release('b')
+    # 'a' is in use, so the idle 'b' makes room for 'c'
+    pool.acquire('c')
+    assert closed == ['b'] and len(pool) == 2
+
+    pool.failed('a')
+    assert closed == ['b'] and pool.backing_off('a')
+    pool.release('a')
+    pool.release('a')
+    assert closed == ['b', 'a']
+    with pytest.raises(ConnectionError):
+        pool.acquire('a')
+    pool.close()
+    assert sorted(closed) == ['a', 'b', 'c']
+
+
+def test_connection_pool_checks_health_without_holding_up_other_peers():
+    checking = threading.Event()
+    release = threading.Event()
+
+    def healthy(connection : str) -> bool:
+        # the connection of 'slow' takes its time, like a session that is connecting
+        if connection == 'slow':
+            checking.set()
+            release.wait(5)
+        return True
+
+    pool = ConnectionPool(lambda key: key, healthy=healthy)
+    pool.acquire('slow')
+    pool.acquire('fast')
+    pool.release('slow')
+    pool.release('fast')
+    threading.Thread(target=pool.acquire, args=('slow',), daemon=True).start()
+    try:
+        assert checking.wait(5)
+        started = time.monotonic()
+        assert pool.acquire('fast') == 'fast'
+        assert time.monotonic() - started < 1
+    finally:
+        release.set()
+
+
+def test_engine_starts_with_the_first_answer_and_merges_late_peers():
+    data = os.urandom(40)
+    pieces = {i : hashlib.sha256(data[i * 10:(i + 1) * 10]).hexdigest() for i in range(4)}
+    requests : List[str] = []
+    started, joined = threading.Event(), threading.Event()
+
+    def fetch(peer : str, index : int, begin : int, length : int) -> bytes:
+        requests.append(peer)
+        # the first request runs before peers b and c answered
+        if not started.is_set():
+            started.set()
+            assert joined.wait(5)
+        return data[index * 10 + begin:index * 10 + begin + length]
+
+    engine = DownloadEngine(pieces, range(4), {}, fetch, store=lambda index, piece: None,
+                            piece_size=lambda index: 10, max_in_flight=2, max_in_flight_per_peer=1,
+                            endgame_threshold=0, pending_peers=3)
+
+    def answer() -> None:
+        engine.add_peer('a', range(4))
+        started.wait(5)
+        # c could not be asked, b answers late
+        engine.add_peer('c', None)
+        engine.add_peer('b', range(4))
+        joined.set()
+
+    threading.Thread(target=answer, daemon=True).start()
+    assert engine.run()
+    assert requests[0] == 'a' and 'b' in requests
+    assert engine.pending_peers == 0
+
+    # without any peer that answered the download gives up instead of waiting
+    engine = DownloadEngine(pieces, range(4), {}, fetch, store=lambda index, piece: None,
+                            piece_size=lambda index: 10, pending_peers=1)
+    engine.add_peer('a', None)
+    assert not engine.run()
+
+
+def test_peer_stats_size_queues_and_failing_peers_back_off():
+    now = time.monotonic()
+    slow, fast = PeerStats(), PeerStats()
+    slow.succeeded(128 << 10, now - 1, now)
+    fast.succeeded(10 << 20, now - 1, now)
+    assert slow.queue_depth(1 << 16, 8) == 1
+    assert fast.queue_depth(1 << 16, 8) == 8
+    # a peer nothing is known about gets the full queue, failures shrink it
+    fresh = PeerStats()
+    assert fresh.queue_depth(1 << 16, 8) == 8
+    for _ in range(3):
+        fresh.failed()
+    assert fresh.queue_depth(1 << 16, 8) == 4
+    assert fast.snapshot()['rtt'] == pytest.approx(1)
+    # deadlines follow the round trip time, a request that timed out counts as a long one
+    assert fresh.timeout(10) == 10
+    assert fast.timeout(10) == pytest.approx(4)
+    fast.failed(elapsed=4)
+    assert fast.snapshot()['rtt'] > 1 and fast.timeout(10) > 4
+
+    data = os.urandom(40)
+    pieces = {i : hashlib.sha256(data[i * 10:(i + 1) * 10]).hexdigest() for i in range(4)}
+    def fetch(peer : str, index : int, begin : int, length : int) -> bytes:
+        if peer == 'b':
+            raise ConnectionError('refused')
+        return data[index * 10 + begin:index * 10 + begin + length]
+
+    engine = DownloadEngine(pieces, range(4), {'a' : range(4), 'b' : range(4)}, fetch,
+                            store=lambda index, piece: None, piece_size=lambda index: 10,
+                            max_in_flight=2, max_in_flight_per_peer=1, endgame_threshold=0)
+    assert engine.run()
+    # b backed off after every failure until it was dropped, a downloaded the rest
+    assert engine.stats['b'].failures <= 3
+    assert engine.stats['a'].snapshot()['bytes'] == 40
+    assert engine.stats['a'].failure_rate == 0
+
+
+def test_choker_reciprocates_and_unchokes_optimistically():
+    choker = Choker(slots=3, optimistic_rounds=2, rng=random.Random(1))
+    # slots are handed out first come first served until the first rechoke
+    assert [choker.allow(peer) for peer in 'abcd'] == [True, True, True, False]
+    for peer in 'abcde':
+        choker.allow(peer)
+    choker.sent('a', 100)
+    # d and e upload the fastest to us, one of a, b and c is unchoked optimistically
+    choker.rechoke({'d' : 10.0, 'e' : 5.0})
+    assert {'d', 'e'} < choker.unchoked and len(choker.unchoked) == 3
+    assert choker.optimistic in 'abc'
+    assert choker.allow('d') and not choker.allow(({'a', 'b', 'c'} - {choker.optimistic}).pop())
+    # a peer that leaves frees its slot
+    choker.remove('d')
+    assert choker.allow('a')
+    assert Choker(slots=None).allow('z')
+
+
+def test_choker_keeps_the_slot_of_a_slow_peer_that_still_downloads(monkeypatch):
+    import utils.choker
+    monkeypatch.setattr(utils.choker, 'SLOT_IDLE_TIMEOUT', 0.05)
+    downloading = {'slow'}
+    choker = Choker(slots=1, busy=lambda peer: peer in downloading)
+    assert choker.allow('slow')
+    # the next request of the slow peer takes longer than the idle timeout,
+    # its reply is still being sent
+    time.sleep(0.1)
+    assert not choker.allow('other')
+    assert choker.unchoked == {'slow'}
+    # once its replies are sent and it stopped asking, the slot is handed on
+    downloading.clear()
+    assert choker.allow('other')
+    assert choker.unchoked == {'other'}
+
+
+def test_token_buckets_limit_global_and_torrent_bandwidth():
+    bucket = TokenBucket(1 << 20, burst=1 << 17)
+    # a full bucket lets the burst through at once, then the rate applies
+    assert allowance([bucket], 1 << 20) == 1 << 17
+    start = time.monotonic()
+    throttle([bucket], 1 << 17)
+    throttle([bucket], 1 << 17)
+    assert 0.1 <= time.monotonic() - start < 0.5
+    # raising the limit at runtime takes effect at once
+    bucket.set_rate(None)
+    assert allowance([bucket], 1 << 30) == 1 << 30
+
+    limits = BandwidthLimits()
+    assert limits.buckets('upload', 'a' * 64) == []
+    limits.set_limits(upload=1 << 20, info_hash='a' * 64)
+    limits.set_limits(download=1 << 21)
+    assert len(limits.buckets('upload', 'a' * 64)) == 1 and limits.buckets('upload', 'b' * 64) == []
+    assert len(limits.buckets('download', 'a' * 64)) == 1
+    assert limits.limits() == {'global' : {'upload' : None, 'download' : float(1 << 21)},
+                               'a' * 64 : {'upload' : float(1 << 20), 'download' : None}}
+
+
+def test_download_manager_queues_by_priority_pauses_and_persists(tmp_path):
+    path = str(tmp_path / 'downloads.json')
+    release : Dict[str, threading.Event] = {name : threading.Event() for name in 'abcd'}
+    started : List[str] = []
+
+    def run(job : DownloadJob) -> bool:
+        started.append(job.info_hash)
+        # a paused download returns early, like a stopped engine
+        release[job.info_hash].wait(5)
+        return manager.jobs[job.info_hash].state == ACTIVE
+
+    def states() -> Dict[str, str]:
+        return {job['info_hash'] : job['state'] for job in manager.status()}
+
+    def wait_for(condition) -> None:
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert condition()
+
+    manager = DownloadManager(path, run, stop=lambda info_hash: release[info_hash].set(), max_active=2)
+    manager.start()
+    manager.add('a', 'a.bin')
+    manager.add('b', 'b.bin')
+    manager.add('c', 'c.bin')
+    manager.add('d', 'd.bin', priority=5)
+    wait_for(lambda: len(started) == 2)
+    assert states() == {'a' : ACTIVE, 'b' : ACTIVE, 'c' : QUEUED, 'd' : QUEUED}
+
+    # pausing frees a slot for the queued torrent with the highest priority
+    manager.pause('a')
+    wait_for(lambda: len(started) == 3)
+    assert started[2] == 'd' and states()['a'] == PAUSED
+    release['b'].set()
+    wait_for(lambda: states()['b'] == DONE and 'c' in started)
+
+    # the queue survives a restart, running downloads are queued again
+    restored = DownloadManager(path, run, stop=lambda info_hash: None)
+    assert {job.info_hash : job.state for job in restored.jobs.values()} == {
+        'a' : PAUSED, 'b' : DONE, 'c' : QUEUED, 'd' : QUEUED}
+    release['c'].set()
+    release['d'].set()
+    wait_for(lambda: states()['c'] == DONE and states()['d'] == DONE)
+
+
+def test_download_manager_reports_raising_downloads_and_drops_old_finished_ones(tmp_path):
+    path = str(tmp_path / 'downloads.json')
+    finished : List[str] = []
+
+    def run(job : DownloadJob) -> bool:
+        finished.append(job.info_hash)
+        if job.info_hash == 'broken':
+            raise KeyError('info')
+        return True
+
+    manager = DownloadManager(path, run, stop=lambda info_hash: None, max_active=1, max_finished=2)
+    manager.start()
+    reader, writer = os.pipe()
+    try:
+        manager.add('broken', 'broken.bin', pipe=writer)
+        assert json.loads(os.read(reader, 1024)) == {'msg' : 'failed'}
+    finally:
+        os.close(reader)
+        os.close(writer)
+    for name in 'abc':
+        manager.add(name, f'{name}.bin')
+    deadline = time.monotonic() + 5
+    while (len(finished) < 4 or manager.running) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    # the failed download and the oldest finished one are gone
+    assert {job['info_hash'] : job['state'] for job in manager.status()} == {'b' : DONE, 'c' : DONE}
+    assert {job.info_hash for job in DownloadManager(path, run, stop=lambda info_hash: None).jobs.values()} == {'b', 'c'}
+
+
+def test_picker_follows_the_playback_cursor():
+    picker = PiecePicker(100, range(100), random.Random(3))
+    picker.add_peer('seeder', range(100))
+    picker.add_peer('leecher', range(50, 100))
+    picker.set_cursor(0, window=4)
+    assert [picker.pick('seeder') for _ in range(3)] == [0, 1, 2]
+    # a peer without the pieces at the cursor still gets rarer pieces
+    assert 50 <= picker.pick('leecher') < 100
+    picker.complete(0)
+    picker.complete(1)
+    # a seek moves the pieces picked in order
+    picker.set_cursor(70, window=4)
+    assert [picker.pick('leecher') for _ in range(3)] == [70, 71, 72]
+
+
+def test_stream_server_serves_ranges_while_pieces_arrive():
+    import urllib.request
+    from utils.stream_server import StreamServer, parse_range
+
+    piece_length, length = 4, 18
+    data = bytes(range(length))
+    present : Set[int] = {0}
+    seeks : List[int] = []
+
+    class Storage:
+        def read(self, index, begin, size):
+            if index not in present:
+                return None
+            return data[index * piece_length + begin:index * piece_length + begin + size]
+
+    def seek(info_hash, index):
+        # the download jumps to the piece the player waits for
+        seeks.append(index)
+        threading.Timer(0.05, present.update, args=(range(index, index + 2),)).start()
+
+    info_hash = 'ab' * 32
+    info = {'name' : 'movie.mp4', 'length' : length, 'piece length' : piece_length}
+    server = StreamServer(('127.0.0.1', 0), lambda h: (info, Storage()) if h == info_hash else None, seek)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        request = urllib.request.Request(server.url(info_hash), headers={'Range' : 'bytes=9-14'})
+        with urllib.request.urlopen(request, timeout=5) as response:
+            assert response.status == 206
+            assert response.headers['Content-Range'] == 'bytes 9-14/18'
+            assert response.headers['Content-Type'] == 'video/mp4'
+            assert response.read() == data[9:15]
+        assert seeks == [2]
+        with urllib.request.urlopen(server.url(info_hash), timeout=5) as response:
+            assert response.status == 200 and response.read() == data
+        assert seeks == [2, 1, 4]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert parse_range('bytes=-4', length) == (14, 17)
+    assert parse_range('bytes=10-', length) == (10, 17)
+    assert parse_range('bytes=18-20', length) is None
+    with pytest.raises(ValueError):
+        parse_range('bytes=0-1,4-5', length)
+
+
+@needs_peer
+def test_server_survives_malformed_handshakes(tmp_path):
+    data = os.urandom(100_000)
+    server, torrent = start_seeder(tmp_path, data, 1 << 15)
+    port = server.getsockname()[1]
+    # an oversized byte string, a huge allocation and a pickle that is not a message
+    for garbage in (b'\x80\x04\x8e' + (2 ** 63 - 1).to_bytes(8, 'little'),
+                    b'\x80\x04\x96' + (2 ** 63 - 1).to_bytes(8, 'little'),
+                    b'\x80\x04K\x01.'):
+        with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+            sock.sendall(garbage)
+            # the server drops the connection instead of dying
+            assert sock.recv(1) == b''
+
+    session = peer.PeerSession(peer.Address('127.0.0.1', port), 'leecher')
+    try:
+        assert session.request_torrent(torrent['info_hash'], timeout=5)['info'] == torrent['info']
+        assert bytes(session.request_part(torrent['info_hash'], 1, torrent['info']['pieces']['1'], 0, 1000)) == \
+            data[1 << 15:(1 << 15) + 1000]
+    finally:
+        session.close()
+
+
+def test_engine_survives_peers_with_broken_block_hashes_and_replies(tmp_path):
+    path = tmp_path / 'file'
+    data = os.urandom(64)
+    path.write_bytes(data)
+    hasher = PieceHasher(block_length=4, piece_length=16)
+    pieces, _ = hash_file(str(path), 16, hasher=hasher)
+    stored = {}
+
+    def fetch(peer : str, index : int, begin : int, length : int) -> bytes:
+        if peer == 'crashing':
+            raise ValueError('malformed reply')
+        return data[index * 16 + begin:index * 16 + begin + length]
+
+    def fetch_hashes(peer : str, index : int) -> List[bytes]:
+        leaves = hasher.leaves(data[index * 16:index * 16 + 16])
+        # more leaves than the tree of a piece is wide
+        return leaves + [bytes(32)] * 5 if peer == 'padding' else leaves
+
+    engine = DownloadEngine(pieces, range(4), {'padding' : range(4), 'crashing' : range(4), 'good' : range(4)},
+                            fetch, store=lambda index, piece: stored.update({index : bytes(piece)}),
+                            piece_size=lambda index: 16, endgame_threshold=0, hasher=hasher, fetch_hashes=fetch_hashes)
+    assert engine.run()
+    assert b''.join(stored[i] for i in range(4)) == data
+    assert engine.stats['padding'].snapshot()['failure_rate'] > 0
+    assert 'crashing' not in engine.picker.peers
+
+
+def test_engine_stops_with_the_cause_when_pieces_cannot_be_stored():
+    data = os.urandom(64)
+    pieces = {index : hashlib.sha256(data[index * 16:index * 16 + 16]).hexdigest() for index in range(4)}
+    requests : List[Tuple[int, int]] = []
+    stored = {}
+
+    def store(index : int, piece : bytes) -> None:
+        if stored:
+            raise OSError(errno.ENOSPC, 'No space left on device')
+        stored[index] = bytes(piece)
+
+    def fetch(peer : str, index : int, begin : int, length : int) -> bytes:
+        requests.append((index, begin))
+        return data[index * 16 + begin:index * 16 + begin + length]
+
+    engine = DownloadEngine(pieces, range(4), {'a' : range(4), 'b' : range(4)}, fetch, store=store,
+                            piece_size=lambda index: 16, max_in_flight=1, block_size=16)
+
+    assert not engine.run()
+    # the full disk ends the download, the peers that sent the pieces are not blamed
+    assert isinstance(engine.error, StorageError)
+    assert engine.error.__cause__.errno == errno.ENOSPC
+    assert engine.failures == {'a' : 0, 'b' : 0} and len(requests) == 2
+    assert len(stored) == 1 and len(engine.missing) == 3
+
+
+def test_engine_drops_peers_sending_corrupt_pieces_and_gives_up_on_them():
+    data = os.urandom(64)
+    pieces = {index : hashlib.sha256(data[index * 16:index * 16 + 16]).hexdigest() for index in range(4)}
+    requests : List[Tuple[str, int]] = []
+    stored = {}
+
+    def fetch(peer : str, index : int, begin : int, length : int) -> bytes:
+        requests.append((peer, index))
+        if peer.startswith('bad'):
+            return b'X' * length
+        return data[index * 16 + begin:index * 16 + begin + length]
+
+    def engine(peers : List[str]) -> DownloadEngine:
+        return DownloadEngine(pieces, range(4), {peer : range(4) for peer in peers}, fetch,
+                              store=lambda index, piece: stored.update({index : bytes(piece)}),
+                              piece_size=lambda index: 16, block_size=8, endgame_threshold=0)
+
+    # the pieces the bad peer spoiled are downloaded again from one peer at a time
+    # until it is caught and dropped, the good peer finishes the download
+    mixed = engine(['bad', 'good'])
+    assert mixed.run()
+    assert b''.join(stored[i] for i in range(4)) == data
+    assert 'bad' not in mixed.picker.peers and mixed.bad_pieces['bad'] >= 1
+    assert 'good' not in mixed.bad_pieces
+
+    # with nobody else to ask, the download fails instead of spinning
+    requests.clear()
+    started = time.monotonic()
+    alone = engine(['bad'])
+    assert not alone.run()
+    assert time.monotonic() - started < 5
+    # every block was asked for once, the third corrupt piece got the peer dropped
+    assert 'bad' not in alone.picker.peers and len(requests) <= 2 * len(pieces)
+
+    # a piece that every peer spoils ends the download before each of them is caught
+    crowd = engine([f'bad{i}' for i in range(8)])
+    assert not crowd.run()
+    assert isinstance(crowd.error, CorruptPieceError)
+
+
+def test_engine_gives_up_requests_of_a_stalled_peer():
+    data = os.urandom(64)
+    pieces = {index : hashlib.sha256(data[index * 16:index * 16 + 16]).hexdigest() for index in range(4)}
+    stall = threading.Event()
+    stored = {}
+
+    def fetch(peer : str, index : int, begin : int, length : int) -> bytes:
+        if peer == 'stalled':
+            # accepts the request and never answers, cancelling does not help
+            stall.wait()
+            return None
+        return data[index * 16 + begin:index * 16 + begin + length]
+
+    try:
+        engine = DownloadEngine(pieces, range(4), {'stalled' : range(4), 'good' : range(4)}, fetch,
+                                store=lambda index, piece: stored.update({index : bytes(piece)}),
+                                piece_size=lambda index: 16, block_size=4, endgame_threshold=0,
+                                request_timeout=0.2)
+        started = time.monotonic()
+        assert engine.run()
+        assert time.monotonic() - started < 5
+        assert b''.join(stored[i] for i in range(4)) == data
+        assert engine.failures['stalled'] > 0
+
+        # a stopped download does not wait for the stalled requests either
+        engine = DownloadEngine(pieces, range(4), {'stalled' : range(4)}, fetch, store=lambda index, piece: None,
+                                piece_size=lambda index: 16, block_size=4, request_timeout=60)
+        threading.Timer(0.1, engine.stop, kwargs={'timeout' : 0.1}).start()
+        started = time.monotonic()
+        assert not engine.run()
+        assert time.monotonic() - started < 5
+    finally:
+        stall.set()
+
+
+@needs_peer
+def test_session_requests_to_a_stalled_peer_time_out_and_cancel():
+    listener = socket.create_server(('127.0.0.1', 0))
+    frames : List[int] = []
+
+    def stalled_peer() -> None:
+        sock, _ = listener.accept()
+        msg = peer.load_message(sock.recv(4096))
+        sock.sendall(peer.pickle.dumps(peer.Message('$session', {'peer_id' : 'stalled', 'version' : msg.data['version']})))
+        # reads the requests and never answers them
+        while True:
+            try:
+                msg_type, _, length = wire_protocol.read_header(sock)
+                wire_protocol.recv_exact(sock, length)
+            except (OSError, ConnectionError):
+                return
+            frames.append(msg_type)
+
+    threading.Thread(target=stalled_peer, daemon=True).start()
+    session = peer.PeerSession(peer.Address('127.0.0.1', listener.getsockname()[1]), 'leecher')
+    try:
+        started = time.monotonic()
+        with pytest.raises(TimeoutError):
+            session.request_part('ab' * 32, 0, 'ff' * 32, 0, 1024, timeout=0.2)
+        assert time.monotonic() - started < 2
+        deadline = time.monotonic() + 2
+        while len(frames) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert frames == [wire_protocol.PART, wire_protocol.CANCEL]
+    finally:
+        session.close()
+        listener.close()
+
+
+@needs_peer
+def test_sessions_reject_short_blocks_and_oversized_replies():
+    listener = socket.create_server(('127.0.0.1', 0))
+
+    def lying_peer() -> None:
+        sock, _ = listener.accept()
+        msg = peer.load_message(sock.recv(4096))
+        sock.sendall(peer.pickle.dumps(peer.Message('$session', {'peer_id' : 'liar', 'version' : msg.data['version']})))
+        with sock:
+            # 100 bytes for a block of 1024, then a torrent of 2 GB that never comes
+            _, request_id, length = wire_protocol.read_header(sock)
+            wire_protocol.recv_exact(sock, length)
+            sock.sendall(wire_protocol.pack_frame(wire_protocol.PART, request_id,
+                                                  wire_protocol.PART_REPLY.pack(0, 0) + bytes(100)))
+            _, request_id, length = wire_protocol.read_header(sock)
+            wire_protocol.recv_exact(sock, length)
+            sock.sendall(wire_protocol.HEADER.pack(wire_protocol.TORRENT, request_id, 1 << 31))
+            sock.recv(1)
+
+    threading.Thread(target=lying_peer, daemon=True).start()
+    session = peer.PeerSession(peer.Address('127.0.0.1', listener.getsockname()[1]), 'leecher')
+    try:
+        with pytest.raises(ConnectionError):
+            session.request_part('ab' * 32, 0, 'ff' * 32, 0, 1024, timeout=2)
+        # the session is dropped before the reply is read into memory
+        with pytest.raises(ConnectionError):
+            session.request(wire_protocol.TORRENT, bytes(32), timeout=2)
+        assert session.socket is None
+    finally:
+        session.close()
+        listener.close()
+
+
+def test_stalling_peers_get_shorter_queues():
+    data = os.urandom(256)
+    pieces = {index : hashlib.sha256(data[index * 16:index * 16 + 16]).hexdigest() for index in range(16)}
+    stall = threading.Event()
+
+    def fetch(peer : str, index : int, begin : int, length : int) -> bytes:
+        if peer == 'stalled':
+            stall.wait()
+            return None
+        return data[index * 16 + begin:index * 16 + begin + length]
+
+    try:
+        engine = DownloadEngine(pieces, range(16), {'stalled' : range(16), 'good' : range(16)}, fetch,
+                                store=lambda index, piece: None, piece_size=lambda index: 16, block_size=16,
+                                endgame_threshold=0, request_timeout=0.1)
+        assert engine.run()
+    finally:
+        stall.set()
+    stalled = engine.stats['stalled']
+    # every timeout counts as a failure and as a round trip as long as the wait
+    assert stalled.failures >= 1 and stalled.snapshot()['rtt'] >= 0.1
+    assert stalled.queue_depth(16, 8) < engine.stats['good'].queue_depth(16, 8) == 8
+
+
+@needs_peer
+def test_server_rehashes_changed_files_beside_the_event_loop(tmp_path):
+    piece_length = 1 << 14
+    data = os.urandom(8 * piece_length)
+    server, torrent = start_seeder(tmp_path, data, piece_length)
+    info_hash = torrent['info_hash']
+    payload = bytes.fromhex(info_hash)
+    assert server.handle_frame(wire_protocol.PARTS_AVAILABLE, 1, payload)[0][wire_protocol.HEADER.size:] == b'\xff'
+    # the seeded file changes behind the back of the server
+    path = tmp_path / 'seeded.bin'
+    with open(path, 'r+b') as file:
+        file.seek(3 * piece_length)
+        file.write(b'changed')
+    os.utime(path, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+
+    # a long rehash, it runs in its own thread and meanwhile nothing of the torrent is served
+    storage = server.storage(info_hash)
+    release = threading.Event()
+    rehash = storage.rehash
+    storage.rehash = lambda *args: release.wait(5) and rehash(*args)
+    bitfield = server.handle_frame(wire_protocol.PARTS_AVAILABLE, 2, payload)[0][wire_protocol.HEADER.size:]
+    assert bitfield == b'\x00' and info_hash in server.rehashing
+    part = wire_protocol.pack_part_request(info_hash, 0, 0, 16)
+    assert wire_protocol.HEADER.unpack_from(server.handle_frame(wire_protocol.PART, 3, part)[0])[0] == wire_protocol.NOT_FOUND
+    release.set()
+    deadline = time.monotonic() + 5
+    while info_hash in server.rehashing and time.monotonic() < deadline:
+        time.sleep(0.01)
+    bitfield = server.handle_frame(wire_protocol.PARTS_AVAILABLE, 4, payload)[0][wire_protocol.HEADER.size:]
+    assert bitfield == bytes([0xff & ~(0x80 >> 3)])
+
+
+def test_endgame_skips_blocks_of_pieces_stored_before_their_request_was_collected():
+    data = os.urandom(32)
+    pieces = {index : hashlib.sha256(data[index * 16:index * 16 + 16]).hexdigest() for index in range(2)}
+    engine = DownloadEngine(pieces, range(2), {'a' : range(2), 'b' : range(2)}, lambda *args: None,
+                            store=lambda index, piece: None, piece_size=lambda index: 16, block_size=8)
+    # piece 0 was stored by the worker of a's last block, its request was not collected yet
+    engine.requests[(0, 8)] = {'a'}
+    engine.missing.discard(0)
+    engine.picker.complete(0)
+    assert 0 not in engine.partial
+    assert engine._endgame_block('b') is None
+
+    # a block still missing is duplicated
+    assert engine._next_block('a') == (1, 0)
+    engine.requests[(1, 0)] = {'a'}
+    assert engine._endgame_block('b') == (1, 0)
+
+
+def test_endgame_duplicates_the_block_of_a_slow_peer_and_cancels_the_loser():
+    data = os.urandom(64)
+    pieces = {index : hashlib.sha256(data[index * 16:index * 16 + 16]).hexdigest() for index in range(4)}
+    released = threading.Event()
+    slow_blocks : List[Tuple[int, int]] = []
+    cancelled : List[Tuple[str, int, int]] = []
+    stored : Dict[int, List[bytes]] = {}
+
+    def fetch(peer : str, index : int, begin : int, length : int) -> bytes:
+        if peer == 'slow':
+            # holds the first block it is asked for until it is cancelled, its copy
+            # crossed the cancel and arrives anyway, corrupt
+            slow_blocks.append((index, begin))
+            released.wait(5)
+            return b'X' * length
+        return data[index * 16 + begin:index * 16 + begin + length]
+
+    def cancel(peer : str, index : int, begin : int, on_discard) -> None:
+        cancelled.append((peer, index, begin))
+        released.set()
+
+    engine = DownloadEngine(pieces, range(4), {'slow' : range(4), 'fast' : range(4)}, fetch,
+                            store=lambda index, piece: stored.setdefault(index, []).append(bytes(piece)),
+                            piece_size=lambda index: 16, max_in_flight_per_peer=1, cancel=cancel,
+                            endgame_threshold=2, block_size=8)
+    started = time.monotonic()
+    assert engine.run()
+
+    # the fast peer did not wait for the slow one but asked for its block too
+    assert time.monotonic() - started < 4
+    assert len(slow_blocks) == 1
+    index, begin = slow_blocks[0]
+    assert cancelled == [('slow', index, begin)]
+    assert engine.redundant_requests == 1
+    # the first verified copy is stored once, the late one is counted as wasted
+    assert stored == {i : [data[i * 16:i * 16 + 16]] for i in range(4)}
+    assert engine.redundant_bytes == 8
+
+
+@needs_peer
+def test_sessions_pipeline_blocks_cancel_and_fall_back_to_legacy_peers(tmp_path):
+    piece_length = 1 << 16
+    data = os.urandom(3 * piece_length + 1000)
+    server, torrent = start_seeder(tmp_path, data, piece_length, upload_slots=1)
+    info_hash, pieces = torrent['info_hash'], torrent['info']['pieces']
+    address = peer.Address('127.0.0.1', server.getsockname()[1])
+
+    # the $session handshake agrees on the newest version, then blocks are requested
+    # at once over the one connection
+    session = peer.PeerSession(address, 'leecher')
+    try:
+        assert session.request_parts_available(info_hash, {int(i) : h for i, h in pieces.items()}, 5) == [0, 1, 2, 3]
+        assert session.persistent and session.version == wire_protocol.PROTOCOL_VERSION
+        assert session.remote_id == 'seeder'
+        blocks = [(index, begin) for index in range(4) for begin in range(0, piece_length, 1 << 14)
+                  if index * piece_length + begin < len(data)]
+        results : Dict[Tuple[int, int], bytes] = {}
+
+        def fetch(index : int, begin : int) -> None:
+            length = min(1 << 14, len(data) - index * piece_length - begin)
+            results[(index, begin)] = bytes(session.request_part(info_hash, index, pieces[str(index)], begin, length, 5))
+
+        workers = [threading.Thread(target=fetch, args=block) for block in blocks]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(10)
+        assert all(results[(index, begin)] == data[index * piece_length + begin:][:len(results[(index, begin)])]
+                   for index, begin in blocks) and len(results) == len(blocks)
+
+        # the only upload slot is taken, a second peer is choked
+        other = peer.PeerSession(address, 'other')
+        with pytest.raises(peer.PeerChoked):
+            other.request_part(info_hash, 0, pieces['0'], 0, 1000, 5)
+        other.close()
+    finally:
+        session.close()
+
+    # a request cancelled while it is queued behind another one is dropped by the server
+    with socket.create_connection(('127.0.0.1', address.port), timeout=5) as sock:
+        sock.sendall(pickle.dumps(peer.Message('$session', {'peer_id' : 'raw', 'version' : 1})))
+        reply = peer.MessageUnpickler(sock.makefile('rb', buffering=0)).load()
+        assert reply.data['version'] == 1
+        sock.sendall(b''.join([wire_protocol.pack_frame(wire_protocol.PART, request_id,
+                                                        wire_protocol.pack_part_request(info_hash, 0, 0, 100))
+                               for request_id in (1, 2, 3)] + [wire_protocol.pack_frame(wire_protocol.CANCEL, 3)]))
+        replies = set()
+        for _ in range(3):
+            msg_type, request_id, length = wire_protocol.read_header(sock)
+            wire_protocol.recv_exact(sock, length)
+            replies.add((msg_type, request_id))
+        assert replies == {(wire_protocol.CANCEL, 3), (wire_protocol.PART, 1), (wire_protocol.PART, 2)}
+
+    # an old peer closes the connection on the handshake and is asked one pickled request at a time
+    listener, asked = start_legacy_peer(data, piece_length, pieces)
+    legacy = peer.PeerSession(peer.Address('127.0.0.1', listener.getsockname()[1]), 'leecher')
+    try:
+        assert legacy.request_parts_available(info_hash, {int(i) : h for i, h in pieces.items()}, 5) == [0, 1, 2, 3]
+        assert legacy.persistent is False
+        # the blocks of a piece are cut from the piece the old peer sent once
+        assert legacy.request_part(info_hash, 1, pieces['1'], 0, 1000, 5) == data[piece_length:piece_length + 1000]
+        assert legacy.request_part(info_hash, 1, pieces['1'], 1000, 1000, 5) == data[piece_length + 1000:piece_length + 2000]
+        assert asked == ['$session', '$parts_available', '$part']
+    finally:
+        listener.close()
+
+
+@needs_peer
+def test_piece_length_is_chosen_from_the_size_and_pieces_are_checked_against_it(tmp_path):
+    smallest, largest, most = peer.MIN_PIECE_LENGTH, peer.MAX_PIECE_LENGTH, peer.MAX_PIECES
+    assert peer.choose_piece_length(0) == smallest
+    assert peer.choose_piece_length(smallest * most) == smallest
+    assert peer.choose_piece_length(smallest * most + 1) == 2 * smallest
+    assert peer.choose_piece_length(largest * most) == largest
+    # files too large for MAX_PIECES pieces get more pieces, never larger ones
+    assert peer.choose_piece_length(largest * most * 4) == largest
+
+    path = tmp_path / 'file'
+    data = bytearray(os.urandom(4 * smallest + 100))
+    path.write_bytes(data)
+    piece_length = peer.choose_piece_length(len(data))
+    parts, _ = hash_file(str(path), piece_length)
+    info = {'length' : len(data), 'piece length' : piece_length, 'pieces' : {str(i) : h for i, h in parts.items()}}
+    assert piece_length == smallest and len(parts) == 5
+    assert peer.valid_pieces(info)
+    assert not peer.valid_pieces({**info, 'piece length' : 2 * piece_length})
+    assert not peer.valid_pieces({**info, 'piece length' : 0})
+    assert not peer.valid_pieces({**info, 'piece length' : 2 * largest, 'length' : 4 * largest})
+    assert not peer.valid_pieces({**info, 'length' : len(data) + piece_length})
+    assert not peer.valid_pieces({**info, 'pieces' : {str(i) : h for i, h in parts.items() if i != 2}})
+    assert not peer.valid_pieces({**info, 'piece length' : 'large'})
+    hasher = PieceHasher(smallest, piece_length)
+    merkle = {**info, 'meta version' : 2, 'block length' : smallest, 'pieces root' : hasher.root(info['pieces'])}
+    assert peer.valid_pieces(merkle)
+    assert not peer.valid_pieces({**merkle, 'pieces root' : '00' * 32})
+    assert not peer.valid_pieces({**merkle, 'block length' : 3000})
+
+    # one corrupted byte fails only the piece it is in, the short last piece still matches
+    data[2 * piece_length + 7] ^= 0xff
+    path.write_bytes(data)
+    pieces = [(index, FileRange(str(path), index * piece_length, min(piece_length, len(data) - index * piece_length)),
+               parts[index]) for index in parts]
+    assert verify_pieces(pieces, len(data), workers=2) == {0 : True, 1 : True, 2 : False, 3 : True, 4 : True}
+
+
+@needs_peer
+def test_torrents_of_unavailable_hash_algorithms_are_rejected_cleanly(tmp_path, monkeypatch):
+    piece_length = 1 << 14
+    data = os.urandom(2 * piece_length)
+    server, torrent = start_seeder(tmp_path, data, piece_length)
+    foreign = {**torrent, 'info' : {**torrent['info'], 'hash algorithm' : 'md5'}}
+    foreign.pop('storage')
+    assert not peer.valid_pieces(foreign['info'])
+
+    # the download fails before anything of the torrent is written
+    downloads = tmp_path / 'leecher'
+    downloads.mkdir()
+    monkeypatch.chdir(downloads)
+    node = object.__new__(peer.Peer)
+    node.announce = lambda info_hash, name, event: [{'ip' : '127.0.0.1', 'port' : server.getsockname()[1]}]
+    node.get_torrent_file = lambda info_hash, peers: json.loads(json.dumps(foreign))
+    node.storage_mode = 'file'
+    node.catalog = TorrentCatalog(str(downloads))
+    reader, writer = os.pipe()
+    try:
+        assert node.download_file(foreign['info_hash'], 'seeded.bin', writer) is None
+        assert json.loads(os.read(reader, 1024)) == {'msg' : 'failed'}
+    finally:
+        os.close(reader)
+        os.close(writer)
+    assert os.listdir(downloads) == [] and node.catalog.get(foreign['info_hash']) is None
+
+    # a seeder that has such a torrent answers for its block hashes without dropping the session
+    server.catalog.save({**foreign, 'storage' : torrent['storage']})
+    session = peer.PeerSession(peer.Address('127.0.0.1', server.getsockname()[1]), 'leecher')
+    try:
+        assert session.request_hashes(foreign['info_hash'], 0, 5) is None
+        assert session.request_part(torrent['info_hash'], 1, torrent['info']['pieces']['1'], 0, 100, 5) == \
+            data[piece_length:piece_length + 100]
+    finally:
+        session.close()
+
+
+@needs_peer
+def test_legacy_peers_send_each_piece_once_for_all_its_blocks():
+    piece_length, block_length = 1 << 16, 1 << 14
+    data = os.urandom(4 * piece_length)
+    pieces = {str(i) : hashlib.sha256(data[i * piece_length:(i + 1) * piece_length]).hexdigest() for i in range(4)}
+    listener, asked = start_legacy_peer(data, piece_length, pieces, delay=0.05)
+    legacy = peer.PeerSession(peer.Address('127.0.0.1', listener.getsockname()[1]), 'leecher')
+    blocks : Dict[Tuple[int, int], bytes] = {}
+
+    def fetch(index : int, begin : int) -> None:
+        blocks[(index, begin)] = legacy.request_part('00' * 32, index, pieces[str(index)], begin, block_length, 5)
+
+    try:
+        workers = [threading.Thread(target=fetch, args=(index, begin))
+                   for index in range(4) for begin in range(0, piece_length, block_length)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(10)
+        assert b''.join(blocks[key] for key in sorted(blocks)) == data
+        # the blocks asked for at once share the request of their piece, which is
+        # dropped once every block of it was handed out
+        assert asked.count('$part') == 4
+        assert legacy.legacy_pieces == {}
+    finally:
+        listener.close()
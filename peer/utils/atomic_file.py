@@ -0,0 +1,38 @@
+import os
+import tempfile
+
+# read once, mkstemp creates files only the owner can read, they get the mode
+# open() would give them instead
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def atomic_write(path : str, data : bytes | str) -> None:
+    """
+    Writes a file next to `path` and swaps it in, readers see the old
+    content or the new one, never half a file. The data is synced before
+    the swap, so after a crash the file is not left empty, and every write
+    goes through its own temporary file, so concurrent writers do not mix.
+
+    Args:
+        path (str): file written.
+        data (bytes | str): new content, text is written in UTF-8.
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.',
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            if hasattr(os, 'fchmod'):
+                os.fchmod(file.fileno(), 0o666 & ~UMASK)
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
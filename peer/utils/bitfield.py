@@ -0,0 +1,76 @@
+from typing import Iterable, Iterator
+
+
+class Bitfield:
+    """
+    One bit per piece of a torrent, the most significant bit of the first
+    byte is piece 0.
+
+    Args:
+        length (int): number of pieces.
+        data (bytes | None): packed bits, all pieces are unset if None.
+    """
+    def __init__(self, length : int, data : bytes | None = None) -> None:
+        self.length = length
+        size = (length + 7) // 8
+        if data is None:
+            self.data = bytearray(size)
+        else:
+            if len(data) != size:
+                raise ValueError(f'bitfield of {length} pieces needs {size} bytes, got {len(data)}')
+            self.data = bytearray(data)
+            # bits past the last piece are padding
+            if length % 8:
+                self.data[-1] &= (0xFF << (8 - length % 8)) & 0xFF
+
+
+    @classmethod
+    def from_indices(cls, length : int, indices : Iterable[int]) -> 'Bitfield':
+        bitfield = cls(length)
+        for index in indices:
+            bitfield.set(index)
+        return bitfield
+
+
+    def __len__(self) -> int:
+        return self.length
+
+
+    def __contains__(self, index : int) -> bool:
+        if not 0 <= index < self.length:
+            return False
+        return bool(self.data[index >> 3] & (0x80 >> (index & 7)))
+
+
+    def __iter__(self) -> Iterator[int]:
+        # yields the indices of the set pieces
+        for byte_index, byte in enumerate(self.data):
+            if not byte:
+                continue
+            for bit in range(8):
+                if byte & (0x80 >> bit):
+                    yield (byte_index << 3) | bit
+
+
+    def set(self, index : int) -> None:
+        if not 0 <= index < self.length:
+            raise IndexError(f'piece {index} out of range')
+        self.data[index >> 3] |= 0x80 >> (index & 7)
+
+
+    def clear(self, index : int) -> None:
+        if not 0 <= index < self.length:
+            raise IndexError(f'piece {index} out of range')
+        self.data[index >> 3] &= ~(0x80 >> (index & 7)) & 0xFF
+
+
+    def count(self) -> int:
+        return sum(bin(byte).count('1') for byte in self.data)
+
+
+    def complete(self) -> bool:
+        return self.count() == self.length
+
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.data)
@@ -0,0 +1,141 @@
+import json
+import os
+import pathlib
+from threading import Lock
+from time import monotonic
+from typing import Any, Dict, List, Tuple
+
+from utils.atomic_file import atomic_write
+from utils.storage import file_stamp
+
+# seconds between rescans of the torrent directory for files changed on disk
+RESCAN_INTERVAL = 5
+
+
+class TorrentCatalog:
+    """
+    The torrent files of a directory indexed by info hash.
+
+    Every torrent file is parsed once. Rescanning the directory only lists
+    it and compares the size and modification time of every file with the
+    ones seen before, new and changed files are parsed and removed files are
+    forgotten. Lookups and `values` rescan once `rescan_interval` seconds
+    passed since the last scan, whether the torrent is known or not, so
+    torrents copied into, edited in or removed from the directory are
+    followed without reparsing it.
+
+    Args:
+        directory (str): directory of the torrent files.
+        rescan_interval (float): seconds between rescans done by lookups.
+    """
+    def __init__(self, directory : str, rescan_interval : float = RESCAN_INTERVAL) -> None:
+        self.directory = directory
+        self.rescan_interval = rescan_interval
+        # info hash -> torrent
+        self.torrents : Dict[str, Dict[str, Any]] = {}
+        # file name -> stamp of the file when it was parsed, info hash it holds
+        self.files : Dict[str, Tuple[Dict[str, int] | None, str | None]] = {}
+        self.lock = Lock()
+        self.scanned = 0.0
+        self.refresh()
+
+
+    def refresh(self) -> None:
+        """
+        Rescans the directory for torrent files added, changed or removed on disk.
+        """
+        with self.lock:
+            self._refresh()
+
+
+    def _refresh(self) -> None:
+        self.scanned = monotonic()
+        try:
+            filenames = {filename for filename in os.listdir(self.directory) if filename.endswith('.torrent')}
+        except FileNotFoundError:
+            filenames = set()
+
+        for filename in set(self.files) - filenames:
+            _, info_hash = self.files.pop(filename)
+            self._forget(info_hash, filename)
+
+        for filename in filenames:
+            stamp = file_stamp(os.path.join(self.directory, filename))
+            known = self.files.get(filename)
+            if known is not None and known[0] == stamp:
+                continue
+            if known is not None:
+                self._forget(known[1], filename)
+            self.files[filename] = (stamp, self._load(filename))
+
+
+    def _load(self, filename : str) -> str | None:
+        try:
+            with open(os.path.join(self.directory, filename), 'r') as file:
+                torrent = json.load(file)
+            info_hash = torrent['info_hash']
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f'skipping torrent file {filename}: {e}')
+            return None
+        self.torrents[info_hash] = torrent
+        return info_hash
+
+
+    def _forget(self, info_hash : str | None, filename : str) -> None:
+        # another file may hold the same torrent
+        if info_hash is None or any(
+                other != filename and known[1] == info_hash for other, known in self.files.items()):
+            return
+        self.torrents.pop(info_hash, None)
+
+
+    def get(self, info_hash : str) -> Dict[str, Any] | None:
+        """
+        Returns:
+            Dict[str, Any] | None: the torrent with the info hash, None if there is none.
+        """
+        with self.lock:
+            self._refresh_due()
+            return self.torrents.get(info_hash)
+
+
+    def values(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            self._refresh_due()
+            return list(self.torrents.values())
+
+
+    def _refresh_due(self) -> None:
+        # called with the lock held
+        if monotonic() - self.scanned >= self.rescan_interval:
+            self._refresh()
+
+
+    def __contains__(self, info_hash : str) -> bool:
+        return self.get(info_hash) is not None
+
+
+    def __len__(self) -> int:
+        return len(self.torrents)
+
+
+    def save(self, torrent : Dict[str, Any]) -> str:
+        """
+        Writes a torrent file, named after the file of the torrent, and indexes it.
+
+        Returns:
+            str: file path of the torrent file
+        """
+        filename = pathlib.Path(torrent['info']['name']).stem + '.torrent'
+        path = os.path.join(self.directory, filename)
+        data = json.dumps(torrent)
+        with self.lock:
+            # readers never see half a torrent
+            atomic_write(path, data)
+            known = self.files.get(filename)
+            if known is not None and known[1] != torrent['info_hash']:
+                self._forget(known[1], filename)
+            self.files[filename] = (file_stamp(path), torrent['info_hash'])
+            # indexed as it reads back from the file, with string piece indices
+            self.torrents[torrent['info_hash']] = json.loads(data)
+        return path
@@ -0,0 +1,117 @@
+import random
+from time import monotonic
+from typing import Callable, Dict, Hashable, Set
+
+# peers the server uploads to at once, one of them chosen optimistically
+UPLOAD_SLOTS = 4
+# seconds between two choices of the unchoked peers
+RECHOKE_INTERVAL = 10
+# rechokes between two optimistic unchokes
+OPTIMISTIC_ROUNDS = 3
+# seconds after which the slot of an unchoked peer with no request left that stopped asking is handed on
+SLOT_IDLE_TIMEOUT = 1
+
+
+class Choker:
+    """
+    Chooses the peers the server uploads to, tit-for-tat.
+
+    Every RECHOKE_INTERVAL seconds `rechoke` unchokes the `slots - 1` peers
+    that asked for pieces and upload the fastest to us, the peers we upload
+    the fastest to win ties so a seeder keeps serving the peers that take
+    its data the quickest. The last slot is optimistic, it goes to a random
+    choked peer every `optimistic_rounds` rechokes so new peers get their
+    first pieces and faster peers can be discovered. Between rechokes a
+    peer is unchoked as soon as it asks while a slot is free, the slot of
+    a peer that has no request waiting or being answered and did not ask
+    for SLOT_IDLE_TIMEOUT seconds, because it finished or left, counts as
+    free. A peer on a slow or throttled link keeps its slot while its
+    replies are still being sent.
+
+    The requests of choked peers are refused, the server then uploads to
+    few peers at full speed and they finish early and start uploading
+    themselves, instead of splitting its upload across every peer.
+
+    Args:
+        slots (int | None): peers unchoked at once, every peer if None.
+        optimistic_rounds (int): rechokes between two optimistic unchokes.
+        rng (random.Random | None): source of the optimistic choice.
+        busy (Callable[[Hashable], bool] | None): whether requests of a peer are
+            queued or being answered, never if None.
+    """
+    def __init__(self, slots : int | None = UPLOAD_SLOTS, optimistic_rounds : int = OPTIMISTIC_ROUNDS,
+                 rng : random.Random | None = None, busy : Callable[[Hashable], bool] | None = None) -> None:
+        self.slots = None if slots is None else max(1, slots)
+        self.optimistic_rounds = max(1, optimistic_rounds)
+        self.random = rng or random.Random()
+        self.busy = busy or (lambda peer: False)
+        self.unchoked : Set[Hashable] = set()
+        self.optimistic : Hashable | None = None
+        # peers that asked for pieces since the last rechoke
+        self.interested : Set[Hashable] = set()
+        # unchoked peer -> when it last asked for a piece
+        self.last_asked : Dict[Hashable, float] = {}
+        # bytes uploaded to every peer since the last rechoke
+        self.uploaded : Dict[Hashable, int] = {}
+        self.rounds = 0
+
+
+    def allow(self, peer : Hashable) -> bool:
+        """
+        Records that a peer asked for a piece.
+
+        Returns:
+            bool: whether the peer is unchoked and the request is answered.
+        """
+        self.interested.add(peer)
+        if self.slots is None:
+            return True
+        now = monotonic()
+        if peer not in self.unchoked:
+            if len(self.unchoked) >= self.slots:
+                for other in list(self.unchoked):
+                    if now - self.last_asked.get(other, now) > SLOT_IDLE_TIMEOUT and not self.busy(other):
+                        self.unchoked.discard(other)
+                        del self.last_asked[other]
+            if len(self.unchoked) >= self.slots:
+                return False
+            self.unchoked.add(peer)
+        self.last_asked[peer] = now
+        return True
+
+
+    def sent(self, peer : Hashable, size : int) -> None:
+        self.uploaded[peer] = self.uploaded.get(peer, 0) + size
+
+
+    def remove(self, peer : Hashable) -> None:
+        self.unchoked.discard(peer)
+        self.interested.discard(peer)
+        self.uploaded.pop(peer, None)
+        self.last_asked.pop(peer, None)
+        if self.optimistic == peer:
+            self.optimistic = None
+
+
+    def rechoke(self, rates : Dict[Hashable, float]) -> None:
+        """
+        Chooses the unchoked peers among the peers that asked for pieces since
+        the last rechoke.
+
+        Args:
+            rates (Dict[Hashable, float]): peer -> bytes per second it uploads to us.
+        """
+        if self.slots is None:
+            return
+        ranked = sorted(self.interested, reverse=True,
+                        key=lambda peer: (rates.get(peer, 0.0), self.uploaded.get(peer, 0)))
+        regular = set(ranked[:self.slots - 1])
+        choked = [peer for peer in ranked if peer not in regular]
+        self.rounds += 1
+        if self.optimistic not in choked or self.rounds % self.optimistic_rounds == 0:
+            self.optimistic = self.random.choice(choked) if choked else None
+        self.unchoked = regular | ({self.optimistic} if self.optimistic is not None else set())
+        now = monotonic()
+        self.last_asked = {peer : self.last_asked.get(peer, now) for peer in self.unchoked}
+        self.interested = set()
+        self.uploaded = {}
@@ -0,0 +1,176 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+# connections kept open at most, the least recently used idle ones are closed first
+MAX_POOL_SIZE = 64
+# seconds an unused connection stays open
+POOL_IDLE_TIMEOUT = 60
+# seconds a peer is not dialled again after a failure, doubled for every further failure
+RECONNECT_BACKOFF = 1
+MAX_RECONNECT_BACKOFF = 60
+
+
+class PooledConnection:
+    def __init__(self, connection : Any) -> None:
+        self.connection = connection
+        # callers using the connection right now
+        self.users = 0
+        self.last_used = monotonic()
+        # closed once the last user releases it
+        self.broken = False
+
+
+class ConnectionPool:
+    """
+    Live connections to peers by address, shared by everything that talks
+    to them: fetching a torrent, asking for the pieces a peer has and the
+    piece requests of every download.
+
+    A connection is handed to several users at once, it has to support
+    concurrent requests like PeerSession. At most `max_size` connections
+    are kept, the least recently used idle ones are closed first, and
+    connections unused for `idle_timeout` seconds are closed on the next
+    acquire or release. A connection that fails its health check is
+    replaced, and a peer whose connection failed is not dialled again
+    before its backoff, doubled for every failure in a row, expires.
+
+    Args:
+        factory (Callable[[Hashable], Any]): opens a connection to an address.
+        max_size (int): connections kept open.
+        idle_timeout (float): seconds an unused connection is kept open.
+        backoff (float): seconds a peer is skipped after its first failure.
+        max_backoff (float): longest backoff.
+        healthy (Callable[[Any], bool] | None): health check of a pooled connection.
+        close (Callable[[Any], None] | None): closes a connection, its `close` method if None.
+    """
+    def __init__(self, factory : Callable[[Hashable], Any], max_size : int = MAX_POOL_SIZE,
+                 idle_timeout : float = POOL_IDLE_TIMEOUT, backoff : float = RECONNECT_BACKOFF,
+                 max_backoff : float = MAX_RECONNECT_BACKOFF,
+                 healthy : Callable[[Any], bool] | None = None,
+                 close : Callable[[Any], None] | None = None) -> None:
+        self.factory = factory
+        self.max_size = max(1, max_size)
+        self.idle_timeout = idle_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.healthy = healthy
+        self.close_connection = close or (lambda connection: connection.close())
+        self.entries : OrderedDict[Hashable, PooledConnection] = OrderedDict()
+        # address -> failures in a row, time before which it is not dialled again
+        self.failures : Dict[Hashable, Tuple[int, float]] = {}
+        self.lock = Lock()
+
+
+    def acquire(self, key : Hashable) -> Any:
+        """
+        Returns the pooled connection to an address, opened if there is none,
+        every acquire has to be paired with a release.
+
+        Raises:
+            ConnectionError: the address failed recently and is backing off.
+        """
+        with self.lock:
+            self._sweep()
+            retry_at = self.failures.get(key, (0, 0.0))[1]
+            if monotonic() < retry_at:
+                raise ConnectionError(f'{key} failed recently, retrying in {retry_at - monotonic():.1f}s')
+            pooled = self.entries.get(key)
+        # checked without the lock, a slow check of one connection does not hold up the others
+        healthy = pooled is None or (not pooled.broken and (self.healthy is None or self.healthy(pooled.connection)))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry is pooled and not healthy:
+                self._drop(key)
+                entry = None
+            if entry is None:
+                entry = PooledConnection(self.factory(key))
+                self.entries[key] = entry
+            self.entries.move_to_end(key)
+            entry.users += 1
+            entry.last_used = monotonic()
+            self._evict(self.max_size)
+            return entry.connection
+
+
+    def release(self, key : Hashable) -> None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            entry.users -= 1
+            entry.last_used = monotonic()
+            if entry.broken and not entry.users:
+                self._drop(key)
+            self._sweep()
+
+
+    def succeeded(self, key : Hashable) -> None:
+        with self.lock:
+            self.failures.pop(key, None)
+
+
+    def failed(self, key : Hashable) -> None:
+        """
+        Records that the connection to an address failed. It is closed once
+        nobody uses it and the address backs off.
+        """
+        with self.lock:
+            count = self.failures.get(key, (0, 0.0))[0] + 1
+            delay = min(self.max_backoff, self.backoff * 2 ** (count - 1))
+            self.failures[key] = (count, monotonic() + delay)
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            entry.broken = True
+            if not entry.users:
+                self._drop(key)
+
+
+    def backing_off(self, key : Hashable) -> bool:
+        with self.lock:
+            return monotonic() < self.failures.get(key, (0, 0.0))[1]
+
+
+    def _drop(self, key : Hashable) -> None:
+        entry = self.entries.pop(key)
+        try:
+            self.close_connection(entry.connection)
+        except OSError:
+            pass
+
+
+    def _evict(self, limit : int) -> None:
+        for key in list(self.entries):
+            if len(self.entries) <= limit:
+                break
+            if not self.entries[key].users:
+                self._drop(key)
+
+
+    def _sweep(self) -> None:
+        now = monotonic()
+        for key, entry in list(self.entries.items()):
+            if not entry.users and now - entry.last_used >= self.idle_timeout:
+                self._drop(key)
+
+
+    def connections(self) -> Dict[Hashable, Any]:
+        """
+        Returns:
+            Dict[Hashable, Any]: address -> connection of every pooled connection.
+        """
+        with self.lock:
+            return {key : entry.connection for key, entry in self.entries.items()}
+
+
+    def close(self) -> None:
+        with self.lock:
+            for key in list(self.entries):
+                self._drop(key)
+            self.failures.clear()
+
+
+    def __len__(self) -> int:
+        return len(self.entries)
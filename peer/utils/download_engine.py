@@ -0,0 +1,686 @@
+import queue
+from concurrent.futures import ThreadPoolExecutor, Future, CancelledError, InvalidStateError, wait, FIRST_COMPLETED
+from threading import Lock
+from time import monotonic
+from typing import Callable, Dict, Hashable, Iterable, List, Set, Tuple
+
+from utils.peer_stats import PeerStats
+from utils.piece_hash import PieceHasher
+from utils.piece_picker import PiecePicker
+
+# maximum number of block requests in flight across all peers
+MAX_IN_FLIGHT = 32
+# maximum number of block requests in flight to a single peer
+MAX_IN_FLIGHT_PER_PEER = 8
+# bytes of a block, the unit pieces are requested in
+BLOCK_SIZE = 1 << 16
+# consecutive connection failures after which a peer is dropped
+MAX_PEER_FAILURES = 3
+# seconds a peer is not asked again after a failed request, doubled for every further failure
+PEER_BACKOFF = 0.25
+# seconds a peer that choked us is not asked again
+CHOKE_BACKOFF = 0.25
+# seconds a block request may run before it fails and its block is requested from another peer
+REQUEST_TIMEOUT = 10
+# seconds a stopped download waits for the requests running before it gives them up
+STOP_TIMEOUT = 2
+# below this many missing pieces every peer holding one is asked for it
+ENDGAME_THRESHOLD = 8
+# corrupt pieces after which the peer that sent them is dropped
+MAX_BAD_PIECES = 3
+# times a piece may fail its hash before the download gives up
+MAX_HASH_FAILURES = 5
+
+
+class PeerChoked(ConnectionError):
+    """
+    Raised by `fetch` when the peer refused the request because it does not
+    upload to us right now.
+    """
+
+
+class StorageError(Exception):
+    """
+    Raised when a verified piece cannot be stored, for example because the
+    disk is full. It ends the download, the peer that sent the piece is not
+    at fault.
+    """
+
+
+class CorruptPieceError(Exception):
+    """
+    Raised when a piece failed its hash MAX_HASH_FAILURES times, none of the
+    peers asked for it sends a good copy. It ends the download.
+    """
+
+
+class PartialPiece:
+    """
+    Buffer a piece is assembled in from its blocks, the blocks of one piece
+    can come from different peers.
+
+    Args:
+        size (int): size of the piece in bytes.
+        block_size (int): size of a block, the last block can be shorter.
+    """
+    def __init__(self, size : int, block_size : int) -> None:
+        self.data = bytearray(size)
+        # offset of every block in the piece -> its size
+        self.blocks : Dict[int, int] = {begin : min(block_size, size - begin) for begin in range(0, size, block_size)}
+        self.unrequested : List[int] = []
+        self.received : Set[int] = set()
+        # blocks added before the block hashes of the piece were known
+        self.unchecked : Set[int] = set()
+        # block hashes of a Merkle piece, checked against the piece hash
+        self.leaves : List[bytes] | None = None
+        # peers asked for the block hashes, one at a time
+        self.asked : Set[Hashable] = set()
+        self.asking = False
+        # whether the piece matched its hash, None until every block arrived and it was checked
+        self.verified : bool | None = None
+        # peers that sent the blocks received since the last reset
+        self.senders : Set[Hashable] = set()
+        # times the piece did not match its hash
+        self.failures = 0
+        # a piece that failed its hash is downloaded again from one peer, `owner`,
+        # so a copy that fails again tells which peer sends corrupt data
+        self.single = False
+        self.owner : Hashable | None = None
+        self.reset()
+
+
+    def next_block(self) -> int | None:
+        """
+        Returns:
+            int | None: offset of the first block not requested yet, None if every
+            block is requested or received.
+        """
+        return self.unrequested.pop() if self.unrequested else None
+
+
+    def add(self, begin : int, data : bytes, checked : bool = False) -> bool:
+        """
+        Copies a block into the piece.
+
+        Args:
+            begin (int): offset of the block.
+            data (bytes): data of the block.
+            checked (bool): whether the block was verified against its block hash.
+
+        Returns:
+            bool: False if the block was received before.
+        """
+        if begin in self.received:
+            return False
+        self.data[begin:begin + len(data)] = data
+        self.received.add(begin)
+        if not checked:
+            self.unchecked.add(begin)
+        return True
+
+
+    def complete(self) -> bool:
+        return len(self.received) == len(self.blocks)
+
+
+    def reset(self) -> None:
+        # popped from the end, so blocks are requested in order
+        self.unrequested = sorted(self.blocks, reverse=True)
+        self.received.clear()
+        self.unchecked.clear()
+        self.senders.clear()
+        self.owner = None
+        self.verified = None
+
+
+class DownloadEngine:
+    """
+    Downloads the missing pieces of a torrent from several peers at once.
+
+    Pieces are requested in blocks of `block_size` bytes. Blocks are fetched
+    by a pool of worker threads, every worker runs one blocking `fetch` call.
+    The scheduler keeps at most `max_in_flight` requests running in total and
+    at most `max_in_flight_per_peer` requests running against a single peer,
+    fewer for slow or failing peers, see PeerStats.queue_depth.
+    A peer first gets the unrequested blocks of pieces already started, so
+    the blocks of one piece spread over every peer holding it, and otherwise
+    starts the rarest piece it holds, chosen by a PiecePicker. Blocks are
+    assembled in a PartialPiece and a piece is verified once its last block
+    arrived. A failed request only puts its block back, a piece that does not
+    match its hash is downloaded again, from a single peer so that a copy
+    that fails again tells which peer sent it. A peer that sent
+    MAX_BAD_PIECES corrupt pieces is dropped, and a piece that failed
+    MAX_HASH_FAILURES times ends the download with a CorruptPieceError in
+    `error`. A peer whose request failed is not
+    asked again for PEER_BACKOFF seconds, doubled for every failure in a row,
+    and it is dropped after MAX_PEER_FAILURES failures in a row. A peer that
+    choked us is asked again after CHOKE_BACKOFF seconds, which does not
+    count as a failure. A request that did not finish by its deadline, a
+    few round trips of the peer and at most `request_timeout` seconds (see
+    PeerStats.timeout), fails the same way, its block is requested from
+    another peer and the request is cancelled, a worker stuck in a peer
+    that stalled is not waited for.
+
+    Once fewer than `endgame_threshold` pieces are missing, peers with free
+    request slots also ask for blocks already requested from other peers. The
+    first copy wins, the other requests are cancelled and the bytes spent on
+    copies that were not needed are counted in `redundant_bytes`.
+
+    Pieces of Merkle torrents are requested in the blocks of their tree. The
+    block hashes of a piece are fetched from the first peer asked for one of
+    its blocks and checked against the piece hash, every block is then
+    verified as it arrives and a corrupt block is requested again alone.
+
+    The download does not have to wait for every peer to tell which pieces
+    it holds. `pending_peers` peers are still being asked when `run` starts,
+    their answers are handed over with `add_peer` from any thread and merged
+    into the picker as they arrive. The download only gives up once no
+    request is running and no answer is outstanding.
+
+    A `sequential` download picks the pieces in order, a few pieces ahead
+    of a playback cursor, instead of rarest first, so a streamed file can
+    be read while it downloads. `set_cursor` moves the cursor from any
+    thread when the reader seeks.
+
+    Args:
+        pieces (Dict[int, str]): piece index -> expected hex digest.
+        missing (Iterable[int]): indices of the pieces that still need to be downloaded.
+        availability (Dict[Hashable, Iterable[int]]): peer -> indices of the pieces it holds,
+            known when the download starts.
+        fetch (Callable[[Hashable, int, int, int], bytes | None]): fetches the block of a
+            piece at an offset with a size from a peer, returns None if the peer does not
+            have the piece, raises PeerChoked if the peer refused the request and OSError
+            on connection errors.
+        store (Callable[[int, bytes], None]): stores a verified piece, raises OSError if
+            it cannot be written, which ends the download with the error in `error`.
+        piece_size (Callable[[int], int]): size of a piece in bytes.
+        max_in_flight (int): global limit of concurrent requests.
+        max_in_flight_per_peer (int): per peer limit of concurrent requests.
+        on_progress (Callable[[int, int], None] | None): called with (downloaded, total)
+            every time a piece is stored.
+        cancel (Callable[[Hashable, int, int, Callable[[int], None]], None] | None): cancels
+            the request of the block of a piece at an offset from a peer, the callback it
+            gets is called with the size of data that still arrives for the cancelled request.
+        endgame_threshold (int): missing pieces below which endgame mode starts.
+        block_size (int): bytes of a block, the block length of a Merkle torrent replaces it.
+        hasher (PieceHasher | None): hashes the pieces, flat sha256 if None.
+        fetch_hashes (Callable[[Hashable, int], List[bytes] | None] | None): fetches the
+            block hashes of a piece of a Merkle torrent from a peer, returns None if the
+            peer cannot send them, the blocks of the piece are then checked together.
+        pending_peers (int): peers whose pieces are passed to `add_peer` later.
+        stats (Callable[[Hashable], PeerStats] | None): statistics the requests to a peer
+            are recorded in, kept by the engine if None.
+        sequential (bool): picks the pieces from the start of the torrent on in order.
+        request_timeout (float): seconds a block request may run at most before it fails.
+    """
+    def __init__(self, pieces : Dict[int, str], missing : Iterable[int],
+                 availability : Dict[Hashable, Iterable[int]],
+                 fetch : Callable[[Hashable, int, int, int], bytes | None],
+                 store : Callable[[int, bytes], None],
+                 piece_size : Callable[[int], int],
+                 max_in_flight : int = MAX_IN_FLIGHT,
+                 max_in_flight_per_peer : int = MAX_IN_FLIGHT_PER_PEER,
+                 on_progress : Callable[[int, int], None] | None = None,
+                 cancel : Callable[[Hashable, int, int, Callable[[int], None]], None] | None = None,
+                 endgame_threshold : int = ENDGAME_THRESHOLD,
+                 block_size : int = BLOCK_SIZE,
+                 hasher : PieceHasher | None = None,
+                 fetch_hashes : Callable[[Hashable, int], List[bytes] | None] | None = None,
+                 pending_peers : int = 0,
+                 stats : Callable[[Hashable], PeerStats] | None = None,
+                 sequential : bool = False,
+                 request_timeout : float = REQUEST_TIMEOUT) -> None:
+        self.pieces = pieces
+        self.missing : Set[int] = set(missing)
+        self.total = len(self.missing)
+        self.fetch = fetch
+        self.store = store
+        self.piece_size = piece_size
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_in_flight_per_peer = max(1, max_in_flight_per_peer)
+        self.on_progress = on_progress
+        self.cancel = cancel
+        self.endgame_threshold = endgame_threshold
+        self.hasher = hasher or PieceHasher()
+        self.fetch_hashes = fetch_hashes if self.hasher.merkle else None
+        self.block_size = self.hasher.block_length if self.hasher.merkle else max(1, block_size)
+
+        self.picker = PiecePicker(len(pieces), self.missing)
+        if sequential:
+            self.picker.set_cursor(0)
+        for peer, indices in availability.items():
+            self.picker.add_peer(peer, indices)
+        self.failures : Dict[Hashable, int] = {peer : 0 for peer in availability}
+        # peer -> pieces it sent corrupt
+        self.bad_pieces : Dict[Hashable, int] = {}
+        # peer -> time before which it is not asked again
+        self.retry_at : Dict[Hashable, float] = {}
+        self.stats : Dict[Hashable, PeerStats] = {}
+        self.new_stats = stats or (lambda peer: PeerStats())
+        self.in_flight : Dict[Future, Tuple[Hashable, int, int]] = {}
+        self.request_timeout = request_timeout
+        # request -> time it started and time it fails if it did not finish
+        self.deadlines : Dict[Future, Tuple[float, float]] = {}
+        # requests that failed by their deadline and whose workers did not return yet
+        self.expired : Set[Future] = set()
+        self.per_peer : Dict[Hashable, int] = {peer : 0 for peer in availability}
+        # pieces started and not stored yet
+        self.partial : Dict[int, PartialPiece] = {}
+        # (piece, offset) of a block -> peers it is currently requested from
+        self.requests : Dict[Tuple[int, int], Set[Hashable]] = {}
+
+        self.lock = Lock()
+        self.redundant_requests = 0
+        self.redundant_bytes = 0
+
+        # answers of peers that were still being asked for their pieces
+        self.pending_peers = pending_peers
+        self.arrivals : queue.SimpleQueue = queue.SimpleQueue()
+        # done when an answer arrived or the download was stopped, wakes up the scheduler
+        self.wakeup : Future = Future()
+        self.stopped = False
+        self.stop_timeout = STOP_TIMEOUT
+        # why the download could not finish, it ended with it
+        self.error : StorageError | CorruptPieceError | None = None
+        # piece the cursor is moved to by the scheduler
+        self.seek : int | None = None
+
+
+    def add_peer(self, peer : Hashable, indices : Iterable[int] | None) -> None:
+        """
+        Hands over the pieces of one of the `pending_peers`, it can be called
+        from any thread while the download runs.
+
+        Args:
+            peer (Hashable): the peer.
+            indices (Iterable[int] | None): indices of the pieces it holds, None
+                if it could not be asked.
+        """
+        self.arrivals.put((peer, None if indices is None else list(indices)))
+        self._wake()
+
+
+    def stop(self, timeout : float = STOP_TIMEOUT) -> None:
+        """
+        Stops the download from any thread, `run` returns once the requests
+        running finished, or after `timeout` seconds for requests that stall.
+        The pieces stored so far stay stored.
+        """
+        self.stop_timeout = timeout
+        self.stopped = True
+        self._wake()
+
+
+    def set_cursor(self, index : int) -> None:
+        """
+        Moves the playback cursor to a piece from any thread, the pieces from
+        it on are requested next.
+        """
+        with self.lock:
+            self.seek = index
+        self._wake()
+
+
+    def _wake(self) -> None:
+        with self.lock:
+            wakeup = self.wakeup
+        try:
+            wakeup.set_result(None)
+        except InvalidStateError:
+            # the scheduler is awake already
+            pass
+
+
+    def run(self) -> bool:
+        """
+        Downloads pieces until none are missing, no peer can provide them or
+        the download is stopped.
+
+        Returns:
+            bool: True if every missing piece was downloaded.
+        """
+        pool = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        try:
+            while self.missing and not self.stopped:
+                self._merge_arrivals()
+                self._expire()
+                self._schedule(pool)
+                delay = self._next_timeout()
+                # expired requests only hold workers, nothing is waited for from them
+                if len(self.in_flight) == len(self.expired) and not self.pending_peers and delay is None:
+                    return False
+
+                done, _ = wait([*self.in_flight, self.wakeup], timeout=delay, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future is not self.wakeup:
+                        self._complete(future)
+            self._collect()
+        finally:
+            # workers stuck in a stalled fetch are left behind
+            pool.shutdown(wait=False, cancel_futures=True)
+        return not self.missing
+
+
+    def _collect(self) -> None:
+        # the requests still running are collected so their pieces are stored, up to
+        # their deadline or the stop timeout, the rest are cancelled
+        running = [future for future in self.in_flight if future not in self.expired]
+        timeout = max((self.deadlines[future][1] for future in running), default=monotonic()) - monotonic()
+        if self.stopped:
+            timeout = min(timeout, self.stop_timeout)
+        done, _ = wait(running, timeout=max(0.0, timeout))
+        for future in list(self.in_flight):
+            if future in done:
+                self._complete(future)
+            elif self.cancel:
+                peer, index, begin = self.in_flight[future]
+                self.cancel(peer, index, begin, self._add_redundant_bytes)
+
+
+    def _merge_arrivals(self) -> None:
+        # the wakeup is replaced before the queue is drained so no answer is missed
+        if self.wakeup.done():
+            with self.lock:
+                self.wakeup = Future()
+        with self.lock:
+            seek, self.seek = self.seek, None
+        if seek is not None:
+            self.picker.set_cursor(seek)
+        while True:
+            try:
+                peer, indices = self.arrivals.get_nowait()
+            except queue.Empty:
+                return
+            self.pending_peers -= 1
+            if indices is None:
+                continue
+            self.picker.add_peer(peer, indices)
+            self.failures.setdefault(peer, 0)
+            self.per_peer.setdefault(peer, 0)
+
+
+    def _next_timeout(self) -> float | None:
+        # seconds until the first peer backing off can be asked again or the first request expires
+        now = monotonic()
+        delays = [retry_at - now for peer, retry_at in self.retry_at.items()
+                  if retry_at > now and peer in self.picker.peers]
+        delays.extend(deadline - now for _, deadline in self.deadlines.values())
+        return max(0.0, min(delays)) if delays else None
+
+
+    def _expire(self) -> None:
+        # requests past their deadline fail, the worker may stay stuck in fetch
+        now = monotonic()
+        for future, (started, deadline) in list(self.deadlines.items()):
+            if deadline > now:
+                continue
+            del self.deadlines[future]
+            self.expired.add(future)
+            peer, index, begin = self.in_flight[future]
+            print(f"block {begin} of piece {index} from {peer} timed out after {now - started:.1f}s")
+            self._forget_request(peer, index, begin)
+            self._release_block(index, begin)
+            # the wait counts as a round trip too, the next deadline of the peer is longer
+            self._peer_failed(peer, now - started)
+            if self.cancel:
+                self.cancel(peer, index, begin, self._add_redundant_bytes)
+
+
+    def _peer_failed(self, peer : Hashable, elapsed : float | None = None) -> None:
+        self.stats[peer].failed(elapsed)
+        self.failures[peer] += 1
+        if self.failures[peer] >= MAX_PEER_FAILURES:
+            self.picker.remove_peer(peer)
+        else:
+            self.retry_at[peer] = monotonic() + PEER_BACKOFF * 2 ** (self.failures[peer] - 1)
+
+
+    def _forget_request(self, peer : Hashable, index : int, begin : int) -> None:
+        requested = self.requests.get((index, begin))
+        if requested is not None:
+            requested.discard(peer)
+            if not requested:
+                del self.requests[(index, begin)]
+
+
+    def _peer_stats(self, peer : Hashable) -> PeerStats:
+        # created by the scheduler before the first request to the peer runs
+        stats = self.stats.get(peer)
+        if stats is None:
+            stats = self.stats[peer] = self.new_stats(peer)
+        return stats
+
+
+    def _schedule(self, pool : ThreadPoolExecutor) -> None:
+        # hand out requests round robin so every peer gets a share
+        now = monotonic()
+        depths = {
+            peer : self._peer_stats(peer).queue_depth(self.block_size, self.max_in_flight_per_peer)
+            for peer in self.picker.peers if self.retry_at.get(peer, 0.0) <= now
+        }
+        scheduled = True
+        while scheduled and len(self.in_flight) < self.max_in_flight:
+            scheduled = False
+            for peer, depth in depths.items():
+                if len(self.in_flight) >= self.max_in_flight:
+                    break
+                if self.per_peer[peer] >= depth:
+                    continue
+                block = self._next_block(peer)
+                if block is None and len(self.missing) < self.endgame_threshold:
+                    block = self._endgame_block(peer)
+                if block is None:
+                    continue
+
+                index, begin = block
+                length = self.partial[index].blocks[begin]
+                future = pool.submit(self._download_block, peer, index, begin, length)
+                self.in_flight[future] = (peer, index, begin)
+                started = monotonic()
+                self.deadlines[future] = (started, started + self._peer_stats(peer).timeout(self.request_timeout))
+                self.per_peer[peer] += 1
+                self.requests.setdefault(block, set()).add(peer)
+                scheduled = True
+
+
+    def _next_block(self, peer : Hashable) -> Tuple[int, int] | None:
+        # pieces already started are finished before new ones are started
+        have = self.picker.peers.get(peer, set())
+        for index, piece in self.partial.items():
+            if piece.owner is not None and piece.owner not in self.picker.peers:
+                # the peer a piece was downloaded from alone is gone, another one takes over
+                piece.owner = None
+            if piece.unrequested and index in have and piece.owner in (None, peer):
+                if piece.single:
+                    piece.owner = peer
+                return index, piece.next_block()
+
+        index = self.picker.pick(peer)
+        if index is None:
+            return None
+        piece = PartialPiece(self.piece_size(index), self.block_size)
+        self.partial[index] = piece
+        return index, piece.next_block()
+
+
+    def _endgame_block(self, peer : Hashable) -> Tuple[int, int] | None:
+        # the requested block of a piece the peer holds with the fewest requests running
+        have = self.picker.peers.get(peer, set())
+        candidates = [
+            block for block, peers in self.requests.items()
+            if block[0] in have and peer not in peers
+            # the block may have arrived while its request was not collected yet
+            and block[0] in self.partial and block[1] not in self.partial[block[0]].received
+            # a piece that failed its hash stays with one peer
+            and not self.partial[block[0]].single
+        ]
+        if not candidates:
+            return None
+        self.redundant_requests += 1
+        return min(candidates, key=lambda block: len(self.requests[block]))
+
+
+    def _download_block(self, peer : Hashable, index : int, begin : int, length : int) -> bool | None:
+        """
+        Fetches a block, the worker that adds the last block of a piece
+        verifies the piece and stores it.
+
+        Returns:
+            bool | None: True if the block was added to its piece, False if the peer
+            does not have the piece or sent a block of the wrong size, None if another
+            copy of the block arrived first.
+
+        Raises:
+            ConnectionError: the block does not match its block hash, or the block
+                hashes the peer sent do not match the piece.
+        """
+        with self.lock:
+            piece = self.partial.get(index)
+            ask = (self.fetch_hashes is not None and piece is not None and piece.leaves is None
+                   and not piece.asking and peer not in piece.asked)
+            if ask:
+                piece.asked.add(peer)
+                piece.asking = True
+        if ask:
+            try:
+                leaves = self.fetch_hashes(peer, index)
+            finally:
+                piece.asking = False
+            if leaves is not None:
+                if len(leaves) != len(piece.blocks) or self.hasher.leaves_root(leaves) != self.pieces[index]:
+                    # counts as a failed request of the peer, another peer is asked for them
+                    raise ConnectionError(f'block hashes of piece {index} do not match the piece')
+                piece.leaves = leaves
+        started = monotonic()
+        try:
+            data = self.fetch(peer, index, begin, length)
+        except CancelledError:
+            return None
+        if data is None or len(data) != length:
+            return False
+        self.stats[peer].succeeded(length, started)
+        checked = piece is not None and piece.leaves is not None
+        if checked and not self.hasher.verify_block(data, piece.leaves, begin):
+            # counts as a failed request of the peer, only this block is requested again
+            raise ConnectionError('block does not match its hash')
+        with self.lock:
+            piece = self.partial.get(index)
+            if piece is None or not piece.add(begin, data, checked):
+                self.redundant_bytes += len(data)
+                return None
+            piece.senders.add(peer)
+            if not piece.complete():
+                return True
+        # the blocks of a piece with known block hashes were verified as they arrived
+        verified = ((piece.leaves is not None and not piece.unchecked)
+                    or self.hasher.digest(piece.data) == self.pieces[index])
+        if verified:
+            try:
+                self.store(index, piece.data)
+            except OSError as e:
+                raise StorageError(f'cannot store piece {index}: {e}') from e
+        piece.verified = verified
+        return True
+
+
+    def _add_redundant_bytes(self, size : int) -> None:
+        with self.lock:
+            self.redundant_bytes += size
+
+
+    def _complete(self, future : Future) -> None:
+        peer, index, begin = self.in_flight.pop(future)
+        self.per_peer[peer] -= 1
+        self.deadlines.pop(future, None)
+        # an expired request was counted as failed when it expired, only a block
+        # that still arrived is kept
+        expired = future in self.expired
+        self.expired.discard(future)
+        self._forget_request(peer, index, begin)
+
+        try:
+            added = future.result()
+        except PeerChoked:
+            if not expired:
+                self._release_block(index, begin)
+                self.retry_at[peer] = monotonic() + CHOKE_BACKOFF
+            return
+        except StorageError as e:
+            # asking other peers would not help, the download stops with the cause
+            print(f"Error storing the download: {e}")
+            self._give_up(e)
+            return
+        except Exception as e:
+            if expired:
+                return
+            # connection errors, broken replies and anything else a worker raises
+            # count against the peer, the download goes on with the others
+            print(f"Error downloading block {begin} of piece {index} from {peer}: {e!r}")
+            self._release_block(index, begin)
+            self._peer_failed(peer)
+            return
+
+        if not expired:
+            self.failures[peer] = 0
+            self.retry_at.pop(peer, None)
+        if added is None or (expired and not added):
+            return
+        if not added:
+            # the peer does not have the piece or sent broken data
+            self._release_block(index, begin)
+            self.picker.peer_lost(peer, index)
+            return
+
+        # the duplicates of an endgame block are not needed anymore
+        for other in self.requests.pop((index, begin), set()):
+            if self.cancel:
+                self.cancel(other, index, begin, self._add_redundant_bytes)
+
+        # pieces are checked by the worker adding their last block, which may
+        # still be running or may have been collected already
+        piece = self.partial.get(index)
+        if piece is None or piece.verified is None:
+            return
+        if not piece.verified:
+            self._piece_failed(index, piece)
+            return
+
+        del self.partial[index]
+        self.picker.complete(index)
+        self.missing.discard(index)
+        if self.on_progress:
+            self.on_progress(self.total - len(self.missing), self.total)
+
+
+    def _piece_failed(self, index : int, piece : PartialPiece) -> None:
+        piece.failures += 1
+        if piece.failures >= MAX_HASH_FAILURES:
+            self._give_up(CorruptPieceError(f'piece {index} did not match its hash {piece.failures} times'))
+            return
+        print(f"piece {index} does not match its hash, downloading it again")
+        # any of several peers that sent a block may be at fault, the piece is downloaded
+        # again from one peer, a peer that sent a whole corrupt piece alone is to blame
+        if len(piece.senders) == 1:
+            peer = next(iter(piece.senders))
+            self.bad_pieces[peer] = self.bad_pieces.get(peer, 0) + 1
+            if self.bad_pieces[peer] >= MAX_BAD_PIECES:
+                print(f"dropping {peer}, it sent {self.bad_pieces[peer]} corrupt pieces")
+                self.picker.remove_peer(peer)
+            else:
+                self.retry_at[peer] = monotonic() + PEER_BACKOFF * 2 ** (self.bad_pieces[peer] - 1)
+        piece.single = True
+        piece.reset()
+
+
+    def _give_up(self, error : StorageError | CorruptPieceError) -> None:
+        self.error = self.error or error
+        self.stop()
+
+
+    def _release_block(self, index : int, begin : int) -> None:
+        # the block is requested again unless a copy is still on its way
+        piece = self.partial.get(index)
+        if piece is None or begin in piece.received or (index, begin) in self.requests:
+            return
+        if begin not in piece.unrequested:
+            piece.unrequested.append(begin)
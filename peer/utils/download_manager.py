@@ -0,0 +1,235 @@
+import json
+import os
+from dataclasses import dataclass, asdict
+from threading import Lock, Thread
+from typing import Any, Callable, Dict, List, Set
+
+from utils.atomic_file import atomic_write
+
+# torrents downloaded at the same time, the others wait in the queue
+MAX_ACTIVE_DOWNLOADS = 3
+# finished and failed torrents kept in the queue, the oldest are dropped first
+MAX_FINISHED_JOBS = 100
+
+QUEUED = 'queued'
+ACTIVE = 'active'
+PAUSED = 'paused'
+DONE = 'done'
+FAILED = 'failed'
+
+
+@dataclass
+class DownloadJob:
+    info_hash : str
+    name : str
+    # higher priorities start first, ties in the order the torrents were added
+    priority : int = 0
+    state : str = QUEUED
+    order : int = 0
+    # pieces are downloaded in order so the file can be streamed, see Peer.stream
+    sequential : bool = False
+    # progress of the download is written to it, see Peer.download_file
+    pipe : int | None = None
+
+
+class DownloadManager:
+    """
+    Queue of the torrents a peer downloads.
+
+    At most `max_active` torrents download at once, each from its own
+    thread, and they share the connection pool and the bandwidth limits of
+    the peer. Whenever a download finishes, fails or is paused, the queued
+    torrent with the highest priority starts. A paused torrent keeps its
+    verified pieces and continues where it stopped once it is resumed.
+
+    The queue is saved to `path` on every change. Torrents that were
+    downloading when the peer stopped are queued again when it is loaded,
+    `start` begins the downloads. Only the last `max_finished` torrents that
+    finished or failed are kept.
+
+    A download that raises fails, `{'msg' : 'failed'}` is written to the pipe
+    of its job like for any other failed download.
+
+    Args:
+        path (str): file the queue is saved to.
+        run (Callable[[DownloadJob], bool]): downloads a torrent, returns True on success.
+        stop (Callable[[str], None]): stops the running download of an info hash.
+        max_active (int): torrents downloaded at once.
+        max_finished (int): finished and failed torrents kept in the queue.
+    """
+    def __init__(self, path : str, run : Callable[[DownloadJob], bool], stop : Callable[[str], None],
+                 max_active : int = MAX_ACTIVE_DOWNLOADS, max_finished : int = MAX_FINISHED_JOBS) -> None:
+        self.path = path
+        self.run = run
+        self.stop = stop
+        self.max_active = max(1, max_active)
+        self.max_finished = max(0, max_finished)
+        self.jobs : Dict[str, DownloadJob] = {}
+        # info hashes with a download thread, a paused torrent resumed before its
+        # download stopped waits for it
+        self.running : Set[str] = set()
+        self.lock = Lock()
+        self.started = False
+        self.load()
+
+
+    def load(self) -> None:
+        try:
+            with open(self.path, 'r') as file:
+                records = json.load(file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f'skipping download queue {self.path}: {e}')
+            return
+        with self.lock:
+            for record in records:
+                job = DownloadJob(**record)
+                if job.state == ACTIVE:
+                    job.state = QUEUED
+                self.jobs[job.info_hash] = job
+            self._prune()
+
+
+    def save(self) -> None:
+        # called with the lock held
+        records = [{key : value for key, value in asdict(job).items() if key != 'pipe'} for job in self.jobs.values()]
+        atomic_write(self.path, json.dumps(records))
+
+
+    def start(self) -> None:
+        with self.lock:
+            self.started = True
+            self._fill()
+
+
+    def add(self, info_hash : str, name : str, priority : int = 0, pipe : int | None = None,
+            sequential : bool = False) -> DownloadJob:
+        """
+        Queues a torrent, a torrent already queued, paused or failed is queued
+        again with the new priority. A sequential download stays sequential.
+        """
+        with self.lock:
+            job = self.jobs.get(info_hash)
+            if job is None or job.state in (DONE, FAILED):
+                order = max((other.order for other in self.jobs.values()), default=0) + 1
+                job = self.jobs[info_hash] = DownloadJob(info_hash, name, priority, QUEUED, order, sequential, pipe)
+            else:
+                job.priority = priority
+                job.sequential = job.sequential or sequential
+                job.pipe = pipe if pipe is not None else job.pipe
+                if job.state == PAUSED:
+                    job.state = QUEUED
+            self.save()
+            self._fill()
+            return job
+
+
+    def pause(self, info_hash : str) -> None:
+        with self.lock:
+            job = self.jobs.get(info_hash)
+            if job is None or job.state not in (QUEUED, ACTIVE):
+                return
+            active = job.state == ACTIVE
+            job.state = PAUSED
+            self.save()
+        if active:
+            # its thread starts the next torrent once the download stopped
+            self.stop(info_hash)
+
+
+    def resume(self, info_hash : str) -> None:
+        with self.lock:
+            job = self.jobs.get(info_hash)
+            if job is None or job.state != PAUSED:
+                return
+            job.state = QUEUED
+            self.save()
+            self._fill()
+
+
+    def remove(self, info_hash : str) -> None:
+        self.pause(info_hash)
+        with self.lock:
+            self.jobs.pop(info_hash, None)
+            self.save()
+
+
+    def set_priority(self, info_hash : str, priority : int) -> None:
+        with self.lock:
+            job = self.jobs.get(info_hash)
+            if job is not None:
+                job.priority = priority
+                self.save()
+
+
+    def set_max_active(self, max_active : int) -> None:
+        """
+        Changes the number of torrents downloaded at once, running downloads
+        over a lower limit finish first.
+        """
+        with self.lock:
+            self.max_active = max(1, max_active)
+            self._fill()
+
+
+    def paused(self, info_hash : str) -> bool:
+        with self.lock:
+            job = self.jobs.get(info_hash)
+            return job is not None and job.state == PAUSED
+
+
+    def status(self) -> List[Dict[str, Any]]:
+        """
+        Returns:
+            List[Dict[str, Any]]: info hash, name, priority and state of every
+            torrent, in the order they start.
+        """
+        with self.lock:
+            jobs = sorted(self.jobs.values(), key=lambda job: (-job.priority, job.order))
+            return [{key : value for key, value in asdict(job).items() if key not in ('pipe', 'order')} for job in jobs]
+
+
+    def _fill(self) -> None:
+        # starts queued torrents while slots are free, called with the lock held
+        if not self.started:
+            return
+        active = len(self.running)
+        queued = sorted((job for job in self.jobs.values() if job.state == QUEUED and job.info_hash not in self.running),
+                        key=lambda job: (-job.priority, job.order))
+        for job in queued[:max(0, self.max_active - active)]:
+            job.state = ACTIVE
+            self.running.add(job.info_hash)
+            worker = Thread(target=self._download, args=(job,))
+            worker.daemon = True
+            worker.start()
+        if queued:
+            self.save()
+
+
+    def _prune(self) -> None:
+        # drops the oldest finished and failed torrents over the limit, called with the lock held
+        finished = sorted((job for job in self.jobs.values() if job.state in (DONE, FAILED)), key=lambda job: job.order)
+        for job in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job.info_hash]
+
+
+    def _download(self, job : DownloadJob) -> None:
+        try:
+            succeeded = self.run(job)
+        except Exception as e:
+            print(f'download of {job.name} failed: {e!r}')
+            succeeded = False
+            if job.pipe is not None:
+                # the download did not get to tell the reader of the pipe
+                try:
+                    os.write(job.pipe, json.dumps({'msg' : 'failed'}).encode())
+                except OSError:
+                    pass
+        with self.lock:
+            self.running.discard(job.info_hash)
+            if job.state == ACTIVE:
+                job.state = DONE if succeeded else FAILED
+            self._prune()
+            self.save()
+            self._fill()
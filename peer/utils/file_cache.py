@@ -0,0 +1,112 @@
+import os
+import socket
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict
+
+from utils.storage import FileRange
+
+# files kept open for serving pieces, least recently used ones are closed first
+MAX_OPEN_FILES = 64
+# bytes handed to a single sendfile call
+SENDFILE_BLOCK = 1 << 20
+
+
+class FileCache:
+    """
+    Keeps the files pieces are served from open for reading and sends
+    ranges of them to sockets with sendfile, so the data goes from the page
+    cache to the socket without being copied into python.
+
+    At most `max_open` files are kept open. Files that are being sent from
+    are never closed, the least recently used idle files are closed instead.
+
+    Args:
+        max_open (int): number of files kept open.
+    """
+    def __init__(self, max_open : int = MAX_OPEN_FILES) -> None:
+        self.max_open = max(1, max_open)
+        self.files : OrderedDict[str, int] = OrderedDict()
+        # path -> number of sends using the file right now
+        self.users : Dict[str, int] = {}
+        self.lock = Lock()
+
+
+    def acquire(self, path : str) -> int:
+        with self.lock:
+            fd = self.files.get(path)
+            if fd is None:
+                self._evict(self.max_open - 1)
+                fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+                self.files[path] = fd
+            self.files.move_to_end(path)
+            self.users[path] = self.users.get(path, 0) + 1
+            return fd
+
+
+    def release(self, path : str) -> None:
+        with self.lock:
+            self.users[path] -= 1
+            if not self.users[path]:
+                del self.users[path]
+            self._evict(self.max_open)
+
+
+    def discard(self, path : str) -> None:
+        """
+        Closes a file that was replaced or changed, once nothing sends from it.
+        """
+        with self.lock:
+            if path in self.files and path not in self.users:
+                os.close(self.files.pop(path))
+
+
+    def _evict(self, limit : int) -> None:
+        for path in list(self.files):
+            if len(self.files) <= limit:
+                break
+            if path not in self.users:
+                os.close(self.files.pop(path))
+
+
+    def send(self, sock : socket.socket, file_range : FileRange, limit : int | None = None) -> int:
+        """
+        Sends as much of a range of a file as a non blocking socket takes,
+        at most `limit` bytes.
+
+        Returns:
+            int: number of bytes sent, 0 if the socket buffer is full.
+
+        Raises:
+            ConnectionError: the file ended before the range did.
+        """
+        size = min(file_range.length, SENDFILE_BLOCK, file_range.length if limit is None else limit)
+        if not hasattr(os, 'sendfile'):
+            # no sendfile on windows, a private file object keeps the seek safe
+            with open(file_range.path, 'rb') as file:
+                file.seek(file_range.offset)
+                data = file.read(size)
+            if len(data) != size:
+                raise ConnectionError(f'{file_range.path} is shorter than the requested range')
+            try:
+                return sock.send(data)
+            except BlockingIOError:
+                return 0
+
+        fd = self.acquire(file_range.path)
+        try:
+            sent = os.sendfile(sock.fileno(), fd, file_range.offset, size)
+        except BlockingIOError:
+            return 0
+        finally:
+            self.release(file_range.path)
+        if not sent:
+            raise ConnectionError(f'{file_range.path} is shorter than the requested range')
+        return sent
+
+
+    def close(self) -> None:
+        with self.lock:
+            for path in list(self.files):
+                if path not in self.users:
+                    os.close(self.files.pop(path))
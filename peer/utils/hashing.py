@@ -0,0 +1,186 @@
+import io
+import os
+import queue
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, FIRST_COMPLETED, wait
+from threading import BoundedSemaphore, Thread
+from time import monotonic
+from typing import Callable, Dict, Hashable, Iterable, List, Tuple
+
+from utils.piece_hash import PieceHasher
+from utils.storage import FileRange
+
+# bytes of pieces hashed by one task of the process pool
+BATCH_BYTES = 1 << 25
+# tasks queued per worker, bounds the memory of pending work
+TASKS_PER_WORKER = 2
+# pieces read ahead per hashing thread while a file is hashed
+PIECES_PER_WORKER = 2
+
+
+def hash_ranges(ranges : List[Tuple[Hashable, str, int, int, PieceHasher]]) -> List[Tuple[Hashable, str | None]]:
+    """
+    Hashes ranges of files, runs in the worker processes of verify_pieces.
+    Only one piece is held in memory at a time.
+
+    Args:
+        ranges (List[Tuple[Hashable, str, int, int, PieceHasher]]): key, path, offset,
+            length and piece hasher of every range.
+
+    Returns:
+        List[Tuple[Hashable, str | None]]: key and hex digest of every range,
+        None if the file is missing or shorter than the range.
+    """
+    digests = []
+    files : Dict[str, io.FileIO | None] = {}
+    buffer = bytearray()
+    try:
+        for key, path, offset, length, hasher in ranges:
+            if path not in files:
+                try:
+                    files[path] = io.FileIO(path, 'r')
+                except OSError:
+                    files[path] = None
+            file = files[path]
+            if file is None:
+                digests.append((key, None))
+                continue
+            if len(buffer) < length:
+                buffer = bytearray(length)
+            view = memoryview(buffer)[:length]
+            file.seek(offset)
+            read = 0
+            while read < length:
+                received = file.readinto(view[read:])
+                if not received:
+                    break
+                read += received
+            digests.append((key, hasher.digest(view) if read == length else None))
+    finally:
+        for file in files.values():
+            if file is not None:
+                file.close()
+    return digests
+
+
+def verify_pieces(pieces : Iterable[Tuple[Hashable, FileRange, str] | Tuple[Hashable, FileRange, str, PieceHasher]],
+                  total : int,
+                  workers : int | None = None,
+                  on_progress : Callable[[int, int, float], None] | None = None) -> Dict[Hashable, bool]:
+    """
+    Verifies pieces against their hashes on all cores. Pieces are handed to
+    a process pool in batches of about BATCH_BYTES, and only a few batches
+    per worker are queued at once, so memory stays bounded however much
+    data is checked.
+
+    Args:
+        pieces (Iterable[Tuple[Hashable, FileRange, str] | Tuple[Hashable, FileRange, str, PieceHasher]]):
+            key, location and expected hex digest of every piece, consumed lazily,
+            optionally followed by the hasher of its torrent, flat sha256 if missing.
+        total (int): bytes of all pieces, for the progress.
+        workers (int | None): worker processes, the number of cores if None.
+        on_progress (Callable[[int, int, float], None] | None): called with the bytes
+            checked, the total and the seconds since the start after every batch.
+
+    Returns:
+        Dict[Hashable, bool]: key -> whether the piece matched its hash.
+    """
+    workers = workers or os.cpu_count() or 1
+    expected : Dict[Hashable, str] = {}
+    sizes : Dict[Future, int] = {}
+    results : Dict[Hashable, bool] = {}
+    checked = 0
+    start = monotonic()
+
+    def collect(done : Iterable[Future]) -> None:
+        nonlocal checked
+        for future in done:
+            checked += sizes.pop(future)
+            for key, digest in future.result():
+                results[key] = digest is not None and digest == expected.pop(key)
+            if on_progress:
+                on_progress(checked, total, monotonic() - start)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        batch : List[Tuple[Hashable, str, int, int, PieceHasher]] = []
+        batch_size = 0
+        flat = PieceHasher()
+        for key, file_range, piece_hash, *hasher in pieces:
+            expected[key] = piece_hash
+            batch.append((key, file_range.path, file_range.offset, file_range.length, hasher[0] if hasher else flat))
+            batch_size += file_range.length
+            if batch_size < BATCH_BYTES:
+                continue
+            if len(sizes) >= workers * TASKS_PER_WORKER:
+                done, _ = wait(sizes, return_when=FIRST_COMPLETED)
+                collect(done)
+            sizes[pool.submit(hash_ranges, batch)] = batch_size
+            batch, batch_size = [], 0
+        if batch:
+            sizes[pool.submit(hash_ranges, batch)] = batch_size
+        collect(wait(list(sizes)).done)
+    return results
+
+
+def hash_file(path : str, piece_length : int, workers : int | None = None,
+              on_piece : Callable[[int, bytes, str], None] | None = None,
+              hasher : PieceHasher | None = None) -> Tuple[Dict[int, str], str]:
+    """
+    Hashes every piece of a file and the whole file.
+
+    Reading, hashing and writing overlap: the calling thread reads the
+    pieces, a pool of threads hashes them (hashlib releases the GIL while
+    it hashes) and one more thread feeds them in order to the hash of the
+    whole file, which cannot be split. At most `PIECES_PER_WORKER` pieces
+    per hashing thread are in memory at once.
+
+    Args:
+        path (str): path of the file.
+        piece_length (int): size of a piece in bytes.
+        workers (int | None): hashing threads, the number of cores if None.
+        on_piece (Callable[[int, bytes, str], None] | None): called by the hashing
+            threads with the index, data and hash of every piece.
+        hasher (PieceHasher | None): hashes the pieces, flat sha256 if None.
+
+    Returns:
+        Tuple[Dict[int, str], str]: piece index -> hex digest of the piece,
+        and the hex digest of the file, both with the algorithm of the hasher.
+    """
+    workers = workers or os.cpu_count() or 1
+    hasher = hasher or PieceHasher()
+    # every piece read takes two slots, released by its piece hash and by the file hash
+    slots = BoundedSemaphore(2 * workers * PIECES_PER_WORKER)
+    file_hash = hasher.new()
+    in_order : queue.Queue[bytes | None] = queue.Queue()
+
+    def hash_whole_file() -> None:
+        while (data := in_order.get()) is not None:
+            file_hash.update(data)
+            slots.release()
+
+    def hash_piece(index : int, data : bytes) -> str:
+        try:
+            piece_hash = hasher.digest(data)
+            if on_piece:
+                on_piece(index, data, piece_hash)
+            return piece_hash
+        finally:
+            slots.release()
+
+    whole_file_thread = Thread(target=hash_whole_file)
+    whole_file_thread.daemon = True
+    whole_file_thread.start()
+    futures : List[Future] = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool, open(path, 'rb') as file:
+            while True:
+                slots.acquire()
+                slots.acquire()
+                data = file.read(piece_length)
+                if not data:
+                    break
+                in_order.put(data)
+                futures.append(pool.submit(hash_piece, len(futures), data))
+    finally:
+        in_order.put(None)
+        whole_file_thread.join()
+    return {index : future.result() for index, future in enumerate(futures)}, file_hash.hexdigest()
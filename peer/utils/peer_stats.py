@@ -0,0 +1,150 @@
+import math
+from collections import deque
+from threading import Lock
+from time import monotonic
+from typing import Deque, Dict, Tuple
+
+# seconds of transfers the bandwidth of a peer is measured over
+RATE_WINDOW = 5
+# weight of a new sample in the smoothed round trip time, as in TCP
+RTT_WEIGHT = 0.125
+# weight of a new request in the smoothed failure rate
+FAILURE_WEIGHT = 0.2
+# seconds of data at the measured bandwidth kept requested from a peer
+QUEUE_TIME = 0.5
+# smoothed round trips a request may take before it fails
+TIMEOUT_ROUND_TRIPS = 4
+# seconds a request may always take, so a short round trip does not fail every hiccup
+MIN_TIMEOUT = 1
+
+
+class PeerStats:
+    """
+    Rolling transfer statistics of a peer.
+
+    The bandwidth is the data received in the last `window` seconds, the
+    round trip time and the failure rate are exponentially smoothed over the
+    requests. A peer is kept busy with as many requests as it sends in
+    QUEUE_TIME seconds at its bandwidth, fewer the more of its requests
+    fail. Until the first request finished nothing is known about the peer
+    and it gets the full queue.
+
+    A request fails once it took TIMEOUT_ROUND_TRIPS smoothed round trips,
+    see `timeout`. A request that timed out counts as a failure and as a
+    round trip at least as long as it waited, so a peer that stalls gets
+    fewer requests and a longer deadline, like a peer that refuses them.
+
+    The statistics are updated from several threads at once.
+
+    Args:
+        window (float): seconds the bandwidth is measured over.
+    """
+    def __init__(self, window : float = RATE_WINDOW) -> None:
+        self.window = window
+        # time and size of every transfer that finished in the window
+        self.transfers : Deque[Tuple[float, int]] = deque()
+        self.window_bytes = 0
+        # when the first request started, the window is shorter before
+        self.started : float | None = None
+        self.rtt : float | None = None
+        self.failure_rate = 0.0
+        self.bytes = 0
+        self.requests = 0
+        self.failures = 0
+        self.lock = Lock()
+
+
+    def succeeded(self, size : int, started : float, finished : float | None = None) -> None:
+        """
+        Records a request that was answered.
+
+        Args:
+            size (int): bytes received.
+            started (float): monotonic time the request was sent.
+            finished (float | None): monotonic time the reply arrived, now if None.
+        """
+        finished = monotonic() if finished is None else finished
+        with self.lock:
+            if self.started is None:
+                self.started = started
+            self.transfers.append((finished, size))
+            self.window_bytes += size
+            self.bytes += size
+            self.requests += 1
+            elapsed = finished - started
+            self.rtt = elapsed if self.rtt is None else self.rtt + RTT_WEIGHT * (elapsed - self.rtt)
+            self.failure_rate -= FAILURE_WEIGHT * self.failure_rate
+
+
+    def failed(self, elapsed : float | None = None) -> None:
+        """
+        Records a request that failed.
+
+        Args:
+            elapsed (float | None): seconds a request that timed out waited for its reply.
+        """
+        with self.lock:
+            self.requests += 1
+            self.failures += 1
+            self.failure_rate += FAILURE_WEIGHT * (1 - self.failure_rate)
+            if elapsed is not None:
+                self.rtt = elapsed if self.rtt is None else self.rtt + RTT_WEIGHT * (max(elapsed, self.rtt) - self.rtt)
+
+
+    def timeout(self, limit : float) -> float:
+        """
+        Returns:
+            float: seconds the next request may take before it fails, `limit` until
+            the first round trip is known.
+        """
+        with self.lock:
+            rtt = self.rtt
+        if rtt is None:
+            return limit
+        return min(limit, max(MIN_TIMEOUT, TIMEOUT_ROUND_TRIPS * rtt))
+
+
+    def rate(self, now : float | None = None) -> float | None:
+        """
+        Returns:
+            float | None: bytes per second received in the window, None before
+            the first transfer.
+        """
+        now = monotonic() if now is None else now
+        with self.lock:
+            return self._rate(now)
+
+
+    def _rate(self, now : float) -> float | None:
+        while self.transfers and self.transfers[0][0] <= now - self.window:
+            self.window_bytes -= self.transfers.popleft()[1]
+        if self.started is None:
+            return None
+        span = now - max(now - self.window, self.started)
+        return self.window_bytes / span if span > 0 else None
+
+
+    def queue_depth(self, block_size : int, limit : int) -> int:
+        """
+        Returns:
+            int: requests to keep running against the peer, between 1 and `limit`.
+        """
+        with self.lock:
+            rate = self._rate(monotonic())
+            failure_rate = self.failure_rate
+        depth = limit if rate is None else math.ceil(rate * QUEUE_TIME / block_size)
+        depth = round(depth * (1 - failure_rate))
+        return max(1, min(limit, depth))
+
+
+    def snapshot(self) -> Dict[str, float | int | None]:
+        """
+        Returns:
+            Dict[str, float | int | None]: bandwidth in bytes per second, round trip
+            time in seconds, failure rate and the totals of the peer.
+        """
+        with self.lock:
+            return {
+                'rate' : self._rate(monotonic()), 'rtt' : self.rtt, 'failure_rate' : self.failure_rate,
+                'bytes' : self.bytes, 'requests' : self.requests, 'failures' : self.failures
+            }
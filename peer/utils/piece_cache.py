@@ -0,0 +1,153 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Hashable, Set, Tuple
+
+# bytes of piece data the server keeps in memory
+PIECE_CACHE_BYTES = 64 << 20
+# share of the budget kept for pieces that were requested more than once
+PROTECTED_SHARE = 0.8
+# pieces remembered with the requester that first asked for them
+MAX_GHOSTS = 4096
+
+
+class PieceCache:
+    """
+    Pieces kept in memory for serving, within a budget of bytes.
+
+    The cache is a segmented LRU, which resists scans. A piece enters the
+    probation segment. Only a second hit moves it to the protected
+    segment, which holds at most `protected_share` of the budget. A peer
+    reading through a whole torrent once therefore only cycles the
+    probation segment, and does not push out the pieces a crowd keeps
+    asking for. Pieces pushed out of the protected segment go back to
+    probation, and probation pieces are evicted first.
+
+    Served pieces are only cached once a second requester asks for them,
+    see `wanted`. A piece a single peer downloads is sent straight from
+    the file, and only the pieces a crowd shares are copied into memory.
+
+    Entries are keyed by info hash and a key inside the torrent, such as
+    the piece index. All entries of a torrent, or a single one, are
+    dropped when its data is rewritten.
+
+    Args:
+        max_bytes (int): budget of cached bytes, 0 disables the cache.
+        protected_share (float): share of the budget for pieces hit more than once.
+    """
+    def __init__(self, max_bytes : int = PIECE_CACHE_BYTES, protected_share : float = PROTECTED_SHARE) -> None:
+        self.max_bytes = max(0, max_bytes)
+        self.max_protected = int(self.max_bytes * protected_share)
+        self.probation : OrderedDict[Tuple[str, Hashable], bytes] = OrderedDict()
+        self.protected : OrderedDict[Tuple[str, Hashable], bytes] = OrderedDict()
+        self.size = 0
+        self.protected_size = 0
+        # info hash -> keys cached for the torrent
+        self.keys : Dict[str, Set[Hashable]] = {}
+        self.lock = Lock()
+        # (info hash, key) of a piece that is not cached -> requester that asked for it first
+        self.ghosts : OrderedDict[Tuple[str, Hashable], Hashable] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def get(self, info_hash : str, key : Hashable) -> bytes | None:
+        with self.lock:
+            entry = (info_hash, key)
+            data = self.protected.get(entry)
+            if data is not None:
+                self.protected.move_to_end(entry)
+                self.hits += 1
+                return data
+            data = self.probation.pop(entry, None)
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.protected[entry] = data
+            self.protected_size += len(data)
+            # the least recently used protected pieces get another chance in probation
+            while self.protected_size > self.max_protected and len(self.protected) > 1:
+                demoted, demoted_data = self.protected.popitem(last=False)
+                self.protected_size -= len(demoted_data)
+                self.probation[demoted] = demoted_data
+            return data
+
+
+    def wanted(self, info_hash : str, key : Hashable, requester : Hashable) -> bool:
+        """
+        Records that a requester asked for an entry that is not cached.
+
+        Returns:
+            bool: True if another requester asked for it recently, the entry is
+            then worth caching.
+        """
+        if not self.max_bytes:
+            return False
+        with self.lock:
+            entry = (info_hash, key)
+            first = self.ghosts.get(entry)
+            if first is None:
+                self.ghosts[entry] = requester
+                if len(self.ghosts) > MAX_GHOSTS:
+                    self.ghosts.popitem(last=False)
+                return False
+            self.ghosts.move_to_end(entry)
+            return first != requester
+
+
+    def put(self, info_hash : str, key : Hashable, data : bytes) -> None:
+        """
+        Caches data, data bigger than the budget is not cached.
+        """
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            self._remove(info_hash, key)
+            self.ghosts.pop((info_hash, key), None)
+            self.probation[(info_hash, key)] = data
+            self.size += len(data)
+            self.keys.setdefault(info_hash, set()).add(key)
+            while self.size > self.max_bytes:
+                segment = self.probation if self.probation else self.protected
+                evicted_hash, evicted_key = next(iter(segment))
+                self._forget(evicted_hash, evicted_key, segment)
+                self.evictions += 1
+
+
+    def discard(self, info_hash : str, key : Hashable | None = None) -> None:
+        """
+        Drops a cached entry of a torrent, or every entry of it if `key` is None.
+        """
+        with self.lock:
+            keys = list(self.keys.get(info_hash, ())) if key is None else [key]
+            for key in keys:
+                self._remove(info_hash, key)
+
+
+    def _remove(self, info_hash : str, key : Hashable) -> None:
+        entry = (info_hash, key)
+        for segment in (self.probation, self.protected):
+            if entry in segment:
+                self._forget(info_hash, key, segment)
+
+
+    def _forget(self, info_hash : str, key : Hashable, segment : OrderedDict) -> None:
+        # removes the entry from its segment and from the index of its torrent
+        data = segment.pop((info_hash, key))
+        self.size -= len(data)
+        if segment is self.protected:
+            self.protected_size -= len(data)
+        keys = self.keys.get(info_hash)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.keys[info_hash]
+
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                'hits' : self.hits, 'misses' : self.misses, 'evictions' : self.evictions,
+                'bytes' : self.size, 'entries' : len(self.probation) + len(self.protected)
+            }
@@ -0,0 +1,162 @@
+import hashlib
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+# size of the blocks of a Merkle torrent, the block size of DownloadEngine so
+# every block request is verified on its own
+MERKLE_BLOCK_LENGTH = 1 << 16
+# stands in for the missing leaves and nodes of a Merkle tree that is not full
+PAD = bytes(32)
+# torrents with this meta version hash their pieces into Merkle trees
+MERKLE_VERSION = 2
+# hash of torrents that do not name one
+DEFAULT_ALGORITHM = 'sha256'
+
+# hash algorithm -> constructor of a hash object, every digest is 32 bytes long
+# so the hashes fit the wire protocol and the Merkle trees
+ALGORITHMS : Dict[str, Callable[..., Any]] = {
+    'sha256' : hashlib.sha256,
+    'blake2b' : lambda data=b'': hashlib.blake2b(data, digest_size=32),
+}
+if blake3 is not None:
+    ALGORITHMS['blake3'] = blake3.blake3
+
+
+def new_hash(algorithm : str = DEFAULT_ALGORITHM, data : bytes | bytearray | memoryview = b'') -> Any:
+    """
+    Returns:
+        Any: a hash object of the algorithm, fed with `data`.
+
+    Raises:
+        ValueError: the algorithm is unknown or its module is not installed.
+    """
+    try:
+        return ALGORITHMS[algorithm](data)
+    except KeyError:
+        raise ValueError(f'hash algorithm {algorithm} is not available') from None
+
+
+def merkle_root(hashes : List[bytes], width : int, algorithm : str = DEFAULT_ALGORITHM) -> bytes:
+    """
+    Returns:
+        bytes: root of the Merkle tree over the hashes, padded with PAD to
+        `width` leaves, a power of two.
+    """
+    layer = list(hashes) + [PAD] * (width - len(hashes))
+    while len(layer) > 1:
+        layer = [new_hash(algorithm, layer[i] + layer[i + 1]).digest() for i in range(0, len(layer), 2)]
+    return layer[0] if layer else PAD
+
+
+def tree_width(count : int) -> int:
+    """
+    Returns:
+        int: the smallest power of two that is at least `count`.
+    """
+    return 1 << max(0, count - 1).bit_length()
+
+
+@dataclass(frozen=True)
+class PieceHasher:
+    """
+    How the pieces of a torrent are hashed.
+
+    Flat torrents hash every piece as a whole. Merkle torrents (meta version
+    2) hash the blocks of `block_length` bytes of a piece, the hash of the
+    piece is the root of the tree over them and the `pieces root` of the
+    torrent is the root of the tree over the piece hashes. A peer that
+    knows the block hashes of a piece, checked against the piece hash,
+    verifies every block on its own as it arrives.
+
+    Every hash of a torrent, of its pieces, blocks, tree nodes and of the
+    whole file, uses the `hash algorithm` it records, SHA-256 if it records
+    none. BLAKE2b, and BLAKE3 if the blake3 module is installed, hash several
+    times faster than SHA-256 on CPUs without SHA extensions.
+
+    Args:
+        block_length (int | None): size of the blocks of a Merkle torrent,
+            None for a flat torrent.
+        piece_length (int): size of a piece, every piece tree has as many leaves
+            as a full piece has blocks.
+        algorithm (str): hash algorithm, a key of ALGORITHMS.
+    """
+    block_length : int | None = None
+    piece_length : int = 0
+    algorithm : str = DEFAULT_ALGORITHM
+
+
+    @classmethod
+    def from_info(cls, info : Dict[str, Any]) -> 'PieceHasher':
+        """
+        Raises:
+            ValueError: the hash algorithm of the torrent is not available.
+        """
+        algorithm = info.get('hash algorithm', DEFAULT_ALGORITHM)
+        new_hash(algorithm)
+        if info.get('meta version') == MERKLE_VERSION:
+            return cls(info['block length'], info['piece length'], algorithm)
+        return cls(algorithm=algorithm)
+
+
+    @property
+    def merkle(self) -> bool:
+        return self.block_length is not None
+
+
+    def new(self, data : bytes | bytearray | memoryview = b'') -> Any:
+        """
+        Returns:
+            Any: a hash object of the algorithm of the torrent.
+        """
+        return new_hash(self.algorithm, data)
+
+
+    def leaves(self, data : bytes | bytearray | memoryview) -> List[bytes]:
+        """
+        Returns:
+            List[bytes]: digest of every block of a piece.
+        """
+        view = memoryview(data)
+        return [self.new(view[begin:begin + self.block_length]).digest()
+                for begin in range(0, len(view), self.block_length)]
+
+
+    def leaves_root(self, leaves : List[bytes]) -> str:
+        """
+        Returns:
+            str: hex digest of the piece with these block hashes.
+        """
+        return merkle_root(leaves, tree_width(-(-self.piece_length // self.block_length)), self.algorithm).hex()
+
+
+    def digest(self, data : bytes | bytearray | memoryview) -> str:
+        """
+        Returns:
+            str: hex digest of a piece.
+        """
+        if not self.merkle:
+            return self.new(data).hexdigest()
+        return self.leaves_root(self.leaves(data))
+
+
+    def verify_block(self, data : bytes | bytearray | memoryview, leaves : List[bytes], begin : int) -> bool:
+        """
+        Returns:
+            bool: whether the block of a piece at an offset matches its hash.
+        """
+        index = begin // self.block_length
+        return index < len(leaves) and self.new(data).digest() == leaves[index]
+
+
+    def root(self, pieces : Dict[int, str] | Dict[str, str]) -> str:
+        """
+        Returns:
+            str: hex `pieces root` of a Merkle torrent with these piece hashes.
+        """
+        hashes = [bytes.fromhex(pieces[index]) for index in sorted(pieces, key=int)]
+        return merkle_root(hashes, tree_width(len(hashes)), self.algorithm).hex()
@@ -0,0 +1,182 @@
+import random
+from typing import Dict, Hashable, Iterable, List, Set
+
+# random probes into a bucket before falling back to scanning it
+RANDOM_PROBES = 8
+# pieces from the playback cursor on that a streamed download picks in order
+SEQUENTIAL_WINDOW = 16
+
+
+class PiecePicker:
+    """
+    Chooses which piece to request next, rarest pieces first.
+
+    The picker keeps the number of peers holding every piece. Pieces that are
+    still wanted and not requested yet are kept in buckets by that count, so
+    picking a piece for a peer only looks at the rarest bucket the peer can
+    serve. Ties inside a bucket are broken randomly so peers downloading at
+    the same time spread over different pieces.
+
+    A streamed download sets a playback cursor, the first pieces from the
+    cursor on are then picked in order before any rarer piece, so the
+    pieces a player reads next arrive first.
+
+    Args:
+        piece_count (int): number of pieces of the torrent.
+        wanted (Iterable[int]): indices of the pieces that still need to be downloaded.
+        rng (random.Random | None): source of the random tie breaking.
+    """
+    def __init__(self, piece_count : int, wanted : Iterable[int], rng : random.Random | None = None) -> None:
+        self.availability : List[int] = [0] * piece_count
+        self.wanted : Set[int] = set(wanted)
+        self.reserved : Set[int] = set()
+        self.peers : Dict[Hashable, Set[int]] = {}
+        self.random = rng or random.Random()
+
+        # availability -> pieces that can be picked, position of each piece in its bucket
+        self.buckets : Dict[int, List[int]] = {0 : list(self.wanted)}
+        self.position : Dict[int, int] = {index : i for i, index in enumerate(self.buckets[0])}
+        # first piece a streamed download needs, None to pick rarest first only
+        self.cursor : int | None = None
+        self.window = SEQUENTIAL_WINDOW
+
+
+    def __len__(self) -> int:
+        # pieces still wanted, requested ones included
+        return len(self.wanted)
+
+
+    def add_peer(self, peer : Hashable, indices : Iterable[int]) -> None:
+        if peer in self.peers:
+            self.remove_peer(peer)
+        self.peers[peer] = set()
+        for index in indices:
+            self.peer_has(peer, index)
+
+
+    def remove_peer(self, peer : Hashable) -> None:
+        for index in self.peers.pop(peer, ()):
+            self._change_availability(index, -1)
+
+
+    def peer_has(self, peer : Hashable, index : int) -> None:
+        """
+        Records that a peer holds a piece.
+        """
+        have = self.peers.setdefault(peer, set())
+        if index in have or not 0 <= index < len(self.availability):
+            return
+        have.add(index)
+        self._change_availability(index, 1)
+
+
+    def peer_lost(self, peer : Hashable, index : int) -> None:
+        """
+        Records that a peer does not hold a piece after all, for example
+        because it refused to send it.
+        """
+        have = self.peers.get(peer)
+        if have is None or index not in have:
+            return
+        have.remove(index)
+        self._change_availability(index, -1)
+
+
+    def set_cursor(self, index : int | None, window : int = SEQUENTIAL_WINDOW) -> None:
+        """
+        Moves the playback cursor, the `window` pieces from `index` on are
+        picked in order first. None goes back to rarest first.
+        """
+        self.cursor = None if index is None else max(0, index)
+        self.window = max(1, window)
+
+
+    def pick(self, peer : Hashable) -> int | None:
+        """
+        Reserves the wanted piece the peer holds that is the next after the
+        playback cursor, or the rarest one.
+
+        Returns:
+            int | None: index of the piece, None if the peer has nothing wanted.
+        """
+        have = self.peers.get(peer)
+        if not have:
+            return None
+
+        cursor = self.cursor
+        if cursor is not None:
+            # pieces before the cursor that are done are skipped for good
+            while cursor < len(self.availability) and cursor not in self.wanted:
+                cursor += 1
+            self.cursor = cursor
+            for index in range(cursor, min(cursor + self.window, len(self.availability))):
+                if index in self.position and index in have:
+                    self.reserve(index)
+                    return index
+
+        for level in sorted(level for level, bucket in self.buckets.items() if level and bucket):
+            bucket = self.buckets[level]
+            size = len(bucket)
+            for _ in range(min(size, RANDOM_PROBES)):
+                index = bucket[self.random.randrange(size)]
+                if index in have:
+                    self.reserve(index)
+                    return index
+
+            start = self.random.randrange(size)
+            for offset in range(size):
+                index = bucket[(start + offset) % size]
+                if index in have:
+                    self.reserve(index)
+                    return index
+        return None
+
+
+    def reserve(self, index : int) -> None:
+        if index in self.wanted and index not in self.reserved:
+            self._remove_from_bucket(index)
+            self.reserved.add(index)
+
+
+    def release(self, index : int) -> None:
+        """
+        Makes a reserved piece pickable again, for example after a failed request.
+        """
+        if index in self.reserved:
+            self.reserved.remove(index)
+            self._add_to_bucket(index)
+
+
+    def complete(self, index : int) -> None:
+        if index not in self.wanted:
+            return
+        if index in self.reserved:
+            self.reserved.remove(index)
+        else:
+            self._remove_from_bucket(index)
+        self.wanted.remove(index)
+
+
+    def _change_availability(self, index : int, delta : int) -> None:
+        pickable = index in self.wanted and index not in self.reserved
+        if pickable:
+            self._remove_from_bucket(index)
+        self.availability[index] += delta
+        if pickable:
+            self._add_to_bucket(index)
+
+
+    def _add_to_bucket(self, index : int) -> None:
+        bucket = self.buckets.setdefault(self.availability[index], [])
+        self.position[index] = len(bucket)
+        bucket.append(index)
+
+
+    def _remove_from_bucket(self, index : int) -> None:
+        # swap with the last piece so removal is O(1)
+        bucket = self.buckets[self.availability[index]]
+        position = self.position.pop(index)
+        last = bucket.pop()
+        if last != index:
+            bucket[position] = last
+            self.position[last] = position
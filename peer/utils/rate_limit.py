@@ -0,0 +1,189 @@
+from threading import Lock
+from time import monotonic, sleep
+from typing import Dict, List, Sequence
+
+# bytes per second peers upload and download at most, None for no limit
+UPLOAD_LIMIT : float | None = None
+DOWNLOAD_LIMIT : float | None = None
+# seconds of traffic at the limit that may be sent at once after an idle period
+BURST_SECONDS = 1
+# smallest burst, so a block of a piece always fits
+MIN_BURST = 1 << 16
+# bytes a throttled sender waits for before it sends again, so it does not send tiny packets
+MIN_SEND = 1 << 14
+
+
+class TokenBucket:
+    """
+    Rate limit of a stream of bytes.
+
+    The bucket fills with `rate` tokens a second up to `burst` tokens, every
+    byte takes one. A transfer bigger than the tokens left may still start
+    once the bucket is not empty, the bucket then goes into debt and the
+    next transfer waits until it is paid back. The rate and burst can be
+    changed while the bucket is in use, a bucket without a rate does not
+    limit anything and costs nothing.
+
+    Args:
+        rate (float | None): bytes per second, None for no limit.
+        burst (float | None): tokens the bucket holds at most, BURST_SECONDS of
+            the rate if None.
+    """
+    def __init__(self, rate : float | None = None, burst : float | None = None) -> None:
+        self.lock = Lock()
+        self.rate : float | None = None
+        self.burst = 0.0
+        self.tokens = 0.0
+        self.updated = monotonic()
+        self.set_rate(rate, burst)
+
+
+    def set_rate(self, rate : float | None, burst : float | None = None) -> None:
+        with self.lock:
+            self._refill(monotonic())
+            if rate is None or rate <= 0:
+                self.rate = None
+                return
+            self.burst = max(float(MIN_BURST), burst if burst is not None else rate * BURST_SECONDS)
+            # a bucket that was unlimited starts full
+            self.tokens = min(self.burst, self.tokens if self.rate is not None else self.burst)
+            self.rate = float(rate)
+
+
+    def _refill(self, now : float) -> None:
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+    def available(self, now : float | None = None) -> float:
+        """
+        Returns:
+            float: tokens in the bucket, infinite without a limit, negative while in debt.
+        """
+        if self.rate is None:
+            return float('inf')
+        with self.lock:
+            self._refill(monotonic() if now is None else now)
+            return self.tokens
+
+
+    def delay(self, size : float) -> float:
+        """
+        Returns:
+            float: seconds until the bucket holds `size` tokens, or is full if
+            that is fewer.
+        """
+        rate = self.rate
+        if rate is None:
+            return 0.0
+        with self.lock:
+            self._refill(monotonic())
+            return max(0.0, (min(size, self.burst) - self.tokens) / rate)
+
+
+    def consume(self, size : int) -> None:
+        if self.rate is None:
+            return
+        with self.lock:
+            self._refill(monotonic())
+            self.tokens -= size
+
+
+def allowance(buckets : Sequence[TokenBucket], size : int) -> int:
+    """
+    Returns:
+        int: bytes of a transfer of `size` bytes that can be sent right now
+        without waiting for any of the buckets, they are not taken yet.
+    """
+    allowed = size
+    for bucket in buckets:
+        if bucket.rate is not None:
+            allowed = min(allowed, max(0, int(bucket.available())))
+    return allowed
+
+
+def consume(buckets : Sequence[TokenBucket], size : int) -> None:
+    for bucket in buckets:
+        bucket.consume(size)
+
+
+def delay(buckets : Sequence[TokenBucket], size : int) -> float:
+    """
+    Returns:
+        float: seconds until every bucket holds `size` tokens, or is full.
+    """
+    return max((bucket.delay(size) for bucket in buckets), default=0.0)
+
+
+def throttle(buckets : Sequence[TokenBucket], size : int) -> None:
+    """
+    Blocks until a transfer of `size` bytes may start and takes its tokens.
+    """
+    while (wait := delay(buckets, size)) > 0:
+        sleep(wait)
+    consume(buckets, size)
+
+
+class BandwidthLimits:
+    """
+    Upload and download limits of a peer, global and per torrent.
+
+    Every transfer takes tokens from the global bucket of its direction and
+    from the bucket of its torrent, so it waits for whichever of them is
+    emptier. Limits can be changed at any time, running transfers follow
+    the new limit with their next chunk.
+
+    Args:
+        upload (float | None): global upload limit in bytes per second.
+        download (float | None): global download limit in bytes per second.
+    """
+    def __init__(self, upload : float | None = UPLOAD_LIMIT, download : float | None = DOWNLOAD_LIMIT) -> None:
+        self.upload = TokenBucket(upload)
+        self.download = TokenBucket(download)
+        # info hash -> upload and download bucket of the torrent
+        self.torrents : Dict[str, Dict[str, TokenBucket]] = {}
+        self.lock = Lock()
+
+
+    def set_limits(self, upload : float | None = None, download : float | None = None,
+                   info_hash : str | None = None) -> None:
+        """
+        Sets the limits of a torrent, or the global limits if `info_hash` is
+        None. None removes a limit.
+        """
+        if info_hash is None:
+            self.upload.set_rate(upload)
+            self.download.set_rate(download)
+            return
+        with self.lock:
+            buckets = self.torrents.setdefault(info_hash, {'upload' : TokenBucket(), 'download' : TokenBucket()})
+        buckets['upload'].set_rate(upload)
+        buckets['download'].set_rate(download)
+
+
+    def limits(self) -> Dict[str, Dict[str, float | None]]:
+        """
+        Returns:
+            Dict[str, Dict[str, float | None]]: 'global' and the info hash of every
+            torrent with limits -> its upload and download limit.
+        """
+        with self.lock:
+            torrents = dict(self.torrents)
+        result = {'global' : {'upload' : self.upload.rate, 'download' : self.download.rate}}
+        for info_hash, buckets in torrents.items():
+            result[info_hash] = {direction : bucket.rate for direction, bucket in buckets.items()}
+        return result
+
+
+    def buckets(self, direction : str, info_hash : str | None = None) -> List[TokenBucket]:
+        """
+        Returns:
+            List[TokenBucket]: the limited buckets a transfer of a torrent in a
+            direction, 'upload' or 'download', takes tokens from.
+        """
+        buckets = [self.upload if direction == 'upload' else self.download]
+        torrent = self.torrents.get(info_hash) if info_hash is not None else None
+        if torrent is not None:
+            buckets.append(torrent[direction])
+        return [bucket for bucket in buckets if bucket.rate is not None]
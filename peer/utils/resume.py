@@ -0,0 +1,102 @@
+import os
+import struct
+from threading import Lock
+from time import monotonic
+from typing import Callable, Dict, Tuple
+
+from utils.atomic_file import atomic_write
+from utils.bitfield import Bitfield
+
+# seconds between writes of the resume file while pieces arrive
+RESUME_FLUSH_INTERVAL = 1
+# magic, number of pieces, size and modification time of the data when the
+# bitfield was written, followed by the bitfield
+RESUME_HEADER = struct.Struct('!4sIqq')
+RESUME_MAGIC = b'RSM2'
+
+
+class ResumeFile:
+    """
+    The bitfield of the verified pieces of a torrent, kept on disk so an
+    interrupted download continues where it stopped.
+
+    The file is rewritten at most every `flush_interval` seconds while
+    pieces arrive, written to a temporary file first and swapped in, so it
+    is never half written. A crash loses at most the pieces of the last
+    interval, they are downloaded again.
+
+    Args:
+        path (str): path of the resume file.
+        piece_count (int): number of pieces of the torrent.
+        flush_interval (float): seconds between writes.
+    """
+    def __init__(self, path : str, piece_count : int, flush_interval : float = RESUME_FLUSH_INTERVAL) -> None:
+        self.path = path
+        self.piece_count = piece_count
+        self.flush_interval = flush_interval
+        self.flushed = monotonic()
+        self.dirty = False
+        self.lock = Lock()
+
+
+    def load(self) -> Tuple[Bitfield, Dict[str, int] | None] | None:
+        """
+        Returns:
+            Tuple[Bitfield, Dict[str, int] | None] | None: the saved bitfield and the
+            stamp of the data it was written for, None if there is no usable resume file.
+        """
+        try:
+            with open(self.path, 'rb') as file:
+                data = file.read()
+        except OSError:
+            return None
+        if len(data) < RESUME_HEADER.size:
+            return None
+        magic, piece_count, size, mtime = RESUME_HEADER.unpack_from(data)
+        bitfield_data = data[RESUME_HEADER.size:]
+        if magic != RESUME_MAGIC or piece_count != self.piece_count or len(bitfield_data) != (piece_count + 7) // 8:
+            return None
+        stamp = {'size' : size, 'mtime' : mtime} if mtime >= 0 else None
+        return Bitfield(piece_count, bitfield_data), stamp
+
+
+    def update(self, snapshot : Callable[[], bytes], sync : Callable[[], None] | None = None,
+               stamp : Callable[[], Dict[str, int] | None] | None = None) -> None:
+        """
+        Records that a piece was verified, the file is written if the last
+        write is older than the flush interval.
+
+        Args:
+            snapshot (Callable[[], bytes]): returns the current bitfield.
+            sync (Callable[[], None] | None): makes the piece data durable before
+                the resume file claims it.
+            stamp (Callable[[], Dict[str, int] | None] | None): returns the file_stamp of
+                the data, a recheck skips the torrent while the data still has it.
+        """
+        self.dirty = True
+        if monotonic() - self.flushed >= self.flush_interval:
+            self.flush(snapshot, sync, stamp)
+
+
+    def flush(self, snapshot : Callable[[], bytes], sync : Callable[[], None] | None = None,
+              stamp : Callable[[], Dict[str, int] | None] | None = None, force : bool = False) -> None:
+        with self.lock:
+            if not self.dirty and not force:
+                return
+            self.dirty = False
+            self.flushed = monotonic()
+            if sync:
+                sync()
+            data_stamp = stamp() if stamp else None
+            if data_stamp is None:
+                data_stamp = {'size' : -1, 'mtime' : -1}
+            header = RESUME_HEADER.pack(RESUME_MAGIC, self.piece_count, data_stamp['size'], data_stamp['mtime'])
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            atomic_write(self.path, header + snapshot())
+
+
+    def remove(self) -> None:
+        with self.lock:
+            self.dirty = False
+            if os.path.exists(self.path):
+                os.remove(self.path)
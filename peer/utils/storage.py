@@ -0,0 +1,402 @@
+import os
+from dataclasses import dataclass
+from threading import Lock
+from typing import Any, Dict, List
+
+from utils.bitfield import Bitfield
+from utils.piece_hash import PieceHasher
+from utils.resume import ResumeFile
+
+# keys of a torrent file that only describe the local copy and are not sent to peers
+LOCAL_KEYS = ('storage',)
+
+
+def public_torrent(torrent : Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Returns:
+        Dict[str, Any]: the torrent without the keys describing the local copy.
+    """
+    return {key : value for key, value in torrent.items() if key not in LOCAL_KEYS}
+
+
+def file_stamp(path : str) -> Dict[str, int] | None:
+    """
+    Returns:
+        Dict[str, int] | None: size and modification time of a file, compared
+        to notice that a seeded file changed, None if the file is missing.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return {'size' : stat.st_size, 'mtime' : stat.st_mtime_ns}
+
+
+@dataclass
+class FileRange:
+    """
+    Bytes of a file a piece request is answered with, sent without reading
+    them into python.
+    """
+    path : str
+    offset : int
+    length : int
+
+
+class ChunkStorage:
+    """
+    Stores every piece of a torrent as `<directory>/<piece hash>.bin`.
+
+    Args:
+        directory (str): directory of the pieces, named after the info hash.
+        pieces (Dict[int, str]): piece index -> piece hash.
+        resume (str | None): path of the resume file of the torrent.
+    """
+    def __init__(self, directory : str, pieces : Dict[int, str], resume : str | None = None) -> None:
+        self.directory = directory
+        self.pieces = pieces
+        self.lock = Lock()
+        self.resume = ResumeFile(resume, len(pieces)) if resume else None
+        resumed = self.resume.load() if self.resume else None
+        # stamp of the directory when the resume state was written
+        self.resumed_stamp = resumed[1] if resumed else None
+        if resumed is None:
+            # no resume state yet, the directory is listed once
+            self.have = Bitfield.from_indices(len(pieces), self._listed())
+        else:
+            self.have = resumed[0]
+
+
+    def path(self, index : int) -> str:
+        return os.path.join(self.directory, self.pieces[index] + '.bin')
+
+
+    def _listed(self) -> List[int]:
+        if not os.path.exists(self.directory):
+            return []
+        parts_hash = {filename.split('.')[0] for filename in os.listdir(self.directory)}
+        return [index for index, part_hash in self.pieces.items() if part_hash in parts_hash]
+
+
+    def available(self) -> List[int]:
+        return list(self.have)
+
+
+    def snapshot(self) -> bytes:
+        with self.lock:
+            return self.have.to_bytes()
+
+
+    def read(self, index : int, begin : int, length : int) -> bytes | None:
+        if index not in self.have or not os.path.exists(self.path(index)):
+            return None
+        with open(self.path(index), 'rb') as file:
+            file.seek(begin)
+            data = file.read(length)
+        if len(data) != length:
+            return None
+        return data
+
+
+    def locate(self, index : int, begin : int, length : int) -> FileRange | None:
+        if index not in self.have:
+            return None
+        path = self.path(index)
+        try:
+            if os.path.getsize(path) < begin + length:
+                return None
+        except OSError:
+            return None
+        return FileRange(path, begin, length)
+
+
+    def write(self, index : int, data : bytes) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path(index), 'wb') as file:
+            file.write(data)
+        with self.lock:
+            self.have.set(index)
+        if self.resume:
+            self.resume.update(self.snapshot, stamp=self.directory_stamp)
+
+
+    def directory_stamp(self) -> Dict[str, int] | None:
+        # pieces are written as new files, which changes the modification time of the directory
+        return file_stamp(self.directory)
+
+
+    def flush(self) -> None:
+        if self.resume:
+            self.resume.flush(self.snapshot, stamp=self.directory_stamp)
+
+
+    def unchanged(self) -> bool:
+        """
+        Returns:
+            bool: whether the pieces on disk are known to match the have state.
+        """
+        return self.resumed_stamp is not None and self.directory_stamp() == self.resumed_stamp
+
+
+    def piece_range(self, index : int, size : int) -> FileRange:
+        return FileRange(self.path(index), 0, size)
+
+
+    def reset(self, have : Bitfield) -> None:
+        """
+        Replaces the have state with the pieces a recheck verified.
+        """
+        with self.lock:
+            self.have = have
+        if self.resume:
+            self.resume.flush(self.snapshot, stamp=self.directory_stamp, force=True)
+            self.resumed_stamp = self.directory_stamp()
+
+
+    def close(self) -> None:
+        self.flush()
+
+
+class FileStorage:
+    """
+    Stores a torrent in its final file, piece `i` lives at offset
+    `i * piece length`. The file is created at its full size up front and
+    pieces are written in place with positional writes, so it is complete the
+    moment the last piece is written.
+
+    Args:
+        path (str): path of the file.
+        length (int): size of the file in bytes.
+        piece_length (int): size of a piece in bytes.
+        complete (bool): whether the file already holds every piece, complete
+            files are only opened for reading.
+        stamp (Dict[str, int] | None): file_stamp of the file when its pieces were
+            last verified.
+        resume (str | None): path of the resume file of an incomplete file.
+    """
+    def __init__(self, path : str, length : int, piece_length : int, complete : bool = False,
+                 stamp : Dict[str, int] | None = None, resume : str | None = None) -> None:
+        self.path = path
+        self.length = length
+        self.piece_length = piece_length
+        self.stamp = stamp
+        # files without a stamp are downloads, their pieces are verified as they arrive
+        self.stamped = stamp is not None
+        self.writable = not complete
+        piece_count = (length + piece_length - 1) // piece_length
+        self.have = Bitfield(piece_count)
+        if complete:
+            self.have = Bitfield(piece_count, b'\xff' * len(self.have.data))
+        self.fd : int | None = None
+        self.lock = Lock()
+        self.resume = ResumeFile(resume, piece_count) if resume and not complete else None
+        # stamp of the file when the resume state was written
+        self.resumed_stamp : Dict[str, int] | None = None
+        # the resume state of a file that was deleted or resized is worthless
+        resumed = self.resume.load() if self.resume else None
+        if resumed and (file_stamp(path) or {}).get('size') == length:
+            self.have, self.resumed_stamp = resumed
+
+
+    def open(self) -> int:
+        with self.lock:
+            return self._open()
+
+
+    def _open(self) -> int:
+        if self.fd is None:
+            flags = os.O_RDWR | os.O_CREAT if self.writable else os.O_RDONLY
+            flags |= getattr(os, 'O_BINARY', 0)
+            # created like open() creates files, readable and writable but not executable
+            self.fd = os.open(self.path, flags, 0o666)
+        return self.fd
+
+
+    def pread(self, length : int, offset : int) -> bytes:
+        if hasattr(os, 'pread'):
+            return os.pread(self.open(), length, offset)
+        # windows has no positional io, seek and read under the lock instead
+        with self.lock:
+            fd = self._open()
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, length)
+
+
+    def pwrite(self, data : bytes, offset : int) -> None:
+        view = memoryview(data)
+        while view:
+            if hasattr(os, 'pwrite'):
+                written = os.pwrite(self.open(), view, offset)
+            else:
+                with self.lock:
+                    fd = self._open()
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    written = os.write(fd, view)
+            view = view[written:]
+            offset += written
+
+
+    def preallocate(self) -> None:
+        # sized with truncate, filesystems that support it keep the file sparse
+        fd = self.open()
+        if os.fstat(fd).st_size != self.length:
+            os.ftruncate(fd, self.length)
+
+
+    def available(self) -> List[int]:
+        return list(self.have)
+
+
+    def locate(self, index : int, begin : int, length : int) -> FileRange | None:
+        offset = index * self.piece_length + begin
+        if index not in self.have or begin + length > self.piece_length or offset + length > self.length:
+            return None
+        return FileRange(self.path, offset, length)
+
+
+    def read(self, index : int, begin : int, length : int) -> bytes | None:
+        file_range = self.locate(index, begin, length)
+        if file_range is None:
+            return None
+        offset = file_range.offset
+        try:
+            data = self.pread(length, offset)
+        except OSError:
+            return None
+        if len(data) != length:
+            return None
+        return data
+
+
+    def write(self, index : int, data : bytes) -> None:
+        self.pwrite(data, index * self.piece_length)
+        with self.lock:
+            self.have.set(index)
+        if self.resume:
+            self.resume.update(self.snapshot, self.sync, self.file_stamp)
+
+
+    def snapshot(self) -> bytes:
+        with self.lock:
+            return self.have.to_bytes()
+
+
+    def sync(self) -> None:
+        # the pieces reach the disk before the resume file claims them
+        with self.lock:
+            if self.fd is not None:
+                os.fsync(self.fd)
+
+
+    def file_stamp(self) -> Dict[str, int] | None:
+        return file_stamp(self.path)
+
+
+    def flush(self) -> None:
+        if self.resume:
+            self.resume.flush(self.snapshot, self.sync, self.file_stamp)
+
+
+    def unchanged(self) -> bool:
+        """
+        Returns:
+            bool: whether the pieces on disk are known to match the have state.
+        """
+        if self.stamped:
+            return not self.stale()
+        return self.resumed_stamp is not None and self.file_stamp() == self.resumed_stamp
+
+
+    def piece_range(self, index : int, size : int) -> FileRange:
+        return FileRange(self.path, index * self.piece_length, size)
+
+
+    def reset(self, have : Bitfield) -> None:
+        """
+        Replaces the have state with the pieces a recheck verified.
+        """
+        with self.lock:
+            self.have = have
+            if self.stamped:
+                self.stamp = file_stamp(self.path)
+        if self.resume:
+            self.resume.flush(self.snapshot, self.sync, self.file_stamp, force=True)
+            self.resumed_stamp = self.file_stamp()
+
+
+    def stale(self) -> bool:
+        """
+        Returns:
+            bool: whether the file changed since its pieces were last verified.
+        """
+        return self.stamped and file_stamp(self.path) != self.stamp
+
+
+    def rehash(self, pieces : Dict[int, str], hasher : PieceHasher | None = None) -> bool:
+        """
+        Verifies every piece of the file against its hash, only the pieces
+        that still match are served afterwards.
+
+        Args:
+            pieces (Dict[int, str]): piece index -> expected hex digest.
+            hasher (PieceHasher | None): hashes the pieces, flat sha256 if None.
+
+        Returns:
+            bool: True if every piece matched.
+        """
+        hasher = hasher or PieceHasher()
+        stamp = file_stamp(self.path)
+        self.close()
+        have = Bitfield(len(self.have))
+        if stamp is not None:
+            for index, part_hash in pieces.items():
+                offset = index * self.piece_length
+                size = min(self.piece_length, self.length - offset)
+                try:
+                    data = self.pread(size, offset)
+                except OSError:
+                    break
+                if len(data) == size and hasher.digest(data) == part_hash:
+                    have.set(index)
+        with self.lock:
+            self.have = have
+            self.stamp = stamp
+        return have.complete()
+
+
+    def seal(self) -> Dict[str, int] | None:
+        """
+        Stamps the finished file, changes to it are noticed from now on.
+
+        Returns:
+            Dict[str, int] | None: the stamp to record with the torrent.
+        """
+        if self.resume:
+            # complete files need no resume state
+            self.resume.remove()
+            self.resume = None
+        with self.lock:
+            self.stamp = file_stamp(self.path)
+            self.stamped = True
+            return self.stamp
+
+
+    def move(self, path : str) -> None:
+        """
+        Renames the file. Open files cannot be renamed on windows, there it is
+        closed first and reopened by the next read.
+        """
+        with self.lock:
+            if not hasattr(os, 'pread') and self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+            os.replace(self.path, path)
+            self.path = path
+
+
+    def close(self) -> None:
+        self.flush()
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
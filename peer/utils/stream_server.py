@@ -0,0 +1,160 @@
+import mimetypes
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep
+from typing import Any, Callable, Dict, Tuple
+
+# seconds a request waits for a piece that was not downloaded yet
+STREAM_WAIT = 30
+# seconds between two looks at a missing piece
+STREAM_POLL = 0.05
+
+RANGE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header : str | None, length : int) -> Tuple[int, int] | None:
+    """
+    Parses a single range of a Range header.
+
+    Returns:
+        Tuple[int, int] | None: first and last byte of the range, the whole file
+        if there is no header, None if the range cannot be satisfied.
+
+    Raises:
+        ValueError: the header is not a single byte range.
+    """
+    if header is None:
+        return (0, length - 1) if length else None
+    match = RANGE.match(header.strip())
+    if match is None or match.group(1) == match.group(2) == '':
+        raise ValueError(f'unsupported range {header}')
+    first, last = match.groups()
+    if first == '':
+        # the last bytes of the file
+        start, end = max(0, length - int(last)), length - 1
+    else:
+        start, end = int(first), min(int(last), length - 1) if last else length - 1
+    if start > end or start >= length:
+        return None
+    return start, end
+
+
+class StreamServer(ThreadingHTTPServer):
+    """
+    Serves torrents over HTTP while they download, at
+    `http://<host>:<port>/<info hash>`, so a media player can start before
+    the last piece arrived.
+
+    Requests may ask for a byte range. The body is sent piece by piece, a
+    piece that is not there yet moves the playback cursor of the download
+    to it with `seek`, so the pieces the player needs next are downloaded
+    first, and the request waits up to STREAM_WAIT seconds for it. The
+    first bytes are therefore sent as soon as the first pieces of the range
+    arrived instead of after the whole file.
+
+    Args:
+        address (Tuple[str, int]): address the server listens on, port 0 picks a free port.
+        source (Callable[[str], Tuple[Dict[str, Any], Any] | None]): info and storage of a
+            torrent by info hash, None while the torrent is unknown.
+        seek (Callable[[str, int], None]): moves the cursor of a running download to a piece.
+    """
+    daemon_threads = True
+
+    def __init__(self, address : Tuple[str, int], source : Callable[[str], Tuple[Dict[str, Any], Any] | None],
+                 seek : Callable[[str, int], None]) -> None:
+        super().__init__(address, StreamHandler)
+        self.source = source
+        self.seek = seek
+
+
+    def url(self, info_hash : str) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/{info_hash}'
+
+
+    def wait_for_source(self, info_hash : str) -> Tuple[Dict[str, Any], Any] | None:
+        # the torrent of a download that just started is fetched from its peers first
+        deadline = monotonic() + STREAM_WAIT
+        while (found := self.source(info_hash)) is None and monotonic() < deadline:
+            sleep(STREAM_POLL)
+        return found
+
+
+    def read(self, info_hash : str, storage : Any, index : int, begin : int, length : int) -> bytes | None:
+        """
+        Returns:
+            bytes | None: bytes of a piece, waited for if the piece is missing, None
+            if it did not arrive within STREAM_WAIT seconds.
+        """
+        data = storage.read(index, begin, length)
+        if data is not None:
+            return data
+        self.seek(info_hash, index)
+        deadline = monotonic() + STREAM_WAIT
+        while data is None and monotonic() < deadline:
+            sleep(STREAM_POLL)
+            data = storage.read(index, begin, length)
+        return data
+
+
+class StreamHandler(BaseHTTPRequestHandler):
+    server : StreamServer
+
+    def do_HEAD(self) -> None:
+        self.respond(body=False)
+
+
+    def do_GET(self) -> None:
+        self.respond(body=True)
+
+
+    def respond(self, body : bool) -> None:
+        info_hash = self.path.strip('/').split('?')[0]
+        found = self.server.wait_for_source(info_hash) if re.fullmatch(r'[0-9a-f]{64}', info_hash) else None
+        if found is None:
+            self.send_error(404, 'unknown torrent')
+            return
+        info, storage = found
+        length, piece_length = info['length'], info['piece length']
+        try:
+            requested = parse_range(self.headers.get('Range'), length)
+        except ValueError:
+            self.send_error(400, 'only single byte ranges are supported')
+            return
+        if requested is None:
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{length}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start, end = requested
+        self.send_response(206 if self.headers.get('Range') else 200)
+        self.send_header('Content-Type', mimetypes.guess_type(info['name'])[0] or 'application/octet-stream')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        if self.headers.get('Range'):
+            self.send_header('Content-Range', f'bytes {start}-{end}/{length}')
+        self.end_headers()
+        if not body:
+            return
+
+        position = start
+        while position <= end:
+            index, begin = divmod(position, piece_length)
+            size = min(piece_length - begin, end - position + 1)
+            data = self.server.read(info_hash, storage, index, begin, size)
+            if data is None:
+                # the headers are out, a player retries the rest with a new range
+                self.close_connection = True
+                return
+            try:
+                self.wfile.write(data)
+            except (BrokenPipeError, ConnectionResetError):
+                # players close the connection when they seek
+                return
+            position += size
+
+
+    def log_message(self, format : str, *args : Any) -> None:
+        pass
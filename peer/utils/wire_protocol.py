@@ -0,0 +1,84 @@
+import socket
+import struct
+
+# version sent in the `$session` handshake, peers use the lower of both versions
+PROTOCOL_VERSION = 2
+
+# every frame starts with: message type, request id, payload length
+HEADER = struct.Struct('!BII')
+# requests are tiny, anything bigger is a broken or hostile peer
+MAX_REQUEST_SIZE = 65536
+# replies are blocks, block hashes and torrents, whose piece hashes of even a
+# terabyte file take a few MB, anything bigger is not read into memory
+MAX_REPLY_SIZE = 1 << 24
+
+# message types, a reply carries the type and request id of its request
+TORRENT = 1             # payload: info hash, reply: torrent json
+PARTS_AVAILABLE = 2     # payload: info hash, reply: bitfield of the pieces held
+PART = 3                # payload: PART_REQUEST, reply: PART_REPLY followed by the data
+NOT_FOUND = 4           # reply to a request that cannot be answered
+CANCEL = 5              # no payload, drops a request that was not answered yet,
+                        # the server confirms with a CANCEL reply of the same id
+HASHES = 6              # payload: PART_REQUEST of a whole piece of a Merkle torrent,
+                        # reply: the digest of every block of the piece
+CHOKED = 7              # reply to a PART request of a peer the server does not upload to
+                        # right now, sent to peers of version 2 and newer
+
+# info hash, piece index, offset in the piece, number of bytes
+PART_REQUEST = struct.Struct('!32sIII')
+# piece index, offset in the piece
+PART_REPLY = struct.Struct('!II')
+
+
+def pack_frame(msg_type : int, request_id : int, payload : bytes = b'') -> bytes:
+    """
+    Packs a frame.
+
+    Args:
+        msg_type (int): message type.
+        request_id (int): id the reply is matched with.
+        payload (bytes): frame payload.
+
+    Returns:
+        bytes: the frame.
+    """
+    return HEADER.pack(msg_type, request_id, len(payload)) + payload
+
+
+def pack_part_request(info_hash : str, index : int, begin : int, length : int) -> bytes:
+    return PART_REQUEST.pack(bytes.fromhex(info_hash), index, begin, length)
+
+
+def unpack_part_request(payload : bytes) -> tuple[str, int, int, int]:
+    info_hash, index, begin, length = PART_REQUEST.unpack(payload)
+    return info_hash.hex(), index, begin, length
+
+
+def recv_into_exact(sock : socket.socket, view : memoryview) -> None:
+    """
+    Fills the whole buffer from the socket.
+
+    Raises:
+        ConnectionError: the peer closed the connection before the buffer was filled.
+    """
+    while view:
+        received = sock.recv_into(view)
+        if not received:
+            raise ConnectionError('connection closed by the peer')
+        view = view[received:]
+
+
+def recv_exact(sock : socket.socket, size : int) -> bytearray:
+    data = bytearray(size)
+    recv_into_exact(sock, memoryview(data))
+    return data
+
+
+def read_header(sock : socket.socket) -> tuple[int, int, int]:
+    """
+    Reads a frame header.
+
+    Returns:
+        tuple[int, int, int]: message type, request id and payload length.
+    """
+    return HEADER.unpack(recv_exact(sock, HEADER.size))